@@ -1,5 +1,6 @@
-from sklearn.cluster import AgglomerativeClustering
-from src.similarity import rcmcs_similarity_matrix, load_similarity_matrix
+import scipy.sparse as sp
+from src.similarity import load_similarity_matrix, similarity_chunks, leader_clusters
+from src.clustering import minimum_spanning_edges, streamed_minimum_spanning_edges, save_hierarchy, hierarchy_clusters
 from src.utils import load_json, save_json, construct_sparse_adj_mat
 import pandas as pd
 import numpy as np
@@ -13,46 +14,65 @@ def main(cfg: DictConfig):
         Path(cfg.filepaths.data) / cfg.dataset / (cfg.toc + ".csv")
         )
     
-    if cfg.similarity_score == 'rcmcs':
-        rules = pd.read_csv(
-            filepath_or_buffer=Path(cfg.filepaths.artifacts) / 'minimal1224_all_uniprot.tsv',
-            sep='\t'
-        )
-        rules.set_index('Name', inplace=True)
-        rxns = load_json(Path(cfg.filepaths.data) / f"{cfg.dataset}/{cfg.toc}.json")
+    if cfg.similarity_score in ('rcmcs', 'mcs'): # Reaction based similarity
         matrix_idx_to_id = adj_to_rxn_id
-        S = rcmcs_similarity_matrix(rxns, rules, matrix_idx_to_id)
     else: # Protein based similarity
+        matrix_idx_to_id = adj_to_prot_id
+
+    if cfg.leader and cfg.similarity_score not in ('rcmcs', 'mcs'):
+        raise ValueError(f"leader clustering scores reaction MCS on demand, similarity_score must be 'rcmcs' or 'mcs', got '{cfg.similarity_score}'")
+    elif cfg.leader: # Reaction similarity scored on demand against cluster leaders only, no matrix needed
+        rules = None
+        if cfg.similarity_score == 'rcmcs':
+            rules = pd.read_csv(
+                filepath_or_buffer=Path(cfg.filepaths.artifacts) / 'minimal1224_all_uniprot.tsv',
+                sep='\t'
+            )
+            rules.set_index('Name', inplace=True)
+
+        rxns = load_json(Path(cfg.filepaths.data) / f"{cfg.dataset}/{cfg.toc}.json")
+        labels = leader_clusters(rxns, matrix_idx_to_id, list(cfg.cutoffs), rules=rules)
+        for cutoff, cutoff_labels in labels.items():
+            id2cluster = {matrix_idx_to_id[i] : int(cutoff_labels[i]) for i in matrix_idx_to_id}
+            save_json(id2cluster, Path(cfg.filepaths.clustering) / f"{cfg.dataset}_{cfg.toc}_{cfg.similarity_score}_leader_{cutoff}.json")
+
+        return
+
+    # Normalize stored raw blosum alignment scores, incl. 0s, w/ the clip bounds. Unthresholded
+    # chunks store every pair, w/ --min-similarity those not stored stay at 0 similarity
+    normalize_blosum = lambda x: ((np.clip(x, cfg.blosum_lb, cfg.blosum_ub) - cfg.blosum_lb) / (cfg.blosum_ub - cfg.blosum_lb)).astype(np.float32)
+
+    # Saved by scripts/similarity_matrix.py: dense, condensed or w/ --min-similarity sparse
+    sim_path = Path(cfg.filepaths.results) / "similarity_matrices"
+    if cfg.streamed: # Chunk shards merged into the spanning tree one at a time
+        edges = streamed_minimum_spanning_edges(
+            similarity_chunks(sim_path, cfg.dataset, cfg.toc, cfg.similarity_score),
+            n=len(matrix_idx_to_id),
+            transform=normalize_blosum if cfg.similarity_score == 'blosum' else None
+        )
+    else:
         S = load_similarity_matrix(
-            sim_path=Path(cfg.filepaths.results) / "similarity_matrices",
+            sim_path=sim_path,
             dataset=cfg.dataset,
             toc=cfg.toc,
-            sim_metric=cfg.similarity_score
+            sim_metric=cfg.similarity_score,
+            sparse=cfg.sparse
         )
-        matrix_idx_to_id = adj_to_prot_id
-
-        if cfg.similarity_score == 'blosum':
+        if cfg.similarity_score == 'blosum' and sp.issparse(S):
+            S.data = normalize_blosum(S.data)
+        elif cfg.similarity_score == 'blosum':
             # Normalize blosum alignment scores
             S = np.where(S > cfg.blosum_ub, cfg.blosum_ub, S)
             S = np.where(S < cfg.blosum_lb, cfg.blosum_lb, S)
             S = (S - S.min()) / (S.max() - S.min())
-        
-    D = 1 - S # Distance matrix
-    
-    for cutoff in cfg.cutoffs:
-        d_cutoff = 1 - (cutoff / 100)
-
-        # Cluster
-        ac = AgglomerativeClustering(
-            n_clusters=None,
-            metric='precomputed',
-            distance_threshold=d_cutoff,
-            linkage='single'
-        )
-        ac.fit(D)            
-        labels = ac.labels_
-        id2cluster = {matrix_idx_to_id[i] : int(labels[i]) for i in matrix_idx_to_id}
-        
+
+        edges = minimum_spanning_edges(S)
+
+    # The minimum spanning tree of D = 1 - S is the whole hierarchy: save it once
+    # and cut it at every cutoff, see src.clustering.hierarchy_clusters for others
+    ids = [matrix_idx_to_id[i] for i in range(len(matrix_idx_to_id))]
+    save_hierarchy(Path(cfg.filepaths.clustering) / f"{cfg.dataset}_{cfg.toc}_{cfg.similarity_score}_hierarchy.npz", edges, ids)
+    for cutoff, id2cluster in hierarchy_clusters((edges, ids), list(cfg.cutoffs)).items():
         # Save clusters
         save_json(id2cluster, Path(cfg.filepaths.clustering) / f"{cfg.dataset}_{cfg.toc}_{cfg.similarity_score}_{cutoff}.json")
 
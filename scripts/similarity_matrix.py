@@ -1,17 +1,31 @@
 from src.utils import load_embed_matrix, construct_sparse_adj_mat, load_json
+from src.similarity_store import SimilarityStore
+from src.condensed_matrix import CondensedSimilarityMatrix
 from src.similarity import(
     embedding_similarity_matrix,
     rcmcs_similarity_matrix,
+    extend_embedding_similarity_matrix,
+    extend_rcmcs_similarity_matrix,
     mcs_similarity_matrix,
     tanimoto_similarity_matrix,
     agg_mfp_cosine_similarity_matrix,
     homology_similarity_matrix,
-    blosum_similarity_matrix
+    kmer_pair_bound,
+    blosum_similarity_matrix,
+    balanced_row_chunks,
+    assemble_similarity_tiles,
+    load_similarity_matrix
 )
 from omegaconf import OmegaConf
 from pathlib import Path
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 from time import perf_counter
+from contextlib import nullcontext
+from functools import partial
+import os
+import json
+import shutil
+import tempfile
 import pandas as pd
 import numpy as np
 import scipy.sparse as sp
@@ -28,7 +42,45 @@ def save_sim_mat(S: np.ndarray, save_to: Path):
     if not parent.exists():
         parent.mkdir(parents=True)
 
-    np.save(save_to, S)
+    if isinstance(S, CondensedSimilarityMatrix):
+        S.save(save_to)
+    elif sp.issparse(S):
+        sp.save_npz(save_to, S)
+    else:
+        np.save(save_to, S)
+
+def parse_shard(value: str) -> tuple[int]:
+    '''
+    Parses --shard i/N
+    '''
+    try:
+        i, n = (int(elt) for elt in value.split('/'))
+    except ValueError:
+        raise ArgumentTypeError(f"Expected i/N, got {value}")
+
+    if not 0 <= i < n:
+        raise ArgumentTypeError(f"Shard index must be in [0, {n}), got {i}")
+
+    return i, n
+
+def check_extend(args):
+    '''
+    --extend writes a dense matrix in one job, whatever the old one's format
+    '''
+    if not args.extend:
+        return
+
+    unsupported = [
+        flag for flag, value in [
+            ('--shard', args.shard), ('--min-similarity', args.min_similarity is not None), ('--condensed', getattr(args, 'condensed', False))
+        ]
+        if value
+    ]
+    if unsupported:
+        raise ArgumentTypeError(f"--extend cannot be combined w/ {', '.join(unsupported)}")
+
+def tiles_dir(save_to: Path) -> Path:
+    return save_to.parent / f"{save_to.name}_tiles"
 
 def calc_rxn_embed_sim(args, embeddings_superdir: Path = embeddings_superdir, sim_mats_dir: Path = sim_mats_dir):
     embed_path = embeddings_superdir / args.embed_path
@@ -36,10 +88,18 @@ def calc_rxn_embed_sim(args, embeddings_superdir: Path = embeddings_superdir, si
     _, _, idx_feature = construct_sparse_adj_mat(data_fp / args.dataset / f"{args.toc}.csv")
     X = load_embed_matrix(embed_path, idx_feature, args.dataset, args.toc)
     tic = perf_counter()
-    S = embedding_similarity_matrix(X)
+    check_extend(args)
+    if args.extend:
+        _, _, old_idx_feature = construct_sparse_adj_mat(data_fp / args.dataset / f"{args.extend}.csv")
+        S_old = load_similarity_matrix(sim_mats_dir, args.dataset, args.extend, '_'.join(args.embed_path.split('/')))
+        S = extend_embedding_similarity_matrix(S_old, old_idx_feature, X, idx_feature)
+        save_sim_mat(S, save_to)
+    else: # Written to save_to as it is computed, shards as tiles, see merge
+        embedding_similarity_matrix(
+            X, min_similarity=args.min_similarity, shard=args.shard, checkpoint_dir=tiles_dir(save_to), save_to=save_to
+        )
     toc = perf_counter()
     print(f"Matrix multiplication took: {toc - tic} seconds")
-    save_sim_mat(S, save_to)
 
 def calc_prot_embed_sim(args, embeddings_superdir: Path = embeddings_superdir, sim_mats_dir: Path = sim_mats_dir):
     embed_path = embeddings_superdir / args.embed_path
@@ -47,10 +107,18 @@ def calc_prot_embed_sim(args, embeddings_superdir: Path = embeddings_superdir, s
     _, idx_sample, _ = construct_sparse_adj_mat(data_fp / args.dataset / f"{args.toc}.csv")
     X = load_embed_matrix(embed_path, idx_sample, args.dataset, args.toc)
     tic = perf_counter()
-    S = embedding_similarity_matrix(X)
+    check_extend(args)
+    if args.extend:
+        _, old_idx_sample, _ = construct_sparse_adj_mat(data_fp / args.dataset / f"{args.extend}.csv")
+        S_old = load_similarity_matrix(sim_mats_dir, args.dataset, args.extend, '_'.join(args.embed_path.split('/')))
+        S = extend_embedding_similarity_matrix(S_old, old_idx_sample, X, idx_sample)
+        save_sim_mat(S, save_to)
+    else: # Written to save_to as it is computed, shards as tiles, see merge
+        embedding_similarity_matrix(
+            X, min_similarity=args.min_similarity, shard=args.shard, checkpoint_dir=tiles_dir(save_to), save_to=save_to
+        )
     toc = perf_counter()
     print(f"Matrix multiplication took: {toc - tic} seconds")
-    save_sim_mat(S, save_to)
 
 def calc_prot_by_rxn_sim(args, embeddings_superdir: Path = embeddings_superdir, sim_mats_dir: Path = sim_mats_dir):
     prot_embed_path = embeddings_superdir / args.prot_embed_path
@@ -66,10 +134,11 @@ def calc_prot_by_rxn_sim(args, embeddings_superdir: Path = embeddings_superdir,
     X = load_embed_matrix(prot_embed_path, idx_sample, args.dataset, args.toc)
     X2 = load_embed_matrix(rxn_embed_path, idx_feature, args.dataset, args.toc)
     tic = perf_counter()
-    S = embedding_similarity_matrix(X, X2=X2)
+    embedding_similarity_matrix(
+        X, X2=X2, min_similarity=args.min_similarity, shard=args.shard, checkpoint_dir=tiles_dir(save_to), save_to=save_to
+    ) # Written to save_to as it is computed, shards as tiles, see merge
     toc = perf_counter()
     print(f"Matrix multiplication took: {toc - tic} seconds")
-    save_sim_mat(S, save_to) 
 
 def calc_rcmcs_sim(args, data_filepath: Path = data_fp, sim_mats_dir: Path = sim_mats_dir):
     save_to = sim_mats_dir / f"{args.dataset}_{args.toc}_rcmcs"
@@ -82,8 +151,25 @@ def calc_rcmcs_sim(args, data_filepath: Path = data_fp, sim_mats_dir: Path = sim
     rxns = load_json(data_filepath / args.dataset / f"{args.toc}.json")
     _, _, idx_feature = construct_sparse_adj_mat(data_fp / args.dataset / f"{args.toc}.csv")
 
-    S = rcmcs_similarity_matrix(rxns, rules, idx_feature)
-    save_sim_mat(S, save_to)
+    check_extend(args)
+    if args.extend: # Old matrix in whichever format it was saved, densified if sparse
+        _, _, old_idx_feature = construct_sparse_adj_mat(data_fp / args.dataset / f"{args.extend}.csv")
+        S_old = load_similarity_matrix(sim_mats_dir, args.dataset, args.extend, 'rcmcs', sparse=True)
+        if sp.issparse(S_old): # Saved w/ --min-similarity, pairs below it stay 0 but the diagonal is 1
+            S_old = S_old.toarray()
+            np.fill_diagonal(S_old, 1)
+        extend_rcmcs_similarity_matrix(S_old, old_idx_feature, rxns, rules, idx_feature, dt=np.dtype(args.dtype), save_to=save_to)
+        return
+
+    checkpoint_dir = tiles_dir(save_to)
+    with SimilarityStore(args.store) if args.store else nullcontext() as store:
+        rcmcs_similarity_matrix(
+            rxns, rules, idx_feature, dt=np.dtype(args.dtype), save_to=save_to, store=store, checkpoint_dir=checkpoint_dir,
+            min_similarity=args.min_similarity, condensed=args.condensed, shard=args.shard
+        ) # Written to save_to as it is computed, or as sparse .npz w/ min_similarity
+
+    if not args.shard: # Shards' tiles are kept for merge
+        shutil.rmtree(checkpoint_dir)
 
 def calc_mcs_sim(args, data_filepath: Path = data_fp, sim_mats_dir: Path = sim_mats_dir):
     save_to = sim_mats_dir / f"{args.dataset}_{args.toc}_mcs"
@@ -91,8 +177,15 @@ def calc_mcs_sim(args, data_filepath: Path = data_fp, sim_mats_dir: Path = sim_m
     rxns = load_json(data_filepath / args.dataset / f"{args.toc}.json")
     _, _, idx_feature = construct_sparse_adj_mat(data_fp / args.dataset / f"{args.toc}.csv")
 
-    S = mcs_similarity_matrix(rxns, idx_feature)
-    save_sim_mat(S, save_to)
+    checkpoint_dir = tiles_dir(save_to)
+    with SimilarityStore(args.store) if args.store else nullcontext() as store:
+        mcs_similarity_matrix(
+            rxns, idx_feature, dt=np.dtype(args.dtype), save_to=save_to, store=store, checkpoint_dir=checkpoint_dir,
+            min_similarity=args.min_similarity, condensed=args.condensed, shard=args.shard
+        ) # Written to save_to as it is computed, or as sparse .npz w/ min_similarity
+
+    if not args.shard: # Shards' tiles are kept for merge
+        shutil.rmtree(checkpoint_dir)
 
 def calc_tani_sim(args, data_filepath: Path = data_fp, sim_mats_dir: Path = sim_mats_dir):
     save_to = sim_mats_dir / f"{args.dataset}_{args.toc}_tanimoto"
@@ -100,8 +193,12 @@ def calc_tani_sim(args, data_filepath: Path = data_fp, sim_mats_dir: Path = sim_
     rxns = load_json(data_filepath / args.dataset / f"{args.toc}.json")
     _, _, idx_feature = construct_sparse_adj_mat(data_fp / args.dataset / f"{args.toc}.csv")
 
-    S = tanimoto_similarity_matrix(rxns, idx_feature)
-    save_sim_mat(S, save_to)
+    S = tanimoto_similarity_matrix(
+        rxns, idx_feature, dt=np.dtype(args.dtype), condensed=args.condensed, min_similarity=args.min_similarity,
+        shard=args.shard, checkpoint_dir=tiles_dir(save_to)
+    )
+    if not args.shard:
+        save_sim_mat(S, save_to)
 
 def calc_agg_mfp_cosine_sim(args, data_filepath: Path = data_fp, sim_mats_dir: Path = sim_mats_dir):
     save_to = sim_mats_dir / f"{args.dataset}_{args.toc}_agg_mfp_cosine"
@@ -109,8 +206,70 @@ def calc_agg_mfp_cosine_sim(args, data_filepath: Path = data_fp, sim_mats_dir: P
     rxns = load_json(data_filepath / args.dataset / f"{args.toc}.json")
     _, _, idx_feature = construct_sparse_adj_mat(data_fp / args.dataset / f"{args.toc}.csv")
 
-    S = agg_mfp_cosine_similarity_matrix(rxns, idx_feature)
-    save_sim_mat(S, save_to)
+    S = agg_mfp_cosine_similarity_matrix(
+        rxns, idx_feature, dt=np.dtype(args.dtype), condensed=args.condensed, min_similarity=args.min_similarity,
+        shard=args.shard, checkpoint_dir=tiles_dir(save_to)
+    )
+    if not args.shard:
+        save_sim_mat(S, save_to)
+
+def calc_sequence_chunks(args, sequences: dict[str, str], sim_metric: str, compute_chunk, sim_mats_dir: Path = sim_mats_dir):
+    '''
+    Computes the upper triangle of a sequence similarity matrix as row chunk
+    shards, each an independent job. Chunks are fixed chunk_size row ranges,
+    or w/ --balanced the same number of ranges w/ roughly equal total
+    alignment cost. The chunks are listed in a manifest the loader
+    reassembles the matrix from. --chunk runs a single chunk, e.g.,
+    one per scheduler array task, and --shard i/N chunks k w/ k % N == i
+    '''
+    n = len(sequences)
+    n_chunks = -(n // - args.chunk_size)
+    if args.balanced:
+        chunks = balanced_row_chunks([len(seq) for seq in sequences.values()], n_chunks)
+    else:
+        chunks = [(i * args.chunk_size, min((i + 1) * args.chunk_size, n)) for i in range(n_chunks)]
+
+    manifest = {
+        'n': n,
+        'ids': list(sequences.keys()),
+        'chunks': [
+            {
+                'chunk': i,
+                'start': start,
+                'end': end,
+                'n_pairs': sum(n - 1 - r for r in range(start, end)),
+                'file': f"{args.dataset}_{args.toc}_{sim_metric}_chunk_{i}_rows_{start}_{end}.npz" # Never reused for other rows
+            }
+            for i, (start, end) in enumerate(chunks)
+        ]
+    }
+    sim_mats_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = sim_mats_dir / f"{args.dataset}_{args.toc}_{sim_metric}_manifest.json"
+    # Every job writes the same manifest, each via a temporary file of its own then an atomic rename
+    with tempfile.NamedTemporaryFile('w', dir=sim_mats_dir, prefix=f"tmp_{manifest_path.stem}_", suffix=".json", delete=False) as f:
+        json.dump(manifest, f)
+
+    os.replace(f.name, manifest_path)
+
+    for entry in manifest['chunks']:
+        i = entry['chunk']
+        if args.chunk is not None and i != args.chunk:
+            continue
+        elif args.shard and i % args.shard[1] != args.shard[0]:
+            continue
+
+        save_to = sim_mats_dir / entry['file']
+        if save_to.exists(): # Finished by an earlier run w/ the same rows
+            print(f"Skipping chunk {i}, already saved")
+            continue
+
+        checkpoint_dir = tiles_dir(save_to.with_suffix(''))
+        print(f"Chunk {i}: rows [{entry['start']}, {entry['end']}), {entry['n_pairs']} pairs\n")
+        S_chunk = compute_chunk(sequences, entry['start'], entry['end'], checkpoint_dir=checkpoint_dir)
+        sp.save_npz(save_to, S_chunk)
+        shutil.rmtree(checkpoint_dir)
+
+        del S_chunk
 
 def calc_gsi(args, data_filepath: Path = data_fp, sim_mats_dir: Path = sim_mats_dir):
 
@@ -124,22 +283,14 @@ def calc_gsi(args, data_filepath: Path = data_fp, sim_mats_dir: Path = sim_mats_
         scoring="blastp"
     )
     aligner.open_gap_score = -1e6
-    n_chunks = -(len(toc) // - args.chunk_size)
-    for i in range(n_chunks):
-        sequences = {id: row["Sequence"] for id, row in toc.iterrows()}
-        start = i * args.chunk_size
-        end = (i + 1) * args.chunk_size
-        S_chunk = homology_similarity_matrix(sequences, start, end, aligner)
-        
-        save_to = sim_mats_dir / f"{args.dataset}_{args.toc}_gsi_chunk_{i}"
-        parent = save_to.parent
-        
-        if not parent.exists():
-            parent.mkdir(parents=True)
-
-        sp.save_npz(save_to, S_chunk)
-
-        del S_chunk
+    sequences = toc["Sequence"].to_dict()
+    compute_chunk = partial(
+        homology_similarity_matrix,
+        aligner=aligner,
+        min_similarity=args.min_similarity,
+        pair_bound=kmer_pair_bound(sequences, args.min_similarity, args.kmer_size) if args.kmer_prefilter else None
+    ) # k-mers indexed once for all chunks
+    calc_sequence_chunks(args, sequences, 'gsi', compute_chunk, sim_mats_dir)
 
 def calc_blosum62(args, data_filepath: Path = data_fp, sim_mats_dir: Path = sim_mats_dir):
 
@@ -154,22 +305,28 @@ def calc_blosum62(args, data_filepath: Path = data_fp, sim_mats_dir: Path = sim_
     aligner.open_gap_score = -11
     aligner.extend_gap_score = -1
 
-    n_chunks = -(len(toc) // - args.chunk_size)
-    for i in range(n_chunks):
-        sequences = {id: row["Sequence"] for id, row in toc.iterrows()}
-        start = i * args.chunk_size
-        end = (i + 1) * args.chunk_size
-        S_chunk = blosum_similarity_matrix(sequences, start, end, aligner)
-        
-        save_to = sim_mats_dir / f"{args.dataset}_{args.toc}_blosum_chunk_{i}"
-        parent = save_to.parent
-        
-        if not parent.exists():
-            parent.mkdir(parents=True)
-
-        sp.save_npz(save_to, S_chunk)
-
-        del S_chunk
+    compute_chunk = partial(blosum_similarity_matrix, aligner=aligner, min_similarity=args.min_similarity)
+    calc_sequence_chunks(args, toc["Sequence"].to_dict(), 'blosum', compute_chunk, sim_mats_dir)
+
+def merge_shards(args, sim_mats_dir: Path = sim_mats_dir):
+    '''
+    Assembles a matrix computed w/ --shard once all shards are done: from
+    its tiles, which are then removed, or for gsi / blosum, from the chunks
+    in its manifest. Raises if any tile or chunk is missing
+    '''
+    save_to = sim_mats_dir / f"{args.dataset}_{args.toc}_{args.name}"
+    manifest_path = sim_mats_dir / f"{args.dataset}_{args.toc}_{args.name}_manifest.json"
+    if tiles_dir(save_to).exists():
+        assemble_similarity_tiles(tiles_dir(save_to), output=args.output, save_to=save_to)
+        shutil.rmtree(tiles_dir(save_to))
+    elif manifest_path.exists():
+        S = load_similarity_matrix(sim_mats_dir, args.dataset, args.toc, args.name, sparse=args.output == 'sparse')
+        if args.output == 'condensed':
+            S = CondensedSimilarityMatrix.from_dense(S)
+
+        save_sim_mat(S, save_to)
+    else:
+        raise FileNotFoundError(f"Found neither {tiles_dir(save_to)} nor {manifest_path}")
 
 parser = ArgumentParser(description="Simlarity matrix calculator")
 subparsers = parser.add_subparsers(title="Commands", description="Available comands")
@@ -179,6 +336,9 @@ parser_rxn_embed = subparsers.add_parser("rxn-embed", help="Calculate reaction e
 parser_rxn_embed.add_argument("dataset", help="Dataset name, e.g., 'sprhea'")
 parser_rxn_embed.add_argument("toc", help="TOC name, e.g., 'v3_folded_pt_ns'")
 parser_rxn_embed.add_argument("embed_path", help="Embedding path relative to embeddings super dir")
+parser_rxn_embed.add_argument("--extend", help="TOC name of a previously computed matrix to extend w/ new reactions")
+parser_rxn_embed.add_argument("--min-similarity", type=float, help="Keep only entries >= this and save a sparse matrix")
+parser_rxn_embed.add_argument("--shard", type=parse_shard, help="Only compute this shard i/N of the job's tiles, then run merge once all shards are done")
 parser_rxn_embed.set_defaults(func=calc_rxn_embed_sim)
 
 # Protein embedding similarity
@@ -186,6 +346,9 @@ parser_prot_embed = subparsers.add_parser("prot-embed", help="Calculate protein
 parser_prot_embed.add_argument("dataset", help="Dataset name, e.g., 'sprhea'")
 parser_prot_embed.add_argument("toc", help="TOC name, e.g., 'v3_folded_pt_ns'")
 parser_prot_embed.add_argument("embed_path", help="Embedding path relative to embeddings super dir")
+parser_prot_embed.add_argument("--extend", help="TOC name of a previously computed matrix to extend w/ new proteins")
+parser_prot_embed.add_argument("--min-similarity", type=float, help="Keep only entries >= this and save a sparse matrix")
+parser_prot_embed.add_argument("--shard", type=parse_shard, help="Only compute this shard i/N of the job's tiles, then run merge once all shards are done")
 parser_prot_embed.set_defaults(func=calc_prot_embed_sim)
 
 # Protein by reaction embedding similarity
@@ -194,24 +357,41 @@ parser_prot_rxn_embed.add_argument("dataset", help="Dataset name, e.g., 'sprhea'
 parser_prot_rxn_embed.add_argument("toc", help="TOC name, e.g., 'v3_folded_pt_ns'")
 parser_prot_rxn_embed.add_argument("prot_embed_path", help="Protein embedding path relative to embeddings super dir")
 parser_prot_rxn_embed.add_argument("rxn_embed_path", help="Reaction embedding path relative to embeddings super dir")
+parser_prot_rxn_embed.add_argument("--min-similarity", type=float, help="Keep only entries >= this and save a sparse matrix")
+parser_prot_rxn_embed.add_argument("--shard", type=parse_shard, help="Only compute this shard i/N of the job's tiles, then run merge once all shards are done")
 parser_prot_rxn_embed.set_defaults(func=calc_prot_by_rxn_sim)
 
 # RCMCS similarity
 parser_rcmcs = subparsers.add_parser("rcmcs", help="Calculate RCMCS similarity")
 parser_rcmcs.add_argument("dataset", help="Dataset name, e.g., 'sprhea'")
 parser_rcmcs.add_argument("toc", help="TOC name, e.g., 'v3_folded_pt_ns'")
+parser_rcmcs.add_argument("--store", type=Path, help="SQLite store of previously computed pair scores to reuse and extend")
+parser_rcmcs.add_argument("--extend", help="TOC name of a previously computed matrix to extend w/ new reactions")
+parser_rcmcs.add_argument("--min-similarity", type=float, help="Skip pairs that provably score below this and save a sparse matrix")
+parser_rcmcs.add_argument("--condensed", action="store_true", help="Save only the upper triangle, see CondensedSimilarityMatrix")
+parser_rcmcs.add_argument("--dtype", default="float32", choices=["float16", "float32"], help="Similarity dtype")
+parser_rcmcs.add_argument("--shard", type=parse_shard, help="Only compute this shard i/N of the job's tiles, then run merge once all shards are done")
 parser_rcmcs.set_defaults(func=calc_rcmcs_sim)
 
 # MCS similarity
 parser_mcs = subparsers.add_parser("mcs", help="Calculate MCS similarity")
 parser_mcs.add_argument("dataset", help="Dataset name, e.g., 'sprhea'")
 parser_mcs.add_argument("toc", help="TOC name, e.g., 'v3_folded_pt_ns'")
+parser_mcs.add_argument("--store", type=Path, help="SQLite store of previously computed pair scores to reuse and extend")
+parser_mcs.add_argument("--min-similarity", type=float, help="Skip pairs that provably score below this and save a sparse matrix")
+parser_mcs.add_argument("--condensed", action="store_true", help="Save only the upper triangle, see CondensedSimilarityMatrix")
+parser_mcs.add_argument("--dtype", default="float32", choices=["float16", "float32"], help="Similarity dtype")
+parser_mcs.add_argument("--shard", type=parse_shard, help="Only compute this shard i/N of the job's tiles, then run merge once all shards are done")
 parser_mcs.set_defaults(func=calc_mcs_sim)
 
 # Tanimoto similarity
 parser_tanimoto = subparsers.add_parser("tanimoto", help="Calculate substrate-aligned Tanimoto similarity")
 parser_tanimoto.add_argument("dataset", help="Dataset name, e.g., 'sprhea'")
 parser_tanimoto.add_argument("toc", help="TOC name, e.g., 'v3_folded_pt_ns'")
+parser_tanimoto.add_argument("--condensed", action="store_true", help="Save only the upper triangle, see CondensedSimilarityMatrix")
+parser_tanimoto.add_argument("--dtype", default="float32", choices=["float16", "float32"], help="Similarity dtype")
+parser_tanimoto.add_argument("--min-similarity", type=float, help="Keep only entries >= this and save a sparse matrix")
+parser_tanimoto.add_argument("--shard", type=parse_shard, help="Only compute this shard i/N of the job's tiles, then run merge once all shards are done")
 parser_tanimoto.set_defaults(func=calc_tani_sim)
 
 # Global sequence identity
@@ -219,6 +399,12 @@ parser_gsi = subparsers.add_parser("gsi", help="Calculate global sequence identi
 parser_gsi.add_argument("dataset", help="Dataset name, e.g., 'sprhea'")
 parser_gsi.add_argument("toc", help="TOC name, e.g., 'v3_folded_pt_ns'")
 parser_gsi.add_argument("chunk_size", type=int, help="Breaks up rows of sim mat")
+parser_gsi.add_argument("--balanced", action="store_true", help="Split rows into chunks of equal estimated cost instead of chunk_size rows")
+parser_gsi.add_argument("--chunk", type=int, help="Only compute this chunk, e.g., a scheduler array task id")
+parser_gsi.add_argument("--min-similarity", type=float, help="Keep only entries >= this and save a sparse matrix")
+parser_gsi.add_argument("--kmer-prefilter", action="store_true", help="Skip aligning pairs whose shared k-mers bound identity below --min-similarity")
+parser_gsi.add_argument("--kmer-size", type=int, help="k-mer length for --kmer-prefilter, chosen from --min-similarity by default")
+parser_gsi.add_argument("--shard", type=parse_shard, help="Only compute this shard i/N of the job's tiles, then run merge once all shards are done")
 parser_gsi.set_defaults(func=calc_gsi)
 
 # BLOSUM62 sequence similarity
@@ -226,14 +412,30 @@ parser_blosum = subparsers.add_parser("blosum", help="Calculate BLOSUM62 sequenc
 parser_blosum.add_argument("dataset", help="Dataset name, e.g., 'sprhea'")
 parser_blosum.add_argument("toc", help="TOC name, e.g., 'v3_folded_pt_ns'")
 parser_blosum.add_argument("chunk_size", type=int, help="Breaks up rows of sim mat")
+parser_blosum.add_argument("--balanced", action="store_true", help="Split rows into chunks of equal estimated cost instead of chunk_size rows")
+parser_blosum.add_argument("--chunk", type=int, help="Only compute this chunk, e.g., a scheduler array task id")
+parser_blosum.add_argument("--min-similarity", type=float, help="Keep only entries >= this and save a sparse matrix")
+parser_blosum.add_argument("--shard", type=parse_shard, help="Only compute this shard i/N of the job's tiles, then run merge once all shards are done")
 parser_blosum.set_defaults(func=calc_blosum62)
 
 # Agg mfp cosine similarity
 parser_agg_mfp_cosine = subparsers.add_parser("agg-mfp-cosine", help="Calculate cosine similarity of aggregated Morgan FPs")
 parser_agg_mfp_cosine.add_argument("dataset", help="Dataset name, e.g., 'sprhea'")
 parser_agg_mfp_cosine.add_argument("toc", help="TOC name, e.g., 'v3_folded_pt_ns'")
+parser_agg_mfp_cosine.add_argument("--condensed", action="store_true", help="Save only the upper triangle, see CondensedSimilarityMatrix")
+parser_agg_mfp_cosine.add_argument("--dtype", default="float32", choices=["float16", "float32"], help="Similarity dtype")
+parser_agg_mfp_cosine.add_argument("--min-similarity", type=float, help="Keep only entries >= this and save a sparse matrix")
+parser_agg_mfp_cosine.add_argument("--shard", type=parse_shard, help="Only compute this shard i/N of the job's tiles, then run merge once all shards are done")
 parser_agg_mfp_cosine.set_defaults(func=calc_agg_mfp_cosine_sim)
 
+# Merge shards
+parser_merge = subparsers.add_parser("merge", help="Assemble a matrix computed w/ --shard")
+parser_merge.add_argument("dataset", help="Dataset name, e.g., 'sprhea'")
+parser_merge.add_argument("toc", help="TOC name, e.g., 'v3_folded_pt_ns'")
+parser_merge.add_argument("name", help="Matrix name as in its file name, e.g., 'rcmcs' or 'gsi'")
+parser_merge.add_argument("--output", choices=["dense", "condensed", "sparse"], help="Defaults to sparse for tiles computed w/ --min-similarity, else dense")
+parser_merge.set_defaults(func=merge_shards)
+
 def main():
     args = parser.parse_args()
     args.func(args)
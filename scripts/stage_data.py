@@ -1,7 +1,7 @@
 import hydra
 from omegaconf import DictConfig
 from src.utils import construct_sparse_adj_mat, load_json, load_embed
-from src.cross_validation import stratified_sim_split, random_split, sample_negatives
+from src.cross_validation import stratified_sim_split, random_split, sample_negatives, is_reaction_split
 
 import numpy as np
 import pandas as pd
@@ -85,7 +85,7 @@ def main(cfg: DictConfig):
             n_inner_splits=cfg.data.n_splits,
             test_percent=cfg.data.test_percent,
             cluster_dir=Path(cfg.filepaths.clustering),
-            adj_mat_idx_to_id=idx_feature if cfg.data.split_strategy == 'rcmcs' else idx_sample,
+            adj_mat_idx_to_id=idx_feature if is_reaction_split(cfg.data.split_strategy) else idx_sample,
             dataset=cfg.data.dataset,
             toc=cfg.data.toc,
             rng=rng
@@ -0,0 +1,193 @@
+'''
+Single linkage clustering from a minimum spanning tree of distances D = 1 - S,
+built once and cut at any number of distance cutoffs. The tree is the whole
+hierarchy, so it is saved once and clusters at new cutoffs are read off it
+'''
+from typing import Iterable, Callable
+from pathlib import Path
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components, minimum_spanning_tree
+from tqdm import tqdm
+from src.condensed_matrix import CondensedSimilarityMatrix
+
+def minimum_spanning_edges(S) -> tuple[np.ndarray]:
+    '''
+    Minimum spanning forest of the distances D = 1 - S, computed in S's dtype
+    as for AgglomerativeClustering(metric='precomputed') on 1 - S, which also
+    only reads the upper triangle, e.g., all that the gsi / blosum loaders fill.
+    Dense and condensed S are read a row at a time (Prim), sparse S is a graph
+    whose missing entries are 0 similarity and never merge (Kruskal)
+
+    Args
+    ----
+    S:np.ndarray | CondensedSimilarityMatrix | scipy.sparse.sparray
+        nxn similarity matrix, possibly memory-mapped
+
+    Returns
+    -------
+    i, j:np.ndarray
+        Edge endpoints
+    d:np.ndarray
+        Edge distances, float64
+    '''
+    if sp.issparse(S):
+        return _sparse_minimum_spanning_edges(S)
+
+    n = S.shape[0]
+    if isinstance(S, CondensedSimilarityMatrix):
+        row = S.row
+    else: # Upper triangle mirrored: column v left of the diagonal, row v right of it
+        row = lambda v: np.concatenate([np.asarray(S[:v, v]), np.asarray(S[v, v:])])
+    in_tree = np.zeros(shape=(n,), dtype=bool)
+    best = np.full(shape=(n,), fill_value=np.inf) # Distance from each node to the tree
+    parent = np.zeros(shape=(n,), dtype=np.int64)
+    i, j, d = (np.empty(shape=(max(n - 1, 0),), dtype=dt) for dt in (np.int64, np.int64, np.float64))
+    v = 0
+    for k in tqdm(range(n - 1)):
+        in_tree[v] = True
+        best[v] = np.inf
+        dv = (1 - row(v)).astype(np.float64)
+        closer = (dv < best) & ~in_tree
+        best[closer] = dv[closer]
+        parent[closer] = v
+        v = int(np.argmin(best))
+        i[k], j[k], d[k] = parent[v], v, best[v]
+
+    return i, j, d
+
+def streamed_minimum_spanning_edges(chunks: Iterable[sp.sparray], n: int, transform: Callable = None) -> tuple[np.ndarray]:
+    '''
+    Minimum spanning forest of a similarity matrix stored as sparse shards,
+    e.g., the gsi / blosum row chunks, loading one shard at a time. As the
+    minimum spanning forest of a union of graphs is that of one's forest
+    and the other, each shard is merged into the forest so far and memory
+    is bounded by n plus one shard. Neither S nor D is ever materialized
+
+    Args
+    ----
+    chunks:Iterable[scipy.sparse.sparray]
+        nxn or row-offset shards of S, e.g., from similarity_chunks.
+        Unstored entries, 0 similarities and the diagonal never merge
+    n:int
+        Number of items
+    transform:Callable
+        If provided, maps all of a shard's stored values to similarities,
+        e.g., to normalize raw blosum scores
+
+    Returns
+    -------
+    i, j, d:np.ndarray
+        See minimum_spanning_edges
+    '''
+    i, j, d = np.zeros(shape=(0,), dtype=np.int64), np.zeros(shape=(0,), dtype=np.int64), np.zeros(shape=(0,))
+    for chunk in tqdm(chunks):
+        chunk = sp.coo_array(chunk)
+        off = chunk.row != chunk.col
+        values = chunk.data[off].astype(np.float32) # As loaded by load_similarity_matrix
+        if transform is not None: # Every stored value, e.g., raw blosum scores of 0
+            values = transform(values).astype(np.float32)
+
+        keep = values != 0 # 0 similarity never merges, stored or not
+        rows, cols = chunk.row[off][keep], chunk.col[off][keep]
+        i, j, d = _minimum_spanning_forest(
+            n,
+            np.concatenate([i, np.minimum(rows, cols)]),
+            np.concatenate([j, np.maximum(rows, cols)]),
+            np.concatenate([d, (1 - values[keep]).astype(np.float64)])
+        )
+
+    return i, j, d
+
+def _sparse_minimum_spanning_edges(S: sp.sparray) -> tuple[np.ndarray]:
+    S = sp.coo_array(S)
+    upper = (S.row < S.col) & (S.data != 0) # Stored 0 similarities never merge either
+    return _minimum_spanning_forest(S.shape[0], S.row[upper], S.col[upper], (1 - S.data[upper]).astype(np.float64))
+
+def _minimum_spanning_forest(n: int, i: np.ndarray, j: np.ndarray, d: np.ndarray) -> tuple[np.ndarray]:
+    '''
+    Minimum spanning forest of the graph w/ edges (i, j) of distance d, i < j
+    '''
+    # csgraph drops 0 weights, so identical items get the smallest positive weight instead
+    tiny = np.finfo(np.float64).smallest_subnormal
+    w = np.where(d == 0, tiny, d)
+    graph = sp.csr_array((w, (i.astype(np.int32), j.astype(np.int32))), shape=(n, n)) # csgraph's index type
+    mst = minimum_spanning_tree(graph).tocoo()
+    mst_i, mst_j = np.minimum(mst.row, mst.col), np.maximum(mst.row, mst.col)
+    return mst_i.astype(np.int64), mst_j.astype(np.int64), np.where(mst.data == tiny, 0, mst.data)
+
+def mst_labels(n: int, edges: tuple[np.ndarray], d_cutoff: float) -> np.ndarray:
+    '''
+    Single linkage clusters at d_cutoff: the connected components of the
+    spanning edges w/ distance < d_cutoff. Clusters are numbered in order
+    of their lowest index member
+
+    Args
+    ----
+    n:int
+        Number of items
+    edges:tuple[np.ndarray]
+        (i, j, d) from minimum_spanning_edges
+    d_cutoff:float
+        Items closer than this are merged
+
+    Returns
+    -------
+    labels:np.ndarray
+    '''
+    i, j, d = edges
+    close = d < d_cutoff
+    graph = sp.csr_array((np.ones(shape=(close.sum(),)), (i[close], j[close])), shape=(n, n))
+    _, labels = connected_components(graph, directed=False)
+    return labels
+
+def save_hierarchy(path: Path, edges: tuple[np.ndarray], ids: list[str]):
+    '''
+    Saves the single linkage hierarchy as its spanning edges (.npz)
+
+    Args
+    ----
+    path:Path
+    edges:tuple[np.ndarray]
+        (i, j, d) from minimum_spanning_edges
+    ids:list[str]
+        Id of each matrix index, e.g., reaction / protein ids
+    '''
+    i, j, d = edges
+    np.savez_compressed(path, i=i.astype(np.int32), j=j.astype(np.int32), d=d, ids=np.array(ids, dtype=str))
+
+def load_hierarchy(path: Path) -> tuple[tuple[np.ndarray], list[str]]:
+    '''
+    Returns
+    -------
+    edges:tuple[np.ndarray]
+        (i, j, d) spanning edges
+    ids:list[str]
+        Id of each matrix index
+    '''
+    with np.load(path) as hierarchy:
+        return (hierarchy['i'], hierarchy['j'], hierarchy['d']), hierarchy['ids'].tolist()
+
+def hierarchy_clusters(hierarchy: tuple[tuple[np.ndarray], list[str]], cutoffs: float | list[float]) -> dict:
+    '''
+    Single linkage clusters at any similarity cutoff(s), in linear time per
+    cutoff, in the format of the cluster JSONs scripts/cluster.py saves
+
+    Args
+    ----
+    hierarchy:tuple
+        (edges, ids) from load_hierarchy
+    cutoffs:float | list[float]
+        Similarity cutoff(s) in percent, e.g., 80 clusters items w/ D < 0.2
+
+    Returns
+    -------
+    id2cluster:dict
+        {id: cluster} for a single cutoff, {cutoff: {id: cluster}} for a list
+    '''
+    edges, ids = hierarchy
+    if np.ndim(cutoffs) > 0:
+        return {cutoff: hierarchy_clusters(hierarchy, cutoff) for cutoff in cutoffs}
+
+    labels = mst_labels(len(ids), edges, 1 - (cutoffs / 100))
+    return {id : int(label) for id, label in zip(ids, labels)}
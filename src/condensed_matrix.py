@@ -0,0 +1,184 @@
+'''
+Condensed storage of symmetric similarity matrices: only the n(n-1)/2
+values above the diagonal are kept, in scipy's squareform order
+'''
+import numpy as np
+from pathlib import Path
+
+def condensed_index(i: np.ndarray, j: np.ndarray, n: int) -> np.ndarray:
+    '''
+    Position of entry (i, j), i != j, of an nxn symmetric matrix in its condensed form
+    '''
+    i, j = np.minimum(i, j), np.maximum(i, j)
+    return n * i - i * (i + 1) // 2 + j - i - 1
+
+def condensed_size(n: int) -> int:
+    return n * (n - 1) // 2
+
+class CondensedSimilarityMatrix:
+    '''
+    Symmetric nxn matrix backed by its condensed upper triangle, e.g., a
+    memory-mapped 1D .npy file. Supports the row, block and pairwise
+    indexing the similarity code needs and behaves like a read-only
+    2D array otherwise (np.asarray densifies).
+
+    1 - S gives the distance view, which shares S's values and
+    transforms them on access instead of copying.
+
+    Args
+    ----
+    values:np.ndarray
+        Condensed upper triangle, length n(n-1)/2
+    scale, shift:float
+        Entries read as shift + scale * value, diagonal as shift + scale
+    '''
+    def __init__(self, values: np.ndarray, scale: float = 1.0, shift: float = 0.0):
+        self.values = values
+        self.n = int(round((1 + np.sqrt(1 + 8 * len(values))) / 2))
+        if condensed_size(self.n) != len(values):
+            raise ValueError(f"{len(values)} values do not form a condensed matrix")
+
+        self.scale = scale
+        self.shift = shift
+
+    @classmethod
+    def empty(cls, n: int, dtype: np.dtype = np.float32, path: Path = None):
+        '''
+        Zero-filled matrix, memory-mapped to path (.npy) if provided
+        '''
+        if path is not None:
+            values = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(condensed_size(n),))
+            values[:] = 0
+        else:
+            values = np.zeros(shape=(condensed_size(n),), dtype=dtype)
+
+        return cls(values)
+
+    @classmethod
+    def from_dense(cls, S: np.ndarray, dtype: np.dtype = None, block_size: int = 4096):
+        '''
+        Condenses the upper triangle of a dense symmetric S
+        '''
+        n = S.shape[0]
+        values = np.empty(shape=(condensed_size(n),), dtype=dtype or S.dtype)
+        for start in range(0, n, block_size):
+            rows = np.asarray(S[start:start + block_size])
+            for r, i in enumerate(range(start, start + len(rows))):
+                offset = condensed_index(i, i + 1, n)
+                values[offset:offset + n - i - 1] = rows[r, i + 1:]
+
+        return cls(values)
+
+    @classmethod
+    def load(cls, path: Path, mmap_mode: str = 'r'):
+        return cls(np.load(path, mmap_mode=mmap_mode))
+
+    def save(self, path: Path):
+        '''
+        Saves values as read through this view, e.g., distances for 1 - S
+        '''
+        np.save(path, self.condensed())
+
+    @property
+    def shape(self) -> tuple[int]:
+        return (self.n, self.n)
+
+    @property
+    def ndim(self) -> int:
+        return 2
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.values.dtype
+
+    @property
+    def diagonal_value(self) -> float:
+        return self.shift + self.scale
+
+    def condensed(self) -> np.ndarray:
+        '''
+        Condensed values as read through this view,
+        e.g., for scipy.cluster.hierarchy.linkage
+        '''
+        if self.scale == 1 and self.shift == 0:
+            return np.asarray(self.values)
+
+        return self._transform(self.values)
+
+    def set_pairs(self, i: np.ndarray, j: np.ndarray, values: np.ndarray):
+        '''
+        Sets S[i, j] = S[j, i] = values for i != j
+        '''
+        if self.scale != 1 or self.shift != 0:
+            raise ValueError("Cannot write through a transformed view")
+
+        self.values[condensed_index(np.asarray(i), np.asarray(j), self.n)] = values
+
+    def row(self, i: int) -> np.ndarray:
+        '''
+        Dense S[i], from one gather for the entries left of the
+        diagonal and one contiguous slice for those right of it
+        '''
+        n = self.n
+        row = np.empty(shape=(n,), dtype=self.dtype)
+        k = np.arange(i)
+        row[:i] = self._transform(self.values[condensed_index(k, i, n)])
+        row[i] = self.diagonal_value
+        offset = n * i - i * (i + 1) // 2
+        row[i + 1:] = self._transform(self.values[offset:offset + n - i - 1])
+        return row
+
+    def block(self, rows: np.ndarray, cols: np.ndarray) -> np.ndarray:
+        '''
+        Dense S[np.ix_(rows, cols)]
+        '''
+        cols = np.asarray(cols)
+        block = np.empty(shape=(len(rows), len(cols)), dtype=self.dtype)
+        for r, i in enumerate(rows):
+            block[r] = self.row(int(i))[cols]
+
+        return block
+
+    def pairs(self, i: np.ndarray, j: np.ndarray) -> np.ndarray:
+        '''
+        S[i, j] for broadcast index arrays i, j
+        '''
+        i, j = np.broadcast_arrays(np.asarray(i), np.asarray(j))
+        out = np.full(shape=i.shape, fill_value=self.diagonal_value, dtype=self.dtype)
+        off = i != j
+        out[off] = self._transform(self.values[condensed_index(i[off], j[off], self.n)])
+        return out
+
+    def to_dense(self, dtype: np.dtype = None) -> np.ndarray:
+        return self.block(np.arange(self.n), np.arange(self.n)).astype(dtype or self.dtype, copy=False)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+
+        rows, cols = (np.arange(self.n)[k] if isinstance(k, slice) else k for k in key)
+        if np.ndim(rows) == 0 and np.ndim(cols) == 0:
+            return self.pairs(rows, cols)[()]
+        elif np.ndim(rows) == 0:
+            return self.block([rows], cols)[0]
+        elif np.ndim(cols) == 0:
+            return self.block(rows, [cols])[:, 0]
+        elif isinstance(key[0], slice) or isinstance(key[1], slice):
+            return self.block(rows, cols)
+
+        return self.pairs(rows, cols) # Pairwise, like numpy fancy indexing
+
+    def __rsub__(self, other: float):
+        return CondensedSimilarityMatrix(self.values, scale=-self.scale, shift=other - self.shift)
+
+    def __array__(self, dtype=None, copy=None):
+        return self.to_dense(dtype)
+
+    def __len__(self) -> int:
+        return self.n
+
+    def _transform(self, values: np.ndarray) -> np.ndarray:
+        if self.scale == 1 and self.shift == 0:
+            return values
+
+        return (self.shift + self.scale * values).astype(self.dtype, copy=False)
@@ -1,4 +1,5 @@
 from src.utils import load_json
+from src.clustering import load_hierarchy, hierarchy_clusters
 import numpy as np
 from sklearn.model_selection import KFold, train_test_split
 from collections import defaultdict
@@ -86,6 +87,14 @@ def random_split(
 
     return train_val_splits, test
 
+def is_reaction_split(split_strategy: str) -> bool:
+    '''
+    Whether a split strategy's clusters are of reactions, i.e., rcmcs / mcs
+    clusters, single linkage or leader (suffix '_leader', see scripts/cluster.py),
+    rather than of proteins
+    '''
+    return split_strategy.removesuffix('_leader') in ('rcmcs', 'mcs')
+
 def stratified_sim_split(
         X: np.ndarray,
         y: np.ndarray,
@@ -110,7 +119,8 @@ def stratified_sim_split(
     y:np.ndarray
         Labels
     split_strategy:str
-        'rcmcs' or 'homology'
+        'homology', another protein similarity, e.g., 'blosum', or a reaction
+        similarity, e.g., 'rcmcs' or w/ leader clusters 'rcmcs_leader', see is_reaction_split
     split_bounds:list[int]
         List of similarity upper bounds
     n_inner_splits:int
@@ -118,7 +128,8 @@ def stratified_sim_split(
     test_percent:int
         Percentage of data to hold out for testing
     cluster_dir:Path
-        Directory containing clustering results
+        Directory containing clustering results: cd-hit .clstr files for
+        homology, otherwise a saved hierarchy or one JSON per bound
     adj_mat_idx_to_id:dict
         Maps adj mat indices to reaction / protein ids
     dataset:str
@@ -165,11 +176,15 @@ def stratified_sim_split(
     # Maps reaction or protein matrix index to pair index in X
     single2pair_idx = defaultdict(list) 
     for i, pair in enumerate(X):
-        if split_strategy == 'rcmcs':
+        if is_reaction_split(split_strategy):
             single2pair_idx[pair[1]].append(i) # Orient to rxn matrix idx
-        elif split_strategy == 'homology':
+        else:
             single2pair_idx[pair[0]].append(i) # Orient to prot matrix idx
 
+    # Cut levels from the saved single linkage hierarchy if there is one, see scripts/cluster.py
+    hierarchy_path = cluster_dir / f"{dataset}_{toc}_{split_strategy}_hierarchy.npz"
+    hierarchy = load_hierarchy(hierarchy_path) if split_strategy != 'homology' and hierarchy_path.exists() else None
+
     # Assemble level clusters matrix
     level_clusters = np.zeros(shape=(len(X), len(split_bounds))) - 1 # (# pairs x # levels of clustering) cols contain jth level cluster idxs
     idxs, cluster_numbers = [], []
@@ -180,6 +195,8 @@ def stratified_sim_split(
             cluster_path = cluster_dir / f"{dataset}_{toc}_{split_strategy}_{bound}.clstr"
             clusters = parse_cd_hit_clusters(cluster_path)
             point_to_cluster = {id: cid for cid, ids in clusters.items() for id in ids}
+        elif hierarchy is not None:
+            point_to_cluster = hierarchy_clusters(hierarchy, bound)
         else:
             cluster_path = cluster_dir / f"{dataset}_{toc}_{split_strategy}_{bound}.json"
             point_to_cluster = load_json(cluster_path)
@@ -2,34 +2,164 @@
 Libary of similarity functions, clustering support functions etc.
 '''
 import re
-from itertools import chain
+import json
+from itertools import chain, islice, repeat, count
+from collections import defaultdict, Counter
+from queue import SimpleQueue
+from time import perf_counter
+from functools import lru_cache, partial
+from contextlib import nullcontext
 from rdkit import Chem
 from rdkit.Chem import rdFMCS, Mol, AllChem
-from typing import Iterable, Dict
+from typing import Iterable, Dict, Callable
 import numpy as np
 import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
 import pandas as pd
 import multiprocessing as mp
 from tqdm import tqdm
 from Bio import Align
 from pathlib import Path
+from tempfile import TemporaryDirectory
+from src.similarity_store import SimilarityStore, content_hash
+from src.similarity_checkpoint import TileCheckpoint
+from src.condensed_matrix import CondensedSimilarityMatrix, condensed_index
 
-def embedding_similarity_matrix(X: np.ndarray, X2: np.ndarray = None, dt: np.dtype = np.float32):
+_worker_state = {} # Per-process inputs of similarity pool workers, see _init_similarity_worker
+
+def embedding_similarity_matrix(
+        X: np.ndarray, X2: np.ndarray = None, dt: np.dtype = np.float32, min_similarity: float = None, tile_entries: int = 2**24,
+        shard: tuple[int] = None, checkpoint_dir: Path = None, save_to: Path = None
+    ):
     '''
-    Multiplies X X.T or X X2.T and saves result
+    Computes sigmoid(X X.T) or sigmoid(X X2.T) a row tile at a time, so peak
+    memory is bounded by the tile rather than several nxn temporaries
+
+    Args
+    ----
+    X, X2:np.ndarray
+        Embeddings of the rows' and, if provided, the columns' items
+    dt:np.dtype
+        Output dtype
+    min_similarity:float
+        If provided, only entries >= min_similarity are kept in a csr_array
+    tile_entries:int
+        About how many entries of S are computed at once
+    shard:tuple[int]
+        (i, N) to only compute that shard's row tiles into
+        checkpoint_dir, see sharded_similarity_tiles
+    checkpoint_dir:Path
+        Where shards save their row tiles
+    save_to:Path
+        If provided, dense S is written straight to this .npy file and returned
+        memory-mapped. Sparse S is saved to it as .npz
+
+    Returns
+    -------
+    S:np.ndarray | scipy.sparse.csr_array
+        None w/ shard
     '''
-    if X2 is not None:
-        S = np.matmul(X, X2.T)
+    symmetric = X2 is None
+    X2 = X if X2 is None else X2
+    tiles = row_tiles(X.shape[0], X2.shape[0], tile_entries)
+    if shard is not None:
+        def score_rows(rows):
+            start, end = rows
+            col_start = start if symmetric else 0 # Upper triangle incl. the diagonal, which is not 1
+            block = sigmoid(np.matmul(X[start:end], X2[col_start:].T))
+            return block_entries(block, start, col_start, min_offset=0 if symmetric else None)
+
+        meta = {
+            'scorer': 'embedding', 'shape': [X.shape[0], X2.shape[0]], 'dtype': np.dtype(dt).str,
+            'symmetric': symmetric, 'unit_diagonal': False, 'tile_size': tiles[0][1] if tiles else 0
+        }
+        sharded_similarity_tiles(score_rows, tiles, shard, checkpoint_dir, meta, min_similarity, n_tiles=len(tiles))
+        return
+
+    if min_similarity is not None:
+        blocks = []
+        for start, end in tiles:
+            block = sigmoid(np.matmul(X[start:end], X2.T))
+            r, c = np.nonzero(block >= min_similarity)
+            blocks.append(sp.csr_array((block[r, c].astype(dt), (r, c)), shape=block.shape))
+
+        S = sp.vstack(blocks, format='csr').astype(dt) if blocks else sp.csr_array((0, X2.shape[0]), dtype=dt)
+        if save_to is not None:
+            Path(save_to).parent.mkdir(parents=True, exist_ok=True)
+            sp.save_npz(save_to, S)
+
+        return S
+
+    shape = (X.shape[0], X2.shape[0])
+    if save_to is not None:
+        path = _npy_path(save_to)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        S = np.lib.format.open_memmap(path, mode='w+', dtype=dt, shape=shape)
     else:
-        S = np.matmul(X, X.T)
+        S = np.empty(shape=shape, dtype=dt)
 
-    S = 1 / (1 + np.exp(-S))  
-    return S.astype(dt)
+    for start, end in tiles:
+        S[start:end] = sigmoid(np.matmul(X[start:end], X2.T))
 
-def tanimoto_similarity_matrix(rxns:dict[str, dict], matrix_idx_to_rxn_id: dict[int, str], dt: np.dtype = np.float32):
+    _flush(S)
+    return S
+
+def sigmoid(z: np.ndarray) -> np.ndarray:
+    '''
+    Logistic function computed in place in floating point z w/o overflow:
+    exp is only taken of -|z|, and 1 / (1 + e) or e / (1 + e) picked by sign
+    '''
+    negative = z < 0
+    np.abs(z, out=z)
+    np.negative(z, out=z)
+    np.exp(z, out=z)
+    r = 1 / (1 + z)
+    np.multiply(z, r, out=z, where=negative)
+    np.copyto(z, r, where=~negative)
+    return z
+
+def extend_embedding_similarity_matrix(S_old: np.ndarray, old_idx_to_id: dict[int, str], X: np.ndarray, matrix_idx_to_id: dict[int, str], dt: np.dtype = np.float32):
+    '''
+    Grows a saved embedding_similarity_matrix to a new, larger set of items,
+    computing only rows / cols of items not in the old matrix
+
+    Args
+    ----
+    S_old:np.ndarray
+        Previously computed nxn similarity matrix
+    old_idx_to_id:dict
+        Maps S_old indices to ids
+    X:np.ndarray
+        Embedding matrix of the full set, rows indexed by matrix_idx_to_id
+    matrix_idx_to_id:dict
+        Maps new similarity matrix / embed matrix indices to ids, e.g.,
+        from construct_sparse_adj_mat on the new toc
+
+    Returns
+    -------
+    S:np.ndarray
+        (n+m)x(n+m) similarity matrix indexed by matrix_idx_to_id
+    '''
+    S = np.eye(N=len(matrix_idx_to_id), dtype=dt)
+    new_idxs = place_similarity_matrix(S, S_old, old_idx_to_id, matrix_idx_to_id)
+    print(f"Computing similarities of {len(new_idxs)} new items")
+    if len(new_idxs) > 0:
+        S_new = sigmoid(np.matmul(X, X[new_idxs].T))
+        S[:, new_idxs] = S_new
+        S[new_idxs, :] = S_new.T
+
+    return S
+
+def tanimoto_similarity_matrix(
+        rxns:dict[str, dict], matrix_idx_to_rxn_id: dict[int, str], dt: np.dtype = np.float32, norm: str = 'max', analyze_sides: str = 'both',
+        batch_size: int = 2**16, condensed: bool = False, min_similarity: float = None, shard: tuple[int] = None,
+        checkpoint_dir: Path = None
+    ):
     '''
     Computes aligned-substrates-tanimoto-similarity 
-    similarity matrix for set of reactions
+    similarity matrix for set of reactions. Each reaction's
+    molecules are parsed and fingerprinted once up front and
+    rule-compatible pairs are then scored in bulk.
 
     Args
     ----
@@ -38,52 +168,87 @@ def tanimoto_similarity_matrix(rxns:dict[str, dict], matrix_idx_to_rxn_id: dict[
         in each reaction_idx indexed sub-dict
     matrix_idx_to_rxn_id:dict
         Maps reaction's similarity matrix / embed matrix index to its reaction index from rxns
+    norm:str
+        Weight molecule pairs by 'max' or 'min' number of atoms
+    analyze_sides:str
+        'left' or 'both'
+    batch_size:int
+        Number of reaction pairs scored per batch
+    condensed:bool
+        Return a CondensedSimilarityMatrix holding only the upper triangle
+    min_similarity:float
+        If provided, only entries >= min_similarity are kept in a csr_array
+    shard:tuple[int]
+        (i, N) to only score batches k w/ k % N == i into checkpoint_dir,
+        see sharded_similarity_tiles
+    checkpoint_dir:Path
+        Where shards save their batches
     
     Returns
     -------
-    S:np.ndarray
-        nxn similarity matrix
-    '''
-    fields = ['smarts', 'min_rules']
-    S = np.eye(N=len(matrix_idx_to_rxn_id)) # Similarity matrix
-
-    to_do = []
-    S_idxs = []
-    print("Preparing reaction pairs\n")
-    for i in range(len(matrix_idx_to_rxn_id) - 1):
-        id_i = matrix_idx_to_rxn_id[i]
-        smarts_i, rules_i = [rxns[id_i][f] for f in fields]
-        print(f"Rxn # {i} : {matrix_idx_to_rxn_id[i]}", end='\r')
-        for j in range(i + 1, len(matrix_idx_to_rxn_id)):
-            id_j = matrix_idx_to_rxn_id[j]
-            smarts_j, rules_j = [rxns[id_j][f] for f in fields]
-
-            if tuple(rules_i) != tuple(rules_j):
-                rules_j = rules_j[::-1]
-            
-                if tuple(rules_i) != tuple(rules_j):
-                    continue
-                else:
-                    smarts_j = ">>".join(smarts_j.split(">>")[::-1])
+    S:np.ndarray | CondensedSimilarityMatrix | scipy.sparse.csr_array
+        nxn similarity matrix. None w/ shard
+    '''
+    n = len(matrix_idx_to_rxn_id)
+    if shard is not None:
+        S = None
+    elif min_similarity is not None:
+        entries = []
+    elif condensed:
+        S = CondensedSimilarityMatrix.empty(len(matrix_idx_to_rxn_id), dtype=dt)
+    else:
+        S = np.eye(N=len(matrix_idx_to_rxn_id), dtype=dt) # Similarity matrix
 
-            S_idxs.append((i, j))
-            to_do.append(([smarts_i, smarts_j],))
+    print("Fingerprinting reactions\n")
+    fps, n_atoms, offsets, n_left = reaction_fingerprints(
+        [rxns[matrix_idx_to_rxn_id[i]]['smarts'] for i in range(len(matrix_idx_to_rxn_id))]
+    )
 
-    print("\nProcessing pairs\n")    
-    with mp.Pool() as pool:
-        res = list(tqdm(pool.imap(_wrap_rxn_tani, to_do), total=len(to_do)))
-    
-    if S_idxs:
-        i, j = [np.array(elt) for elt in zip(*S_idxs)]
-        S[i, j] = res
-        S[j, i] = res
+    def score_batch(chunk):
+        i, j, flips = chunk.T
+        return chunk, aligned_tanimoto_similarity(
+            i, j, flips.astype(bool), fps, n_atoms, offsets, n_left, norm=norm, analyze_sides=analyze_sides
+        )
+
+    print("Processing pairs\n")
+    pairs = rule_compatible_pairs(rxns, matrix_idx_to_rxn_id)
+    if shard is not None:
+        meta = {
+            'scorer': 'tanimoto', 'shape': [n, n], 'dtype': np.dtype(dt).str, 'symmetric': True,
+            'tile_size': batch_size, 'norm': norm, 'analyze_sides': analyze_sides
+        }
+        n_tiles = -(n_rule_compatible_pairs(rxns, matrix_idx_to_rxn_id) // -batch_size)
+        sharded_similarity_tiles(score_batch, pair_chunks(pairs, batch_size), shard, checkpoint_dir, meta, min_similarity, n_tiles)
+        return
+
+    with tqdm(total=n_rule_compatible_pairs(rxns, matrix_idx_to_rxn_id)) as pbar:
+        for chunk in pair_chunks(pairs, batch_size):
+            _, res = score_batch(chunk)
+            i, j, _ = chunk.T
+            if min_similarity is not None:
+                keep = res >= min_similarity
+                entries.append((i[keep], j[keep], res[keep]))
+            elif condensed:
+                S.set_pairs(i, j, res)
+            else:
+                S[i, j] = res
+                S[j, i] = res
+            pbar.update(len(chunk))
+
+    if min_similarity is not None:
+        i, j, res = (np.concatenate(elt) for elt in zip(*entries)) if entries else (np.zeros(shape=(0,), dtype=int),) * 3
+        S = sparse_similarity_matrix(i, j, res, (n, n), dt=dt)
 
-    return S.astype(dt)
+    return S
 
-def agg_mfp_cosine_similarity_matrix(rxns:dict[str, dict], matrix_idx_to_rxn_id: dict[int, str], dt: np.dtype = np.float32):
+def agg_mfp_cosine_similarity_matrix(
+        rxns:dict[str, dict], matrix_idx_to_rxn_id: dict[int, str], dt: np.dtype = np.float32, block_size: int = 2048,
+        condensed: bool = False, min_similarity: float = None, shard: tuple[int] = None, checkpoint_dir: Path = None
+    ):
     '''
     Computes similarity matrix using bag of tanimoto similarity: tanimoto similarity on vectors gotten
-    by taking the abs diff of sum of mfps on each side of reaction.
+    by taking the abs diff of sum of mfps on each side of reaction. Each reaction's vector is built once
+    and the matrix is filled as normalized X X.T one row-block at a time.
 
     Args
     ----
@@ -92,40 +257,71 @@ def agg_mfp_cosine_similarity_matrix(rxns:dict[str, dict], matrix_idx_to_rxn_id:
         in each reaction_idx indexed sub-dict
     matrix_idx_to_rxn_id:dict
         Maps reaction's similarity matrix / embed matrix index to its reaction index from rxns
+    block_size:int
+        Rows of S computed per matmul
+    condensed:bool
+        Return a CondensedSimilarityMatrix holding only the upper triangle
+    min_similarity:float
+        If provided, only entries >= min_similarity are kept in a csr_array
+    shard:tuple[int]
+        (i, N) to only compute row tiles k w/ k % N == i into checkpoint_dir,
+        see sharded_similarity_tiles
+    checkpoint_dir:Path
+        Where shards save their row tiles
     
     Returns
     -------
-    S:np.ndarray
-        nxn similarity matrix
-    '''
-    S = np.eye(N=len(matrix_idx_to_rxn_id)) # Similarity matrix
-
-    to_do = []
-    S_idxs = []
-    print("Preparing reaction pairs\n")
-    for i in range(len(matrix_idx_to_rxn_id) - 1):
-        id_i = matrix_idx_to_rxn_id[i]
-        smarts_i = rxns[id_i]['smarts']
-        print(f"Rxn # {i} : {matrix_idx_to_rxn_id[i]}", end='\r')
-        for j in range(i + 1, len(matrix_idx_to_rxn_id)):
-            id_j = matrix_idx_to_rxn_id[j]
-            smarts_j = rxns[id_j]['smarts']
-
-            S_idxs.append((i, j))
-            to_do.append(([smarts_i, smarts_j],))
-
-    print("\nProcessing pairs\n")    
-    with mp.Pool() as pool:
-        res = list(tqdm(pool.imap(_wrap_agg_mfp_cosine, to_do), total=len(to_do)))
-    
-    if S_idxs:
-        i, j = [np.array(elt) for elt in zip(*S_idxs)]
-        S[i, j] = res
-        S[j, i] = res
+    S:np.ndarray | CondensedSimilarityMatrix | scipy.sparse.csr_array
+        nxn similarity matrix. None w/ shard
+    '''
+    n = len(matrix_idx_to_rxn_id)
+    print("Building reaction vectors\n")
+    X = reaction_difference_vectors([rxns[matrix_idx_to_rxn_id[i]]['smarts'] for i in range(n)])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        X /= np.linalg.norm(X, axis=1, keepdims=True)
+
+    if shard is not None:
+        def score_rows(rows):
+            start, end = rows
+            return block_entries(np.matmul(X[start:end], X[start:].T), start, start, min_offset=1)
+
+        tiles = row_tiles(n, n)
+        meta = {'scorer': 'agg_mfp_cosine', 'shape': [n, n], 'dtype': np.dtype(dt).str, 'symmetric': True, 'tile_size': tiles[0][1] if tiles else 0}
+        sharded_similarity_tiles(score_rows, tiles, shard, checkpoint_dir, meta, min_similarity, n_tiles=len(tiles))
+        return
+
+    if min_similarity is not None:
+        entries = []
+    elif condensed:
+        S = CondensedSimilarityMatrix.empty(n, dtype=dt)
+    else:
+        S = np.empty(shape=(n, n), dtype=dt) # Similarity matrix
+
+    print("Processing pairs\n")
+    for start in tqdm(range(0, n, block_size)):
+        rows = slice(start, start + block_size)
+        block = np.matmul(X[rows], X[start:].T)
+        if min_similarity is not None: # Strict upper triangle of the block's rows
+            r, c = np.nonzero(np.triu(block >= min_similarity, k=1))
+            entries.append((r + start, c + start, block[r, c]))
+        elif condensed: # Row i's entries right of the diagonal are contiguous
+            for r in range(block.shape[0]):
+                i = start + r
+                offset = condensed_index(i, i + 1, n)
+                S.values[offset:offset + n - i - 1] = block[r, r + 1:]
+        else:
+            S[rows, start:] = block
+            S[start:, rows] = block.T
+
+    if min_similarity is not None:
+        i, j, res = (np.concatenate(elt) for elt in zip(*entries)) if entries else (np.zeros(shape=(0,), dtype=int),) * 3
+        S = sparse_similarity_matrix(i, j, res, (n, n), dt=dt)
+    elif not condensed:
+        np.fill_diagonal(S, 1)
 
-    return S.astype(dt)
+    return S
 
-def mcs_similarity_matrix(rxns:dict[str, dict], matrix_idx_to_rxn_id: dict[int, str], dt: np.dtype = np.float32):
+def mcs_similarity_matrix(rxns:dict[str, dict], matrix_idx_to_rxn_id: dict[int, str], dt: np.dtype = np.float32, save_to: Path = None, memoize: bool = True, store: SimilarityStore = None, checkpoint_dir: Path = None, min_similarity: float = None, condensed: bool = False, shard: tuple[int] = None):
     '''
     Computes regular MCS 
     similarity matrix for set of reactions
@@ -137,149 +333,1126 @@ def mcs_similarity_matrix(rxns:dict[str, dict], matrix_idx_to_rxn_id: dict[int,
         in each reaction_idx indexed sub-dict
     matrix_idx_to_rxn_id:dict
         Maps reaction's similarity matrix / embed matrix index to its reaction index from rxns
+    save_to:Path
+        If provided, S is written straight to this .npy file and returned memory-mapped
+    memoize:bool
+        Share molecule pair MCS scores across pairs and workers, see MCSMemo
+    store:SimilarityStore
+        If provided, only pairs missing from the store are computed and
+        new scores are added to it
+    checkpoint_dir:Path
+        If provided, completed tiles of pairs are saved here and an
+        interrupted run resumes from them, see TileCheckpoint
+    min_similarity:float
+        If provided, pairs whose atom label histogram bound (see mcs_pair_bounds)
+        is below it are skipped and only scores >= min_similarity are kept
+    condensed:bool
+        Build and return a CondensedSimilarityMatrix holding only the upper triangle
+    shard:tuple[int]
+        (i, N) to only score this shard's tiles into checkpoint_dir,
+        see streamed_similarity_matrix
     
     Returns
     -------
-    S:np.ndarray
-        nxn similarity matrix
+    S:np.ndarray | CondensedSimilarityMatrix | scipy.sparse.csr_array
+        nxn similarity matrix, sparse if min_similarity is provided. None w/ shard
     '''
+    n = len(matrix_idx_to_rxn_id)
+    context = _reaction_context(rxns, matrix_idx_to_rxn_id)
+
+    store_keys = None
+    if store is not None: # Content hash of everything a pair's score depends on
+        store_keys = [content_hash([rxns[matrix_idx_to_rxn_id[i]][f] for f in ['smarts', 'min_rules']]) for i in range(n)]
+
+    print("Processing pairs\n")
+    with mp.Manager() if memoize else nullcontext() as manager:
+        if memoize:
+            context['mcs_memo'] = manager.dict()
+
+        S = streamed_similarity_matrix(
+            scorer=_mcs_pair,
+            context=context,
+            pairs=rule_compatible_pairs(rxns, matrix_idx_to_rxn_id),
+            shape=(n, n),
+            dt=dt,
+            n_pairs=n_rule_compatible_pairs(rxns, matrix_idx_to_rxn_id),
+            save_to=save_to,
+            store=store,
+            store_metric='mcs:norm=max',
+            store_keys=store_keys,
+            checkpoint_dir=checkpoint_dir,
+            pair_cost=partial(mcs_pair_costs, features=mcs_cost_features(context['smarts'])),
+            pair_bound=partial(mcs_pair_bounds, features=mcs_bound_features(context['smarts'])) if min_similarity is not None else None,
+            min_similarity=min_similarity,
+            condensed=condensed,
+            shard=shard
+        )
 
-    fields = ['smarts', 'min_rules']
-    S = np.eye(N=len(matrix_idx_to_rxn_id)) # Similarity matrix
-
-    to_do = []
-    S_idxs = []
-    print("Preparing reaction pairs\n")
-    for i in range(len(matrix_idx_to_rxn_id) - 1):
-        id_i = matrix_idx_to_rxn_id[i]
-        smarts_i, rules_i = [rxns[id_i][f] for f in fields]
-        print(f"Rxn # {i} : {matrix_idx_to_rxn_id[i]}", end='\r')
-        for j in range(i + 1, len(matrix_idx_to_rxn_id)):
-            id_j = matrix_idx_to_rxn_id[j]
-            smarts_j, rules_j = [rxns[id_j][f] for f in fields]
-
-            if tuple(rules_i) != tuple(rules_j):
-                rules_j = rules_j[::-1]
-            
-                if tuple(rules_i) != tuple(rules_j):
-                    continue
-                else:
-                    smarts_j = ">>".join(smarts_j.split(">>")[::-1])
+    return S
 
-            S_idxs.append((i, j))
-            to_do.append(([smarts_i, smarts_j],))
+def rcmcs_similarity_matrix(rxns:dict[str, dict], rules:pd.DataFrame, matrix_idx_to_rxn_id: dict[int, str], dt: np.dtype = np.float32, save_to: Path = None, memoize: bool = True, store: SimilarityStore = None, checkpoint_dir: Path = None, min_similarity: float = None, condensed: bool = False, shard: tuple[int] = None):
+    '''
+    Computes reaction center MCS 
+    similarity matrix for set of reactions
 
-    print("\nProcessing pairs\n")    
-    with mp.Pool() as pool:
-        res = list(tqdm(pool.imap(_wrap_rxn_mcs, to_do), total=len(to_do)))
+    Args
+    ----
+    rxns:dict
+        Reactions dict. Must contains 'smarts', 'rcs', 'min_rules' keys
+        in each reaction_idx indexed sub-dict
+    rules:pd.DataFrame
+        Minimal rules indexed by rule name, e.g., 'rule0123', w/ 'SMARTS' col
+    matrix_idx_to_rxn_id:dict
+        Maps reaction's similarity matrix / embed matrix index to its reaction index from rxns
+    save_to:Path
+        If provided, S is written straight to this .npy file and returned memory-mapped
+    memoize:bool
+        Share molecule pair MCS scores across pairs and workers, see MCSMemo
+    store:SimilarityStore
+        If provided, only pairs missing from the store are computed and
+        new scores are added to it
+    checkpoint_dir:Path
+        If provided, completed tiles of pairs are saved here and an
+        interrupted run resumes from them, see TileCheckpoint
+    min_similarity:float
+        If provided, pairs whose atom label histogram bound (see mcs_pair_bounds)
+        is below it are skipped and only scores >= min_similarity are kept
+    condensed:bool
+        Build and return a CondensedSimilarityMatrix holding only the upper triangle
+    shard:tuple[int]
+        (i, N) to only score this shard's tiles into checkpoint_dir,
+        see streamed_similarity_matrix
     
-    if S_idxs:
-        i, j = [np.array(elt) for elt in zip(*S_idxs)]
-        S[i, j] = res
-        S[j, i] = res
+    Returns
+    -------
+    S:np.ndarray | CondensedSimilarityMatrix | scipy.sparse.csr_array
+        nxn similarity matrix, sparse if min_similarity is provided. None w/ shard
+    '''
+    n = len(matrix_idx_to_rxn_id)
+    context = _reaction_context(rxns, matrix_idx_to_rxn_id, rules)
+
+    store_keys = None
+    if store is not None: # Content hash of everything a pair's score depends on
+        store_keys = [content_hash([rxns[matrix_idx_to_rxn_id[i]][f] for f in ['smarts', 'rcs', 'min_rules']] + [context['patts'][context['rule_keys'][i]]]) for i in range(n)]
+
+    print("Processing pairs\n")
+    with mp.Manager() if memoize else nullcontext() as manager:
+        if memoize:
+            context['mcs_memo'] = manager.dict()
+
+        S = streamed_similarity_matrix(
+            scorer=_rcmcs_pair,
+            context=context,
+            pairs=rule_compatible_pairs(rxns, matrix_idx_to_rxn_id),
+            shape=(n, n),
+            dt=dt,
+            n_pairs=n_rule_compatible_pairs(rxns, matrix_idx_to_rxn_id),
+            save_to=save_to,
+            store=store,
+            store_metric='rcmcs:norm=max',
+            store_keys=store_keys,
+            checkpoint_dir=checkpoint_dir,
+            pair_cost=partial(mcs_pair_costs, features=mcs_cost_features(context['smarts'])),
+            pair_bound=partial(mcs_pair_bounds, features=mcs_bound_features(context['smarts'], context['rcs'])) if min_similarity is not None else None,
+            min_similarity=min_similarity,
+            condensed=condensed,
+            shard=shard
+        )
 
-    return S.astype(dt)
+    return S
 
-def rcmcs_similarity_matrix(rxns:dict[str, dict], rules:pd.DataFrame, matrix_idx_to_rxn_id: dict[int, str], dt: np.dtype = np.float32):
+def extend_rcmcs_similarity_matrix(
+        S_old: np.ndarray, old_idx_to_rxn_id: dict[int, str], rxns:dict[str, dict], rules:pd.DataFrame, matrix_idx_to_rxn_id: dict[int, str],
+        dt: np.dtype = np.float32, save_to: Path = None, memoize: bool = True
+    ):
     '''
-    Computes reaction center MCS 
-    similarity matrix for set of reactions
+    Grows a saved rcmcs_similarity_matrix to a new, larger set of reactions,
+    computing only pairs that involve a reaction not in the old matrix
 
     Args
     ----
+    S_old:np.ndarray
+        Previously computed nxn similarity matrix
+    old_idx_to_rxn_id:dict
+        Maps S_old indices to reaction ids
     rxns:dict
         Reactions dict. Must contains 'smarts', 'rcs', 'min_rules' keys
         in each reaction_idx indexed sub-dict
     rules:pd.DataFrame
         Minimal rules indexed by rule name, e.g., 'rule0123', w/ 'SMARTS' col
+    matrix_idx_to_rxn_id:dict
+        Maps new similarity matrix indices to reaction ids, e.g.,
+        from construct_sparse_adj_mat on the new toc
+    save_to:Path
+        If provided, S is written straight to this .npy file and returned memory-mapped
+    memoize:bool
+        Share molecule pair MCS scores across pairs and workers, see MCSMemo
+
+    Returns
+    -------
+    S:np.ndarray
+        (n+m)x(n+m) similarity matrix indexed by matrix_idx_to_rxn_id
+    '''
+    n = len(matrix_idx_to_rxn_id)
+    context = _reaction_context(rxns, matrix_idx_to_rxn_id, rules)
+    old_ids = set(old_idx_to_rxn_id.values())
+    new_idxs = [i for i in range(n) if matrix_idx_to_rxn_id[i] not in old_ids]
+
+    print(f"Processing pairs of {len(new_idxs)} new reactions\n")
+    with mp.Manager() if memoize else nullcontext() as manager:
+        if memoize:
+            context['mcs_memo'] = manager.dict()
+
+        S = streamed_similarity_matrix(
+            scorer=_rcmcs_pair,
+            context=context,
+            pairs=rule_compatible_pairs(rxns, matrix_idx_to_rxn_id, involving=new_idxs),
+            shape=(n, n),
+            dt=dt,
+            save_to=save_to,
+            init=lambda S: place_similarity_matrix(S, S_old, old_idx_to_rxn_id, matrix_idx_to_rxn_id),
+            pair_cost=partial(mcs_pair_costs, features=mcs_cost_features(context['smarts']))
+        )
+
+    return S
+
+def leader_clusters(
+        rxns:dict[str, dict], matrix_idx_to_rxn_id: dict[int, str], cutoffs: list[float], rules:pd.DataFrame = None,
+        order: Iterable[int] = None, memoize: bool = True, processes: int = None
+    ) -> dict[float, np.ndarray]:
+    '''
+    Leader (sphere exclusion) clusters of reactions by MCS, or w/ rules RCMCS,
+    similarity, scoring pairs on demand instead of computing the full matrix.
+    Reactions are visited in order and join the cluster of the highest-bound
+    leader they are at least cutoff similar to, else lead a new one. Only
+    leaders w/ compatible min_rules (see rule_compatible_pairs) and an atom
+    label histogram bound (see mcs_pair_bounds) reaching the cutoff are
+    scored, in order of decreasing bound, and scores are cached across cutoffs.
+
+    Unlike single linkage, clusters depend on the order, are not nested
+    across cutoffs and members of different clusters may be similar
+
+    Args
+    ----
+    rxns:dict
+        Reactions dict. Must contains 'smarts', 'rcs', 'min_rules' keys
+        in each reaction_idx indexed sub-dict
     matrix_idx_to_rxn_id:dict
         Maps reaction's similarity matrix / embed matrix index to its reaction index from rxns
-    
+    cutoffs:list[float]
+        Similarity cutoffs in percent, as in configs/cluster.yaml
+    rules:pd.DataFrame
+        Minimal rules indexed by rule name, e.g., 'rule0123', w/ 'SMARTS' col.
+        If provided, RCMCS is used, otherwise MCS
+    order:Iterable[int]
+        Order in which matrix indices are visited, ascending by default
+    memoize:bool
+        Share molecule pair MCS scores across pairs and workers, see MCSMemo
+    processes:int
+        Candidate leaders of a reaction are scored this many at a time
+
     Returns
     -------
+    labels:dict[float, np.ndarray]
+        {cutoff: cluster of each matrix index}
+    '''
+    n = len(matrix_idx_to_rxn_id)
+    context = _reaction_context(rxns, matrix_idx_to_rxn_id, rules)
+    scorer = _mcs_pair if rules is None else _rcmcs_pair
+    features = mcs_bound_features(context['smarts'], context.get('rcs'))
+    rule_keys = [tuple(rxns[matrix_idx_to_rxn_id[i]]['min_rules']) for i in range(n)]
+    order = np.arange(n) if order is None else np.asarray(order)
+    processes = processes or mp.cpu_count()
+
+    cache = {} # (i, j) -> score, i < j
+    stats = Counter()
+    labels = {}
+    with mp.Manager() if memoize else nullcontext() as manager:
+        if memoize:
+            context['mcs_memo'] = manager.dict()
+
+        with mp.Pool(processes=processes, initializer=_init_similarity_worker, initargs=(scorer, context)) as pool:
+            for cutoff in cutoffs:
+                min_similarity = cutoff / 100
+                leaders = defaultdict(list) # Rule key -> leaders' matrix indices
+                labels[cutoff] = np.full(shape=(n,), fill_value=-1, dtype=np.int64)
+                n_clusters = 0
+                for i in tqdm(order):
+                    key = rule_keys[i]
+                    candidates = np.array(leaders[key] + (leaders[key[::-1]] if key[::-1] != key else []), dtype=np.int64)
+                    pairs = np.stack([np.minimum(candidates, i), np.maximum(candidates, i), np.zeros_like(candidates)], axis=1)
+                    pairs[:, 2] = [rule_keys[a] != rule_keys[b] for a, b in pairs[:, :2]] # Reverse j to align w/ i, as rule_compatible_pairs
+                    if len(pairs):
+                        bounds = mcs_pair_bounds(pairs, features)
+                        keep = bounds >= min_similarity - 1e-9 # Slack for rounding of exact scores
+                        stats['pruned'] += int((~keep).sum())
+                        pairs = pairs[keep][np.argsort(-bounds[keep], kind='stable')]
+
+                    leader = None
+                    for start in range(0, len(pairs), processes):
+                        batch = [tuple(pair) for pair in pairs[start:start + processes]]
+                        todo = [pair for pair in batch if pair[:2] not in cache]
+                        for pair, (_, scores) in zip(todo, pool.map(_score_pair_chunk, [np.array([pair]) for pair in todo])):
+                            cache[pair[:2]] = scores[0]
+
+                        stats['scored'] += len(todo)
+                        stats['cached'] += len(batch) - len(todo)
+                        hits = [pair for pair in batch if cache[pair[:2]] >= min_similarity]
+                        if hits:
+                            leader = hits[0][0] if hits[0][1] == i else hits[0][1]
+                            break
+
+                    if leader is None:
+                        leaders[key].append(int(i))
+                        labels[cutoff][i] = n_clusters
+                        n_clusters += 1
+                    else:
+                        labels[cutoff][i] = labels[cutoff][leader]
+
+                print(f"{n_clusters} clusters at cutoff {cutoff}\n")
+
+    print(f"Scored {stats['scored']} of {n_rule_compatible_pairs(rxns, matrix_idx_to_rxn_id)} rule compatible pairs, reused {stats['cached']}, skipped {stats['pruned']} w/ upper bound below cutoff")
+    return labels
+
+def _reaction_context(rxns:dict[str, dict], matrix_idx_to_rxn_id: dict[int, str], rules:pd.DataFrame = None) -> dict:
+    '''
+    Pair scorer inputs for _mcs_pair, or w/ rules, _rcmcs_pair
+    '''
+    n = len(matrix_idx_to_rxn_id)
+    context = {'smarts': [rxns[matrix_idx_to_rxn_id[i]]['smarts'] for i in range(n)]}
+    if rules is None:
+        return context
+
+    rule_keys = [tuple(rxns[matrix_idx_to_rxn_id[i]]['min_rules']) for i in range(n)]
+    context.update(
+        rcs=[rxns[matrix_idx_to_rxn_id[i]]['rcs'] for i in range(n)],
+        rule_keys=rule_keys,
+        patts={
+            key: [extract_operator_patts(rules.loc[rule, 'SMARTS'], side=0) for rule in key]
+            for key in set(rule_keys)
+        } # Reaction center patts for each rule tuple
+    )
+    return context
+
+def place_similarity_matrix(S: np.ndarray, S_old: np.ndarray, old_idx_to_id: dict[int, str], matrix_idx_to_id: dict[int, str], block_size: int = 4096) -> np.ndarray:
+    '''
+    Copies the scores of a previously computed similarity matrix into S
+    at the items' new positions. Items of S_old no longer present are dropped
+
+    Args
+    ----
     S:np.ndarray
-        nxn similarity matrix
-    '''
-    fields = ['smarts', 'rcs', 'min_rules']
-    S = np.eye(N=len(matrix_idx_to_rxn_id)) # Similarity matrix
-
-    to_do = []
-    S_idxs = []
-    print("Preparing reaction pairs\n")
-    for i in range(len(matrix_idx_to_rxn_id) - 1):
-        id_i = matrix_idx_to_rxn_id[i]
-        smarts_i, rcs_i, rules_i = [rxns[id_i][f] for f in fields]
-        patts = [extract_operator_patts(rules.loc[rule, 'SMARTS'], side=0) for rule in rules_i]
-        print(f"Rxn # {i} : {matrix_idx_to_rxn_id[i]}", end='\r')
-        for j in range(i + 1, len(matrix_idx_to_rxn_id)):
-            id_j = matrix_idx_to_rxn_id[j]
-            smarts_j, rcs_j, rules_j = [rxns[id_j][f] for f in fields]
-
-            if tuple(rules_i) != tuple(rules_j):
-                rules_j = rules_j[::-1]
-            
-                if tuple(rules_i) != tuple(rules_j):
-                    continue
+        Output indexed by matrix_idx_to_id
+    S_old:np.ndarray
+        Previously computed similarity matrix indexed by old_idx_to_id
+    old_idx_to_id:dict
+        Maps S_old indices to ids
+    matrix_idx_to_id:dict
+        Maps S indices to ids
+
+    Returns
+    -------
+    new_idxs:np.ndarray
+        Indices of S whose ids are not in S_old
+    '''
+    id_to_idx = {v: k for k, v in matrix_idx_to_id.items()}
+    kept = [(old_idx, id_to_idx[id]) for old_idx, id in old_idx_to_id.items() if id in id_to_idx]
+    old_idxs, idxs = [np.array(elt, dtype=int) for elt in zip(*kept)] if kept else (np.array([], dtype=int),) * 2
+
+    for start in range(0, len(idxs), block_size):
+        rows = slice(start, start + block_size)
+        S[np.ix_(idxs[rows], idxs)] = S_old[np.ix_(old_idxs[rows], old_idxs)]
+
+    return np.setdiff1d(np.arange(len(matrix_idx_to_id)), idxs)
+
+def rule_compatible_pairs(rxns:dict[str, dict], matrix_idx_to_rxn_id: dict[int, str], involving: Iterable[int] = None):
+    '''
+    Yields upper-triangular pairs of reactions whose min_rules match
+    as is or with one reaction reversed. Reactions are hashed into buckets
+    by rule tuple so only pairs within compatible buckets are visited.
+
+    Args
+    ----
+    rxns:dict
+        Reactions dict. Must contains 'min_rules' key
+        in each reaction_idx indexed sub-dict
+    matrix_idx_to_rxn_id:dict
+        Maps reaction's similarity matrix / embed matrix index to its reaction index from rxns
+    involving:Iterable[int]
+        If provided, only pairs with at least one of these matrix indices are yielded
+    
+    Yields
+    ------
+    (i, j, flip):tuple[int, int, bool]
+        Matrix indices, i < j, and whether reaction j must be
+        reversed to align with reaction i
+    '''
+    rule_keys = [tuple(rxns[matrix_idx_to_rxn_id[i]]['min_rules']) for i in range(len(matrix_idx_to_rxn_id))]
+    buckets = defaultdict(list)
+    for i, key in enumerate(rule_keys):
+        buckets[key].append(i) # Ascending matrix indices
+
+    buckets = {key: np.array(idxs) for key, idxs in buckets.items()}
+    if involving is not None:
+        involving = np.array(sorted(set(involving)), dtype=int)
+        involved_buckets = {key: np.intersect1d(idxs, involving) for key, idxs in buckets.items()}
+        is_involved = np.isin(np.arange(len(rule_keys)), involving)
+
+    for i, key in enumerate(rule_keys):
+        orientations = [(key, False)]
+        if key[::-1] != key:
+            orientations.append((key[::-1], True))
+
+        for compat_key, flip in orientations:
+            if compat_key not in buckets:
+                continue
+
+            if involving is None or is_involved[i]:
+                bucket = buckets[compat_key]
+            else:
+                bucket = involved_buckets[compat_key]
+
+            for j in bucket[np.searchsorted(bucket, i, side='right'):]:
+                yield i, int(j), flip
+
+def n_rule_compatible_pairs(rxns:dict[str, dict], matrix_idx_to_rxn_id: dict[int, str]) -> int:
+    '''
+    Number of pairs rule_compatible_pairs will yield
+    '''
+    sizes = Counter(tuple(rxns[matrix_idx_to_rxn_id[i]]['min_rules']) for i in range(len(matrix_idx_to_rxn_id)))
+    n_pairs = 0
+    for key, size in sizes.items():
+        n_pairs += size * (size - 1) // 2
+        if key < key[::-1]: # Count reversed-bucket pairs once
+            n_pairs += size * sizes.get(key[::-1], 0)
+
+    return n_pairs
+
+def upper_triangle_pairs(start: int, end: int, n: int):
+    '''
+    Yields (i, j, False) for rows start <= i < end and
+    columns i < j < n of an nxn matrix
+    '''
+    for i in range(start, min(end, n)):
+        for j in range(i + 1, n):
+            yield i, j, False
+
+def balanced_row_chunks(lengths: np.ndarray, n_chunks: int) -> list[tuple[int]]:
+    '''
+    Splits the rows of an upper-triangular pairwise job into contiguous
+    ranges of roughly equal estimated cost, where a pair costs the product
+    of its sequence lengths, so row i costs len_i * sum_{j > i} len_j
+
+    Args
+    ----
+    lengths:np.ndarray
+        Sequence lengths by matrix index
+    n_chunks:int
+        Target number of chunks. Fewer are returned if single
+        rows exceed the per-chunk budget
+
+    Returns
+    -------
+    chunks:list[tuple[int]]
+        [(start, end), ...] row ranges covering [0, n)
+    '''
+    lengths = np.asarray(lengths, dtype=np.float64)
+    n = len(lengths)
+    suffix = np.cumsum(lengths[::-1])[::-1] - lengths
+    cum_cost = np.cumsum(lengths * suffix)
+    targets = cum_cost[-1] * np.arange(1, n_chunks) / n_chunks if n else []
+    bounds = np.unique(np.concatenate([[0], np.searchsorted(cum_cost, targets) + 1, [n]]).astype(int))
+    bounds = bounds[bounds <= n]
+    return [(int(start), int(end)) for start, end in zip(bounds[:-1], bounds[1:])]
+
+def pair_chunks(pairs: Iterable[tuple], chunk_size: int):
+    '''
+    Lazily groups (i, j, flip) tuples into (chunk_size x 3) int arrays
+    '''
+    pairs = iter(pairs)
+    while True:
+        chunk = list(islice(pairs, chunk_size))
+        if not chunk:
+            return
+        
+        yield np.array(chunk, dtype=np.int64).reshape(-1, 3)
+
+def mcs_cost_features(smarts: Iterable[str]) -> list[tuple[np.ndarray]]:
+    '''
+    Size (# atoms + # bonds) and # ring systems of each
+    molecule on each side of each reaction, see mcs_pair_costs
+
+    Args
+    ----
+    smarts:Iterable[str]
+        Reaction SMARTS indexed by matrix index
+
+    Returns
+    -------
+    features:list[tuple[np.ndarray]]
+        Per reaction, (left, right) arrays of shape (# molecules x 2)
+    '''
+    features = []
+    for rxn in smarts:
+        sides = []
+        for side in rxn.split('>>'):
+            mols = [Chem.MolFromSmiles(smi) for smi in side.split('.')]
+            sides.append(np.array([(mol.GetNumAtoms() + mol.GetNumBonds(), n_ring_systems(mol)) for mol in mols], dtype=np.float64).reshape(-1, 2))
+
+        features.append(tuple(sides))
+
+    return features
+
+def mcs_pair_costs(pairs: np.ndarray, features: list[tuple[np.ndarray]]) -> np.ndarray:
+    '''
+    Estimates the FindMCS cost of each reaction pair as the sum over
+    aligned molecule pairs of size_i * size_j * (1 + ring systems_i + ring systems_j)
+
+    Args
+    ----
+    pairs:np.ndarray
+        (k x 3) array of (i, j, flip)
+    features:list[tuple[np.ndarray]]
+        From mcs_cost_features
+
+    Returns
+    -------
+    costs:np.ndarray
+    '''
+    costs = np.empty(shape=(len(pairs),))
+    for k, (i, j, flip) in enumerate(pairs):
+        fi = np.vstack(features[i])
+        fj = np.vstack(features[j][::-1] if flip else features[j])
+        costs[k] = np.sum(fi[:, 0] * fj[:, 0] * (1 + fi[:, 1] + fj[:, 1]))
+
+    return costs
+
+def mcs_bound_features(smarts: Iterable[str], rcs: Iterable = None) -> tuple[np.ndarray]:
+    '''
+    Atom label histograms of every molecule of every reaction, see mcs_pair_bounds.
+    Atoms are labeled by element, or w/ rcs, the isotope label_reaction_center
+    gives them, i.e., what FindMCS compares atoms by
+
+    Args
+    ----
+    smarts:Iterable[str]
+        Reaction SMARTS indexed by matrix index
+    rcs:Iterable
+        Reaction centers, per reaction per side per molecule, for RCMCS
+
+    Returns
+    -------
+    hists:np.ndarray
+        (# molecules x # labels) atom label counts, molecules of a
+        reaction stored contiguously from left to right
+    n_atoms, offsets, n_left:np.ndarray
+        As returned by reaction_fingerprints
+    '''
+    labels, n_atoms, offsets, n_left = [], [], [0], []
+    rcs = rcs if rcs is not None else repeat(None)
+    for rxn, rc in zip(smarts, rcs):
+        sides = [side.split('.') for side in rxn.split('>>')]
+        for side, smiles in enumerate(sides):
+            for m, smi in enumerate(smiles):
+                mol = Chem.MolFromSmiles(smi)
+                if rc is not None:
+                    mol = label_reaction_center(mol, rc[side][m])
+                    labels.append([atom.GetIsotope() for atom in mol.GetAtoms()])
                 else:
-                    rcs_j = rcs_j[::-1]
-                    smarts_j = ">>".join(smarts_j.split(">>")[::-1])
+                    labels.append([atom.GetAtomicNum() for atom in mol.GetAtoms()])
+
+                n_atoms.append(mol.GetNumAtoms())
+
+        offsets.append(offsets[-1] + sum(len(smiles) for smiles in sides))
+        n_left.append(len(sides[0]))
+
+    vocab = {label: k for k, label in enumerate(sorted(set(chain(*labels))))}
+    hists = np.zeros(shape=(len(labels), len(vocab)), dtype=np.int32)
+    for m, mol_labels in enumerate(labels):
+        np.add.at(hists[m], [vocab[label] for label in mol_labels], 1)
+
+    return hists, np.array(n_atoms), np.array(offsets), np.array(n_left)
+
+def mcs_pair_bounds(pairs: np.ndarray, features: tuple[np.ndarray], norm: str = 'max') -> np.ndarray:
+    '''
+    Upper bound on the atom-weighted (RC)MCS score of each reaction pair.
+    A common substructure cannot have more atoms of a label than either
+    molecule, so each aligned molecule pair's # MCS atoms is bounded by
+    the overlap of their atom label histograms
+
+    Args
+    ----
+    pairs:np.ndarray
+        (k x 3) array of (i, j, flip)
+    features:tuple[np.ndarray]
+        From mcs_bound_features
+    norm:str
+        'max' or 'min', as in aligned_mcs_similarity
+
+    Returns
+    -------
+    bounds:np.ndarray
+    '''
+    hists, n_atoms, offsets, n_left = features
+    i, j, flip = pairs[:, 0], pairs[:, 1], pairs[:, 2].astype(bool)
+    pair_idx, a, b = aligned_molecule_pairs(i, j, flip, offsets, n_left)
+    overlap = np.minimum(hists[a], hists[b]).sum(axis=1)
+    if norm == 'max':
+        weights = np.maximum(n_atoms[a], n_atoms[b])
+    elif norm == 'min':
+        weights = np.minimum(n_atoms[a], n_atoms[b])
 
-            S_idxs.append((i, j))
-            to_do.append(([smarts_i, smarts_j], (rcs_i, rcs_j), patts))
+    return np.bincount(pair_idx, overlap, minlength=len(pairs)) / np.bincount(pair_idx, weights, minlength=len(pairs))
+
+def n_ring_systems(mol: Mol) -> int:
+    '''
+    Number of ring systems, i.e., groups of rings sharing atoms
+    '''
+    systems = []
+    for ring in mol.GetRingInfo().AtomRings():
+        ring = set(ring)
+        fused = [system for system in systems if system & ring]
+        for system in fused:
+            ring |= system
+            systems.remove(system)
+
+        systems.append(ring)
+
+    return len(systems)
+
+def cost_balanced_chunks(pairs: np.ndarray, costs: np.ndarray, n_chunks: int, max_chunk_size: int = 256):
+    '''
+    Yields pairs most expensive first, grouped into about n_chunks
+    chunks of roughly equal total cost, so expensive pairs go out
+    alone or in small chunks and cheap pairs in large ones
 
-    print("\nProcessing pairs\n")    
-    with mp.Pool() as pool:
-        res = list(tqdm(pool.imap(_wrap_rxn_mcs, to_do), total=len(to_do)))
+    Args
+    ----
+    pairs:np.ndarray
+        (k x 3) array of (i, j, flip)
+    costs:np.ndarray
+        Estimated cost of each pair
+    n_chunks:int
+        Target number of chunks
+    max_chunk_size:int
+        Upper bound on pairs per chunk
+    '''
+    order = np.argsort(-costs, kind='stable')
+    pairs, costs = pairs[order], costs[order]
+    budget = costs.sum() / max(n_chunks, 1)
+    start = 0
+    while start < len(pairs):
+        # Smallest chunk reaching the budget, at least one pair and at most max_chunk_size
+        n = min(int(np.searchsorted(np.cumsum(costs[start:start + max_chunk_size]), budget)) + 1, max_chunk_size)
+        yield pairs[start:start + n]
+        start += n
+
+def streamed_similarity_matrix(
+        scorer, context: dict, pairs: Iterable[tuple], shape: tuple[int], dt: np.dtype = np.float32, n_pairs: int = None,
+        symmetric: bool = True, row_offset: int = 0, save_to: Path = None, chunk_size: int = 64, processes: int = None,
+        store: SimilarityStore = None, store_metric: str = None, store_keys: list[str] = None, init = None,
+        checkpoint_dir: Path = None, tile_size: int = 2**14, pair_cost = None, pair_bound = None, min_similarity: float = None,
+        condensed: bool = False, shard: tuple[int] = None
+    ):
+    '''
+    Scores pairs with a pool of workers and streams their scores into a
+    memory-mapped output, or w/ min_similarity, keeps only the entries
+    above it. Pairs are consumed lazily and only a bounded number of small
+    index chunks is ever in flight, so memory stays flat regardless of
+    the number of pairs.
+
+    Args
+    ----
+    scorer:Callable
+        Module-level function (i, j, flip) -> float reading its
+        inputs from _worker_state
+    context:dict
+        Inputs installed once in each worker's _worker_state, e.g.,
+        SMARTS / sequences indexed by matrix index
+    pairs:Iterable[tuple]
+        (i, j, flip) tuples to score
+    shape:tuple[int]
+        Shape of the output
+    dt:np.dtype
+        Output dtype
+    n_pairs:int
+        Number of pairs, for the progress bar only
+    symmetric:bool
+        Write S[j, i] as well as S[i, j] and put 1 on the diagonal
+    row_offset:int
+        Global index of the output's first row
+    save_to:Path
+        If provided, output is this .npy file and is returned memory-mapped.
+        Otherwise a temporary file is used and an in-memory array is returned
+    chunk_size:int
+        Pairs per task
+    processes:int
+        Number of workers, defaults to cpu count
+    store:SimilarityStore
+        If provided, pairs already in the store are filled in from it and
+        only the rest are computed, then added to the store
+    store_metric:str
+        Metric name + parameters the store's scores are keyed by
+    store_keys:list[str]
+        Content hash of each item, indexed by matrix index
+    init:Callable
+        If provided, called on the freshly allocated output to fill it
+        in place, e.g., w/ previously computed scores
+    checkpoint_dir:Path
+        If provided, each tile of tile_size consecutive pairs is saved here
+        once scored, and tiles already saved by an earlier, interrupted run
+        are filled in from there instead of being recomputed, see TileCheckpoint
+    tile_size:int
+        Pairs per checkpointed tile
+    pair_cost:Callable
+        If provided, maps a (k x 3) array of pairs to their estimated
+        cost, e.g., mcs_pair_costs. Pairs of each tile are then dispatched
+        most expensive first in chunks of roughly equal cost, so the run
+        does not end w/ a few workers grinding through large pairs
+    pair_bound:Callable
+        Maps a (k x 3) array of pairs to an upper bound on their scores,
+        e.g., mcs_pair_bounds. W/ min_similarity, pairs whose bound is
+        below it are not scored
+    min_similarity:float
+        If provided, only entries >= min_similarity are kept and the output
+        is sparse, never allocating a dense matrix
+    condensed:bool
+        Output only the upper triangle of a symmetric matrix, see CondensedSimilarityMatrix
+    shard:tuple[int]
+        (i, N) to score only tiles k w/ k % N == i into checkpoint_dir and
+        return nothing. Shards of one job can run anywhere in any order
+        and assemble_similarity_tiles merges them
     
-    if S_idxs:
-        i, j = [np.array(elt) for elt in zip(*S_idxs)]
-        S[i, j] = res
-        S[j, i] = res
+    Returns
+    -------
+    S:np.ndarray | CondensedSimilarityMatrix | scipy.sparse.csr_array
+        Sparse if min_similarity is provided. Then save_to, if
+        provided, gets the sparse matrix as .npz. None w/ shard
+    '''
+    if condensed and not symmetric:
+        raise ValueError("Only symmetric outputs can be condensed")
+
+    if shard is not None and (checkpoint_dir is None or init is not None):
+        raise ValueError("Sharded runs need a checkpoint_dir to save tiles to and cannot init the output")
+
+    processes = processes or mp.cpu_count()
+    stats = Counter()
+    with TemporaryDirectory() as tmp_dir:
+        entries = [] # (pairs, scores) kept in sparse mode
+        if min_similarity is not None or shard is not None:
+            S = None
+        elif condensed:
+            path = _npy_path(save_to) if save_to is not None else Path(tmp_dir) / "S.npy"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            S = CondensedSimilarityMatrix.empty(shape[0], dtype=dt, path=path)
+        else:
+            path = _npy_path(save_to) if save_to is not None else Path(tmp_dir) / "S.npy"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            S = np.lib.format.open_memmap(path, mode='w+', dtype=dt, shape=shape)
+            S[:] = 0
+            if symmetric:
+                np.fill_diagonal(S, 1)
+
+        if init is not None:
+            init(S)
+
+        def write(chunk, scores):
+            if shard is not None: # Only kept in tiles
+                return
+            elif min_similarity is not None:
+                keep = scores >= min_similarity
+                entries.append((chunk[keep], scores[keep]))
+            elif condensed:
+                S.set_pairs(chunk[:, 0], chunk[:, 1], scores)
+            else:
+                S[chunk[:, 0] - row_offset, chunk[:, 1]] = scores
+                if symmetric:
+                    S[chunk[:, 1], chunk[:, 0]] = scores
+
+        checkpoint = None
+        if checkpoint_dir is not None:
+            meta = {
+                'scorer': scorer.__name__, 'shape': list(shape), 'dtype': np.dtype(dt).str,
+                'symmetric': symmetric, 'row_offset': row_offset, 'tile_size': tile_size,
+                'min_similarity': min_similarity, 'pruned': pair_bound is not None
+            }
+            checkpoint = TileCheckpoint(checkpoint_dir, meta)
+
+        tiles = {} # Tile idx -> [scored (pairs, scores), # chunks in flight + 1 while still submitting]
+        def record(k, chunk, scores):
+            write(chunk, scores)
+            if checkpoint is not None:
+                tiles[k][0].append((chunk, scores))
+
+        def release(k):
+            tiles[k][1] -= 1
+            if tiles[k][1] == 0:
+                scored = tiles.pop(k)[0]
+                if checkpoint is not None:
+                    done_pairs, done_scores = (np.concatenate(elt) for elt in zip(*scored)) if scored else (np.zeros(shape=(0, 3), dtype=np.int64), np.zeros(shape=(0,)))
+                    checkpoint.save(k, done_pairs, done_scores)
+
+        def collect(chunk, result, k):
+            chunk_stats, scores = result.get()
+            stats.update(chunk_stats)
+            record(k, chunk, scores)
+            if store is not None:
+                keys_1, keys_2 = [[store_keys[idx] for idx in col] for col in (chunk[:, 0], chunk[:, 1])]
+                store.put_many(store_metric, keys_1, keys_2, scores)
+
+            release(k)
+            pbar.update(stats['pairs'] + stats['stored'] + stats['resumed'] - pbar.n)
+
+        with mp.Pool(processes=processes, initializer=_init_similarity_worker, initargs=(scorer, context)) as pool:
+            pending = {} # Task id -> (chunk, async result, tile idx)
+            finished = SimpleQueue() # Task ids in order of completion
+            task_ids = count()
+            def submit(chunk, k):
+                task_id = next(task_ids)
+                notify = lambda _: finished.put(task_id)
+                pending[task_id] = (chunk, pool.apply_async(_score_pair_chunk, (chunk,), callback=notify, error_callback=notify), k)
+                if len(pending) >= 4 * processes:
+                    collect(*pending.pop(finished.get()))
+
+            tic = perf_counter()
+            with tqdm(total=n_pairs) as pbar:
+                for k, tile in enumerate(pair_chunks(pairs, tile_size)):
+                    stats['tiles'] += 1
+                    stats['enumerated'] += len(tile)
+                    if shard is not None and k % shard[1] != shard[0]:
+                        continue
+
+                    if min_similarity is not None and pair_bound is not None:
+                        keep = pair_bound(tile) >= min_similarity - 1e-9 # Slack for rounding of exact scores
+                        stats['pruned'] += int((~keep).sum())
+                        tile = tile[keep]
+
+                    if checkpoint is not None and k in checkpoint.done:
+                        done_pairs, done_scores = checkpoint.load(k)
+                        write(done_pairs, done_scores)
+                        stats['resumed'] += len(done_pairs)
+                        continue
+
+                    tiles[k] = [[], 1]
+                    todo = tile
+                    if store is not None:
+                        todo = _unstored_pairs(tile, store, store_metric, store_keys, partial(record, k), stats)
+
+                    if pair_cost is not None:
+                        todo = np.array(list(todo), dtype=np.int64).reshape(-1, 3)
+                        chunks = cost_balanced_chunks(todo, pair_cost(todo), n_chunks=4 * processes, max_chunk_size=4 * chunk_size)
+                    else:
+                        chunks = pair_chunks(todo, chunk_size)
+
+                    for chunk in chunks:
+                        tiles[k][1] += 1
+                        submit(chunk, k)
+
+                    release(k)
+
+                while pending:
+                    collect(*pending.pop(finished.get()))
+
+            wall = perf_counter() - tic
+
+        if store is not None:
+            store.commit()
+            print(f"Reused {stats['stored']} stored pairs, computed {stats['pairs']}")
+
+        if checkpoint is not None:
+            print(f"Resumed {stats['resumed']} pairs from {checkpoint_dir}")
+            if shard is None:
+                checkpoint.finish(n_tiles=stats['tiles'], n_pairs=stats['enumerated'] - stats['pruned'])
+            else: # Other shards' tiles are neither scored nor, w/ pair_bound, pruned here
+                n_pairs = stats['enumerated'] if pair_bound is None or min_similarity is None else None
+                checkpoint.finish(n_tiles=stats['tiles'], n_pairs=n_pairs, check=False)
+
+        if shard is not None:
+            print(f"Saved shard {shard[0]} of {shard[1]} to {checkpoint_dir}")
+        elif min_similarity is not None:
+            if pair_bound is not None:
+                print(f"Skipped {stats['pruned']} of {stats['enumerated']} pairs w/ upper bound below {min_similarity}")
+
+            kept_pairs, kept_scores = (np.concatenate(elt) for elt in zip(*entries)) if entries else (np.zeros(shape=(0, 3), dtype=np.int64), np.zeros(shape=(0,)))
+            S = sparse_similarity_matrix(kept_pairs[:, 0] - row_offset, kept_pairs[:, 1], kept_scores, shape, dt=dt, symmetric=symmetric)
+            if save_to is not None:
+                Path(save_to).parent.mkdir(parents=True, exist_ok=True)
+                sp.save_npz(save_to, S)
+        elif save_to is None and condensed:
+            S = CondensedSimilarityMatrix(np.array(S.values))
+        elif save_to is None:
+            S = np.array(S)
+        else:
+            _flush(S)
+
+    if stats['busy'] > 0:
+        print(f"Worker utilization: {stats['busy'] / (processes * wall):.3f} ({stats['busy']:.1f} busy seconds of {processes} x {wall:.1f} s)")
+
+    if stats['mcs_hits'] + stats['mcs_misses'] > 0:
+        lookups = stats['mcs_hits'] + stats['mcs_misses']
+        print(f"MCS memo hit rate: {stats['mcs_hits'] / lookups:.3f} ({stats['mcs_hits']} / {lookups} molecule pairs)")
+
+    return S
+
+def sparse_similarity_matrix(i: np.ndarray, j: np.ndarray, scores: np.ndarray, shape: tuple[int], dt: np.dtype = np.float32, symmetric: bool = True) -> sp.csr_array:
+    '''
+    Assembles scored entries (i, j) into a csr_array. If symmetric, entries
+    are upper-triangular and get mirrored, and the unit diagonal is added
+    '''
+    if symmetric:
+        diag = np.arange(shape[0])
+        i, j = np.concatenate([i, j, diag]), np.concatenate([j, i, diag])
+        scores = np.concatenate([scores, scores, np.ones(shape=(shape[0],))])
+
+    return sp.csr_array((scores, (i, j)), shape=shape).astype(dt)
+
+def sharded_similarity_tiles(
+        score_tile, tiles: Iterable, shard: tuple[int], checkpoint_dir: Path, meta: dict,
+        min_similarity: float = None, n_tiles: int = None
+    ):
+    '''
+    Scores a shard's tiles of a job computed in vectorized blocks rather than
+    by streamed_similarity_matrix's worker pool and saves them to a TileCheckpoint
+    in the same (pairs, scores) layout, for assemble_similarity_tiles. Tile k
+    belongs to shard i of N if k % N == i
+
+    Args
+    ----
+    score_tile:Callable
+        Maps a tile to its (m x 3) pairs and m scores
+    tiles:Iterable
+        Deterministic sequence of tiles, e.g., row ranges or pair arrays
+    shard:tuple[int]
+        (i, N)
+    checkpoint_dir:Path
+        Shared by all shards of the job
+    meta:dict
+        Job parameters. Must have shape, dtype and symmetric, and unit_diagonal
+        if symmetric and the diagonal is not 1
+    min_similarity:float
+        If provided, only entries >= min_similarity are saved
+    n_tiles:int
+        Number of tiles, for the progress bar only
+    '''
+    i, n_shards = shard
+    checkpoint = TileCheckpoint(checkpoint_dir, {'row_offset': 0, 'min_similarity': min_similarity, **meta})
+    n_seen = 0
+    for k, tile in enumerate(tqdm(tiles, total=n_tiles)):
+        n_seen += 1
+        if k % n_shards != i or k in checkpoint.done:
+            continue
+
+        pairs, scores = score_tile(tile)
+        if min_similarity is not None:
+            keep = scores >= min_similarity
+            pairs, scores = pairs[keep], scores[keep]
+
+        checkpoint.save(k, pairs, scores)
+
+    checkpoint.finish(n_tiles=n_seen, n_pairs=None, check=False)
+    print(f"Saved shard {i} of {n_shards} to {checkpoint_dir}")
+
+def row_tiles(n_rows: int, n_cols: int, tile_entries: int = 2**22) -> list[tuple[int]]:
+    '''
+    Splits n_rows into (start, end) ranges of about tile_entries matrix entries
+    '''
+    step = max(1, tile_entries // max(n_cols, 1))
+    return [(start, min(start + step, n_rows)) for start in range(0, n_rows, step)]
+
+def block_entries(block: np.ndarray, row_start: int, col_start: int = 0, min_offset: int = None) -> tuple[np.ndarray]:
+    '''
+    Flattens a dense block of S at (row_start, col_start) into (pairs, scores)
+    w/ pairs laid out like a pair stream's (i, j, 0), keeping only entries
+    w/ j - i >= min_offset if provided, e.g., 1 for the strict upper triangle
+    '''
+    rows, cols = np.indices(block.shape, dtype=np.int32)
+    i, j = rows.ravel() + row_start, cols.ravel() + col_start
+    scores = block.ravel()
+    if min_offset is not None:
+        keep = j - i >= min_offset
+        i, j, scores = i[keep], j[keep], scores[keep]
+
+    return np.stack([i, j, np.zeros_like(i)], axis=1), scores
+
+def assemble_similarity_tiles(checkpoint_dir: Path, output: str = None, save_to: Path = None):
+    '''
+    Merges the tiles of a job, e.g., run as shards, into its similarity
+    matrix after checking all tiles are present
+
+    Args
+    ----
+    checkpoint_dir:Path
+        TileCheckpoint directory of the job
+    output:str
+        'dense', 'condensed' or 'sparse'. Defaults to sparse if the
+        job kept only entries >= min_similarity, dense otherwise
+    save_to:Path
+        If provided, dense / condensed outputs are written straight to this .npy
+        file and returned memory-mapped, sparse ones are saved as .npz
+
+    Returns
+    -------
+    S:np.ndarray | CondensedSimilarityMatrix | scipy.sparse.csr_array
 
-    return S.astype(dt)
+    Raises
+    ------
+    RuntimeError
+        If tiles are missing
+    '''
+    checkpoint = TileCheckpoint.open(checkpoint_dir)
+    checkpoint.check_coverage()
+    meta = checkpoint.meta
+    shape, dt, symmetric, row_offset = tuple(meta['shape']), np.dtype(meta['dtype']), meta['symmetric'], meta['row_offset']
+    unit_diagonal = symmetric and meta.get('unit_diagonal', True)
+    min_similarity = meta['min_similarity']
+    output = output or ('sparse' if min_similarity is not None else 'dense')
+    if output == 'condensed' and not unit_diagonal:
+        raise ValueError("Only symmetric outputs w/ unit diagonal can be condensed")
+
+    if output == 'sparse':
+        entries = []
+        for k in tqdm(range(meta['n_tiles'])):
+            pairs, scores = checkpoint.load(k)
+            if min_similarity is not None:
+                keep = scores >= min_similarity
+                pairs, scores = pairs[keep], scores[keep]
+
+            entries.append((pairs[:, 0] - row_offset, pairs[:, 1], scores))
+
+        i, j, scores = (np.concatenate(elt) for elt in zip(*entries)) if entries else (np.zeros(shape=(0,), dtype=int),) * 3
+        if symmetric: # Mirror off-diagonal entries
+            off = i != j
+            i, j, scores = np.concatenate([i, j[off]]), np.concatenate([j, i[off]]), np.concatenate([scores, scores[off]])
+
+        if unit_diagonal:
+            diag = np.arange(shape[0])
+            i, j, scores = np.concatenate([i, diag]), np.concatenate([j, diag]), np.concatenate([scores, np.ones(shape=(shape[0],))])
+
+        S = sp.csr_array((scores, (i, j)), shape=shape).astype(dt)
+        if save_to is not None:
+            Path(save_to).parent.mkdir(parents=True, exist_ok=True)
+            sp.save_npz(save_to, S)
+
+        return S
+
+    path = _npy_path(save_to) if save_to is not None else None
+    if output == 'condensed':
+        S = CondensedSimilarityMatrix.empty(shape[0], dtype=dt, path=path)
+    elif path is not None:
+        S = np.lib.format.open_memmap(path, mode='w+', dtype=dt, shape=shape)
+        S[:] = 0
+    else:
+        S = np.zeros(shape=shape, dtype=dt)
+
+    if output == 'dense' and unit_diagonal:
+        np.fill_diagonal(S, 1)
+
+    for k in tqdm(range(meta['n_tiles'])):
+        pairs, scores = checkpoint.load(k)
+        if output == 'condensed':
+            off = pairs[:, 0] != pairs[:, 1]
+            S.set_pairs(pairs[off, 0], pairs[off, 1], scores[off])
+        else:
+            S[pairs[:, 0] - row_offset, pairs[:, 1]] = scores
+            if symmetric:
+                S[pairs[:, 1], pairs[:, 0]] = scores
+
+    _flush(S)
+    return S
+
+def _unstored_pairs(pairs: Iterable[tuple], store: SimilarityStore, metric: str, keys: list[str], write, stats: Counter, batch_size: int = 2**14):
+    '''
+    Writes scores of pairs found in store w/ write(chunk, scores)
+    and yields the rest
+    '''
+    for chunk in pair_chunks(pairs, batch_size):
+        scores = store.get_many(metric, [keys[i] for i in chunk[:, 0]], [keys[j] for j in chunk[:, 1]])
+        found = ~np.isnan(scores)
+        write(chunk[found], scores[found])
+        stats['stored'] += int(found.sum())
+        for pair in chunk[~found]:
+            yield tuple(pair)
 
 def merge_cd_hit_clusters(
         pairs:Iterable[tuple],
         Drxn,
         sim_i_to_rxn_id:Dict,
         cd_hit_clusters:Dict,
-        distance_cutoff
+        distance_cutoff,
+        tile_entries: int = 2**22
     ):
-    rxn2i = {v: k for k, v in sim_i_to_rxn_id.items()}
-    upid2cluster = {}
-    for cluster, upids in cd_hit_clusters.items():
-        for upid in upids:
-            upid2cluster[upid] = cluster
-    
-    for i in range(len(pairs) - 1):
-        rxn_idx_1 = rxn2i[pairs[i][1]]
-
-        if pairs[i][0] not in upid2cluster:
-            continue
-
-        cluster1 = upid2cluster[pairs[i][0]]
-        
-        for j in range(i + 1, len(pairs)):
-            rxn_idx_2 = rxn2i[pairs[j][1]]
+    '''
+    Merges cd-hit protein clusters of pairs whose reactions are closer than
+    distance_cutoff, incl. pairs of the same reaction. Merged clusters are the
+    connected components of the graph linking clusters to their pairs'
+    reactions and reactions to each other, found w/o visiting pairs of pairs
 
-            if pairs[j][0] not in upid2cluster:
-                continue
+    Args
+    ----
+    pairs:Iterable[tuple]
+        (protein id, reaction id) pairs
+    Drxn:np.ndarray | CondensedSimilarityMatrix | scipy.sparse.sparray
+        Reaction distance matrix, e.g., 1 - S. If sparse, only stored entries
+        can be below distance_cutoff and reactions are at distance 0 from themselves
+    sim_i_to_rxn_id:dict
+        Maps Drxn indices to reaction ids
+    cd_hit_clusters:dict
+        {cluster: protein ids}, e.g., from parse_cd_hit_clusters. Not modified
+    distance_cutoff:float
+    tile_entries:int
+        Entries of Drxn read at a time
 
-            cluster2 = upid2cluster[pairs[j][0]]
+    Returns
+    -------
+    id2cluster:dict
+        {(protein id, reaction id): cluster} for pairs of clustered proteins,
+        merged clusters labeled by their lowest cd-hit cluster
+    '''
+    rxn2i = {v: k for k, v in sim_i_to_rxn_id.items()}
+    upid2cluster = {upid: cluster for cluster, upids in cd_hit_clusters.items() for upid in upids}
+    pairs = [(upid, rxnid) for upid, rxnid in pairs if upid in upid2cluster]
+    if not pairs:
+        return {}
+
+    clusters = sorted(set(upid2cluster[upid] for upid, _ in pairs))
+    cluster2k = {cluster: k for k, cluster in enumerate(clusters)}
+    pair_clusters = np.array([cluster2k[upid2cluster[upid]] for upid, _ in pairs])
+    rxn_idxs, pair_rxns = np.unique([rxn2i[rxnid] for _, rxnid in pairs], return_inverse=True)
+
+    # Reactions closer than distance_cutoff, numbered as in rxn_idxs
+    if sp.issparse(Drxn):
+        D = sp.coo_array(sp.csr_array(Drxn)[rxn_idxs][:, rxn_idxs])
+        close = (D.data < distance_cutoff) & (D.row != D.col)
+        a, b = D.row[close], D.col[close]
+        self_close = np.full(shape=(len(rxn_idxs),), fill_value=0 < distance_cutoff)
+    else:
+        a, b, self_close = [], [], []
+        for start, end in row_tiles(len(rxn_idxs), Drxn.shape[1], tile_entries):
+            block = np.asarray(Drxn[rxn_idxs[start:end]])[:, rxn_idxs]
+            rows, cols = np.nonzero(block < distance_cutoff)
+            a.append(rows[rows + start != cols] + start)
+            b.append(cols[rows + start != cols])
+            self_close.append(block[np.arange(end - start), np.arange(start, end)] < distance_cutoff)
+
+        a, b, self_close = (np.concatenate(elt) for elt in (a, b, self_close))
+
+    # A reaction w/ a close reaction or at distance < cutoff from itself merges its pairs' clusters
+    linked = self_close | (np.bincount(a, minlength=len(rxn_idxs)) > 0)
+    k, n_clusters = np.flatnonzero(linked[pair_rxns]), len(clusters)
+    graph = sp.csr_array(
+        (
+            np.ones(shape=(len(k) + len(a),)),
+            (np.concatenate([pair_clusters[k], n_clusters + a]), np.concatenate([n_clusters + pair_rxns[k], n_clusters + b]))
+        ),
+        shape=(n_clusters + len(rxn_idxs),) * 2
+    )
+    _, components = connected_components(graph, directed=False)
+    lowest = np.full(shape=(components.max() + 1,), fill_value=n_clusters)
+    np.minimum.at(lowest, components[:n_clusters], np.arange(n_clusters))
+    merged = lowest[components[pair_clusters]]
 
-            if Drxn[rxn_idx_1, rxn_idx_2] < distance_cutoff and cluster1 != cluster2:
-                cd_hit_clusters[cluster1] = cd_hit_clusters[cluster1] + cd_hit_clusters[cluster2]
-                for upid in cd_hit_clusters[cluster2]:
-                    upid2cluster[upid] = cluster1
-                cd_hit_clusters.pop(cluster2)
-    
-    id2cluster = {}
-    for upid, rxnid in pairs:
-        if upid in upid2cluster:
-            id2cluster[(upid, rxnid)] = upid2cluster[upid]
+    return {pair: clusters[m] for pair, m in zip(pairs, merged)}
 
-    return id2cluster
-  
 def combo_similarity_matrix(pairs, Sseq, Srxn, idx2seq, idx2rxn):
     seq2idx = {v: k for k, v in idx2seq.items()}
     rxn2idx = {v: k for k, v in idx2rxn.items()}
@@ -313,28 +1486,141 @@ def global_sequence_identity(seq1:str, seq2:str, aligner:Align.PairwiseAligner):
     alignment = aligner.align(seq1, seq2)[0]
     t_segments, q_segments = alignment.aligned
 
-    talign = ''
-    qalign = ''
-    for i in range(t_segments.shape[0]):
-        talign += alignment.target[t_segments[i, 0] : t_segments[i, 1]]
-        qalign += alignment.query[q_segments[i, 0] : q_segments[i, 1]]
-
+    # Compare each gapless segment as arrays rather than char by char
+    target, query = _encode_sequence(alignment.target), _encode_sequence(alignment.query)
     ct = 0
-    for t, q in zip(talign, qalign):
-        if t == q:
-            ct += 1
+    for (t_start, t_end), (q_start, q_end) in zip(t_segments.tolist(), q_segments.tolist()):
+        ct += int(np.count_nonzero(target[t_start:t_end] == query[q_start:q_end]))
     
     return ct / min(len(alignment.target), len(alignment.query))
 
+def kmer_features(sequences: Iterable[str], k: int) -> sp.csr_array:
+    '''
+    Binary sequence x feature matrix where features are (k-mer, occurrence #),
+    so the dot product of two rows is their multiset k-mer intersection
+    size, sum over k-mers of min(count 1, count 2)
+
+    Args
+    ----
+    sequences:Iterable[str]
+        Amino acid sequences indexed by matrix index
+    k:int
+        k-mer length
+
+    Returns
+    -------
+    F:scipy.sparse.csr_array
+        (# sequences x # features) of int32
+    '''
+    feature_idx = {}
+    indptr, indices = [0], []
+    for seq in sequences:
+        seen = Counter()
+        for start in range(len(seq) - k + 1):
+            kmer = seq[start:start + k]
+            feature = (kmer, seen[kmer])
+            seen[kmer] += 1
+            indices.append(feature_idx.setdefault(feature, len(feature_idx)))
+
+        indptr.append(len(indices))
+
+    return sp.csr_array((np.ones(shape=(len(indices),), dtype=np.int32), indices, indptr), shape=(len(indptr) - 1, len(feature_idx)))
+
+def kmer_identity_bounds(pairs: np.ndarray, F: sp.csr_array, lengths: np.ndarray, k: int, max_gap_opens: int = 1) -> np.ndarray:
+    '''
+    Upper bound on the global_sequence_identity of each pair from their
+    shared k-mers. An alignment w/ M identical columns, at most
+    min length - M mismatches and at most max_gap_opens gap blocks splits
+    the identical columns into at most min length - M + max_gap_opens + 1
+    gapless runs, each of which contributes all of its k-mers, so
+
+        shared >= M - (k - 1) * (min length - M + max_gap_opens + 1)
+
+    and M <= (shared + (k - 1) * (min length + max_gap_opens + 1)) / k
+
+    Args
+    ----
+    pairs:np.ndarray
+        (m x 3) array of (i, j, flip)
+    F:scipy.sparse.csr_array
+        From kmer_features
+    lengths:np.ndarray
+        Sequence lengths
+    k:int
+        k-mer length F was built w/
+    max_gap_opens:int
+        Most gap blocks an alignment can have. Opening a gap costs -1e6 w/ the
+        gsi aligner, so it never opens more than the one a length difference needs
+
+    Returns
+    -------
+    bounds:np.ndarray
+    '''
+    i, j = pairs[:, 0], pairs[:, 1]
+    shared = np.asarray((F[i].multiply(F[j])).sum(axis=1)).ravel()
+    min_len = np.minimum(lengths[i], lengths[j])
+    max_identical = (shared + (k - 1) * (min_len + max_gap_opens + 1)) / k
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(min_len > 0, np.minimum(max_identical / min_len, 1), 1)
+
+def kmer_pair_bound(sequences:Dict[str, str], min_similarity: float, kmer_size: int = None) -> Callable:
+    '''
+    Indexes the k-mers of sequences once and returns the identity upper bound
+    of pairs of them, see kmer_identity_bounds, for homology_similarity_matrix
+
+    Args
+    ----
+    sequences:Dict[str, str]
+        {id: amino acid sequence}
+    min_similarity:float
+        Identity the bound is used to prune below
+    kmer_size:int
+        k-mer length, defaults to kmer_size_for_identity(min_similarity)
+    '''
+    if min_similarity is None:
+        raise ValueError("kmer_prefilter requires min_similarity")
+
+    k = kmer_size or kmer_size_for_identity(min_similarity)
+    print(f"Indexing {k}-mers\n")
+    return partial(
+        kmer_identity_bounds,
+        F=kmer_features(sequences.values(), k),
+        lengths=np.array([len(seq) for seq in sequences.values()]),
+        k=k
+    )
+
+def kmer_size_for_identity(min_identity: float, max_k: int = 5) -> int:
+    '''
+    Longest k-mer for which kmer_identity_bounds can still fall
+    below min_identity, i.e., k < 1 / (1 - min_identity)
+    '''
+    if min_identity >= 1:
+        return max_k
+
+    return int(np.clip(np.ceil(1 / (1 - min_identity) - 1e-9) - 1, 1, max_k))
+
+def _encode_sequence(seq: str) -> np.ndarray:
+    '''
+    One fixed-width code per character, so positions index the array directly
+    '''
+    return np.frombuffer(seq.encode('utf-32-le'), dtype=np.uint32)
+
 def blosum_similarity(seq1:str, seq2:str, aligner:Align.PairwiseAligner):
-    if any(c not in aligner.alphabet for c in seq1 + seq2):
+    if not all(in_aligner_alphabet([seq1, seq2], aligner)):
         print("Encountered characters not in aligner alphabet. Returning -1e6 score")
         return -1e6
     
-    alignment = aligner.align(seq1, seq2)
-    return alignment.score
+    return aligner.score(seq1, seq2) # Score only, no alignment object / traceback
 
-def blosum_similarity_matrix(sequences:Dict[str, str], start: int, end: int, aligner:Align.PairwiseAligner):
+def in_aligner_alphabet(sequences: Iterable[str], aligner:Align.PairwiseAligner) -> np.ndarray:
+    '''
+    Whether each sequence only has characters in the aligner's alphabet
+    '''
+    alphabet = set(aligner.alphabet)
+    return np.array([set(seq) <= alphabet for seq in sequences], dtype=bool)
+
+def blosum_similarity_matrix(sequences:Dict[str, str], start: int, end: int, aligner:Align.PairwiseAligner, checkpoint_dir: Path = None, min_similarity: float = None):
     '''
     With multiprocessing, Computes blosum 
     similarity matrix for set of amino acid sequences
@@ -345,35 +1631,23 @@ def blosum_similarity_matrix(sequences:Dict[str, str], start: int, end: int, ali
         {id: amino acid sequence}
     aligner:Bio.Align.PairwiseAligner
         Pairwise aligner object
+    checkpoint_dir:Path
+        If provided, completed tiles of pairs are saved here and an
+        interrupted run resumes from them, see TileCheckpoint
+    min_similarity:float
+        If provided, only entries >= min_similarity are kept
     
     Returns
     -------
     S:scipy.sparse.csr_array
         chunk_size x n sparse array
     '''
-    sim_i_to_id = {i : id for i, id in enumerate(sequences.keys())}
-
-    to_do = []
-    S_idxs = []
-    print("Preparing reaction pairs\n")
-    for i in range(start, min(end, len(sim_i_to_id) - 1)):
-        seq1 = sequences[sim_i_to_id[i]]
-        print(f"Sequence # {i} : {sim_i_to_id[i]}", end='\r')
-        for j in range(i + 1, len(sim_i_to_id)):
-            seq2 = sequences[sim_i_to_id[j]]
-            S_idxs.append((i, j))
-            to_do.append((seq1, seq2, aligner))
-
-    print("\nProcessing pairs\n")    
-    with mp.Pool() as pool:
-        res = list(tqdm(pool.imap(wrap_blosum, to_do), total=len(to_do)))
-    
-    row_idxs, col_idxs = zip(*S_idxs)
-    S_chunk = sp.csr_array((res, (row_idxs, col_idxs))).astype(np.float16)
-
-    return S_chunk
+    return _sequence_similarity_chunk(_blosum_pair, sequences, start, end, aligner, checkpoint_dir, min_similarity, validate_alphabet=True)
 
-def homology_similarity_matrix(sequences:Dict[str, str], start: int, end: int, aligner:Align.PairwiseAligner):
+def homology_similarity_matrix(
+        sequences:Dict[str, str], start: int, end: int, aligner:Align.PairwiseAligner, checkpoint_dir: Path = None,
+        min_similarity: float = None, kmer_prefilter: bool = False, kmer_size: int = None, pair_bound: Callable = None
+    ):
     '''
     With multiprocessing, Computes global sequence identity 
     similarity matrix for set of amino acid sequences
@@ -384,35 +1658,79 @@ def homology_similarity_matrix(sequences:Dict[str, str], start: int, end: int, a
         {id: amino acid sequence}
     aligner:Bio.Align.PairwiseAligner
         Pairwise aligner object
+    checkpoint_dir:Path
+        If provided, completed tiles of pairs are saved here and an
+        interrupted run resumes from them, see TileCheckpoint
+    min_similarity:float
+        If provided, only entries >= min_similarity are kept
+    kmer_prefilter:bool
+        Skips aligning pairs whose shared k-mers bound their identity below
+        min_similarity, see kmer_identity_bounds. Assumes alignments w/ at most
+        one gap block, as w/ the open_gap_score=-1e6 aligner of scripts/similarity_matrix.py
+    kmer_size:int
+        k-mer length for kmer_prefilter, defaults to kmer_size_for_identity(min_similarity)
+    pair_bound:Callable
+        Prebuilt kmer_pair_bound of sequences, e.g., shared by every chunk of a
+        matrix so the k-mer index is built once. Used instead of kmer_prefilter
     
     Returns
     -------
     S:scipy.sparse.csr_array
         chunk_size x n sparse array
     '''
-    sim_i_to_id = {i : id for i, id in enumerate(sequences.keys())}
+    if kmer_prefilter and pair_bound is None:
+        pair_bound = kmer_pair_bound(sequences, min_similarity, kmer_size)
 
-    to_do = []
-    S_idxs = []
-    print("Preparing reaction pairs\n")
-    for i in range(start, min(end, len(sim_i_to_id) - 1)):
-        seq1 = sequences[sim_i_to_id[i]]
-        print(f"Sequence # {i} : {sim_i_to_id[i]}", end='\r')
-        for j in range(i + 1, len(sim_i_to_id)):
-            seq2 = sequences[sim_i_to_id[j]]
-            S_idxs.append((i, j))
-            to_do.append((seq1, seq2, aligner))
+    if pair_bound is not None and min_similarity is None:
+        raise ValueError("Pruning by a pair bound requires min_similarity")
 
-    print("\nProcessing pairs\n")    
-    with mp.Pool() as pool:
-        res = list(tqdm(pool.imap(wrap_gsi, to_do), total=len(to_do)))
-    
-    row_idxs, col_idxs = zip(*S_idxs)
-    S_chunk = sp.csr_array((res, (row_idxs, col_idxs))).astype(np.float16)
+    return _sequence_similarity_chunk(_gsi_pair, sequences, start, end, aligner, checkpoint_dir, min_similarity, pair_bound=pair_bound)
+
+def _sequence_similarity_chunk(
+        scorer, sequences:Dict[str, str], start: int, end: int, aligner:Align.PairwiseAligner, checkpoint_dir: Path = None,
+        min_similarity: float = None, validate_alphabet: bool = False, pair_bound: Callable = None
+    ):
+    '''
+    Scores upper-triangular pairs in rows [start, end) and returns
+    them as a csr_array indexed by global row / col. Sequences and aligner
+    are installed once per worker and tasks only carry indices. If
+    validate_alphabet, sequences w/ characters outside the aligner's
+    alphabet are found once here and their pairs score -1e6. pair_bound
+    is passed on to streamed_similarity_matrix
+    '''
+    n = len(sequences)
+    row_end = min(end, n - 1)
+    context = {'sequences': list(sequences.values()), 'aligner': aligner}
+    if validate_alphabet:
+        context['in_alphabet'] = in_aligner_alphabet(context['sequences'], aligner)
+        for id in np.array(list(sequences.keys()))[~context['in_alphabet']]:
+            print(f"Encountered characters not in aligner alphabet in {id}. Its pairs score -1e6")
+
+    print("Processing pairs\n")
+    S_rows = streamed_similarity_matrix(
+        scorer=scorer,
+        context=context,
+        pairs=upper_triangle_pairs(start, row_end, n),
+        shape=(max(row_end - start, 0), n),
+        dt=np.float16,
+        n_pairs=sum(n - 1 - i for i in range(start, row_end)),
+        symmetric=False,
+        row_offset=start,
+        checkpoint_dir=checkpoint_dir,
+        pair_bound=pair_bound,
+        min_similarity=min_similarity
+    )
+
+    if min_similarity is not None: # Already sparse, only shift rows to global index
+        S_rows = S_rows.tocoo()
+        return sp.csr_array((S_rows.data, (S_rows.row + start, S_rows.col)), shape=(max(row_end, 0), n)).astype(np.float16)
+
+    row_idxs, col_idxs = np.nonzero(np.arange(n)[None, :] > np.arange(start, row_end)[:, None])
+    S_chunk = sp.csr_array((S_rows[row_idxs, col_idxs], (row_idxs + start, col_idxs)), shape=(row_end, n)).astype(np.float16)
 
     return S_chunk
 
-def molecule_mcs_similarity(molecules: Iterable[Mol], reaction_centers: Iterable[tuple[int]] = None, patt:str = None, norm: str='max', return_match_patt: bool = False):
+def molecule_mcs_similarity(molecules: Iterable[Mol], reaction_centers: Iterable[tuple[int]] = None, patt:str = None, norm: str='max', return_match_patt: bool = False, rc_labeled: bool = False):
     '''
     Calculates MCS similarity score for a pair of molecules. If reaction_centers and patt
     are provided, reaction center MCS score will be provided, otherwise a straight MCS score is provided.
@@ -428,6 +1746,9 @@ def molecule_mcs_similarity(molecules: Iterable[Mol], reaction_centers: Iterable
     norm:str
         'min' normalizes by # atoms in smallest molecule, 'max' the largest
     return_match_patt: bool
+    rc_labeled: bool
+        Molecules are already marked w/ label_reaction_center, e.g., cached templates.
+        Otherwise labeled copies are made; input molecules are never modified
     
     Returns
     -------
@@ -447,22 +1768,11 @@ def molecule_mcs_similarity(molecules: Iterable[Mol], reaction_centers: Iterable
         raise ValueError("Mismatch in number of molecules and reaction centers provided")
 
     if mode == 'rcmcs':
-        rc_scalar = 100
-
-        def replace(match):
-            atomic_number = int(match.group(1))
-            return f"[{atomic_number * rc_scalar}#{atomic_number}"
-        
-        atomic_sub_patt = r'\[#(\d+)'
-        patt = re.sub(atomic_sub_patt, replace, patt) # Mark reaction center patt w/ isotope number
+        patt = label_reaction_center_patt(patt) # Mark reaction center patt w/ isotope number
 
         # Mark reaction center vs other atoms in substrates w/ isotope number
-        for mol, rc in zip(molecules, reaction_centers):
-            for atom in mol.GetAtoms():
-                if atom.GetIdx() in rc:
-                    atom.SetIsotope(atom.GetAtomicNum() * rc_scalar) # Rxn ctr atom
-                else:
-                    atom.SetIsotope(atom.GetAtomicNum()) # Non rxn ctr atom
+        if not rc_labeled:
+            molecules = [label_reaction_center(mol, rc) for mol, rc in zip(molecules, reaction_centers)]
 
         cleared, patt = _mcs_precheck(molecules, reaction_centers, patt) # Prevents FindMCS default behavior of non-rc-mcs
 
@@ -549,14 +1859,52 @@ def reaction_mcs_similarity(
     if mode == 'rcmcs':
         reaction_centers = zip(*reaction_centers) # Transpose to list of rc pairs
 
+    return aligned_mcs_similarity(molecules, reaction_centers, patts, norm=norm)
+
+def aligned_mcs_similarity(
+        molecule_pairs: Iterable[tuple[Mol]], reaction_center_pairs: Iterable[tuple[tuple[int]]] = None, patts: Iterable[str] = None,
+        norm: str = 'max', rc_labeled: bool = False, memo: 'MCSMemo' = None, molecule_key_pairs: Iterable[tuple] = None
+    ):
+    '''
+    Atom-weighted MCS similarity over already aligned molecule pairs, the core
+    of reaction_mcs_similarity
+
+    Args
+    ----
+    molecule_pairs: Iterable[tuple[Mol]]
+        Aligned molecule pairs
+    reaction_center_pairs: Iterable[tuple[tuple[int]]]
+        Reaction centers of each molecule pair, RCMCS only
+    patts: Iterable[str]
+        Reaction center SMARTS of each molecule pair, RCMCS only
+    norm: str
+        Normalize by 'max' or 'min' number of atoms of compare molecules
+    rc_labeled: bool
+        Molecules are already marked w/ label_reaction_center
+    memo: MCSMemo
+        If provided, molecule pair scores are looked up / stored here
+    molecule_key_pairs: Iterable[tuple]
+        mcs_memo_key of each molecule pair, required w/ memo
+    '''
     cum_atoms = 0
     cum_score = 0
-    if mode == 'rcmcs':
-        iterargs = zip(molecules, reaction_centers, patts)
-    elif mode == 'mcs':
-        iterargs = ((elt, ) for elt in molecules)
+    if patts is not None:
+        iterargs = zip(molecule_pairs, reaction_center_pairs, patts)
+    else:
+        iterargs = ((elt, ) for elt in molecule_pairs)
+
+    if memo is not None:
+        molecule_key_pairs = iter(molecule_key_pairs)
+
     for args in iterargs:
-        score = molecule_mcs_similarity(*args, norm=norm)
+        if memo is not None:
+            key = (*sorted(next(molecule_key_pairs)), args[2] if len(args) > 1 else '', norm) # Order-normalized
+            score = memo.get(key)
+            if score is None:
+                score = molecule_mcs_similarity(*args, norm=norm, rc_labeled=rc_labeled)
+                memo.set(key, score)
+        else:
+            score = molecule_mcs_similarity(*args, norm=norm, rc_labeled=rc_labeled)
 
         if norm == 'max':
             n_atoms = max([m.GetNumAtoms() for m in args[0]])
@@ -602,6 +1950,149 @@ def reaction_tanimoto_similarity(reactions: Iterable[str], norm: str = 'max', an
 
     return cum_score / cum_atoms
 
+def reaction_fingerprints(reactions: Iterable[str], radius: int = 2, length: int = 2**10):
+    '''
+    Parses and Morgan-fingerprints every molecule of every
+    reaction exactly once
+
+    Args
+    ----
+    reactions:Iterable[str]
+        Reaction smarts 'rsmi1.rsmi2>psmi1.psmi2'
+    
+    Returns
+    -------
+    fps:np.ndarray
+        (# molecules x length / 64) bit-packed fingerprints (see pack_fingerprints),
+        molecules of a reaction stored contiguously from left to right
+    n_atoms:np.ndarray
+        Number of atoms in each molecule
+    offsets:np.ndarray
+        Row of fps where each reaction's molecules start, plus a final
+        entry for the total number of molecules
+    n_left:np.ndarray
+        Number of reactants of each reaction
+    '''
+    fps, n_atoms, offsets, n_left = [], [], [0], []
+    for rxn in reactions:
+        smiles = fractionate(rxn)
+        for smi in smiles:
+            mol = Chem.MolFromSmiles(smi)
+            fps.append(morgan_fingerprint(mol, radius=radius, length=length) > 0)
+            n_atoms.append(mol.GetNumAtoms())
+        
+        offsets.append(offsets[-1] + len(smiles))
+        n_left.append(len(rxn.split('>>')[0].split('.')))
+
+    fps = pack_fingerprints(np.vstack(fps) if fps else np.zeros(shape=(0, length), dtype=bool))
+
+    return fps, np.array(n_atoms), np.array(offsets), np.array(n_left)
+
+def aligned_molecule_pairs(i: np.ndarray, j: np.ndarray, flip: np.ndarray, offsets: np.ndarray, n_left: np.ndarray, analyze_sides: str = 'both'):
+    '''
+    Expands reaction pairs into their aligned molecule pairs the same way
+    reaction_*_similarity zips fractionated reactions, where reaction j is
+    read right to left when flip is True
+
+    Args
+    ----
+    i, j:np.ndarray
+        Reaction indices into offsets / n_left
+    flip:np.ndarray
+        Whether to reverse reaction j
+    offsets, n_left:np.ndarray
+        As returned by reaction_fingerprints
+    analyze_sides:str
+        'left' or 'both'
+    
+    Returns
+    -------
+    pair_idx:np.ndarray
+        Position in i, j of the reaction pair each molecule pair belongs to
+    a, b:np.ndarray
+        Molecule indices of reaction i and reaction j
+    '''
+    n_mols = np.diff(offsets)
+    n_right = n_mols - n_left
+
+    if analyze_sides == 'left':
+        len_i = n_left[i]
+        len_j = np.where(flip, n_right[j], n_left[j])
+    elif analyze_sides == 'both':
+        len_i = n_mols[i]
+        len_j = n_mols[j]
+
+    m = np.minimum(len_i, len_j)
+    pair_idx = np.repeat(np.arange(len(m)), m)
+    k = np.arange(m.sum()) - np.repeat(np.cumsum(m) - m, m) # Position of molecule within reaction
+
+    jflip, jleft, jright = flip[pair_idx], n_left[j][pair_idx], n_right[j][pair_idx]
+    a = offsets[i][pair_idx] + k
+    b = offsets[j][pair_idx] + np.where(jflip, np.where(k < jright, jleft + k, k - jright), k)
+
+    return pair_idx, a, b
+
+def aligned_tanimoto_similarity(
+        i: np.ndarray, j: np.ndarray, flip: np.ndarray, fps: np.ndarray, n_atoms: np.ndarray, offsets: np.ndarray, n_left: np.ndarray,
+        norm: str = 'max', analyze_sides: str = 'both'
+    ):
+    '''
+    Atom-weighted, substrate-aligned tanimoto similarity for a batch of reaction
+    pairs, equivalent to reaction_tanimoto_similarity on each pair
+
+    Args
+    ----
+    i, j:np.ndarray
+        Reaction indices
+    flip:np.ndarray
+        Whether to reverse reaction j
+    fps, n_atoms, offsets, n_left:np.ndarray
+        As returned by reaction_fingerprints
+    norm:str
+        Weight molecule pairs by 'max' or 'min' number of atoms
+    analyze_sides:str
+        'left' or 'both'
+    
+    Returns
+    -------
+    scores:np.ndarray
+    '''
+    pair_idx, a, b = aligned_molecule_pairs(i, j, flip, offsets, n_left, analyze_sides=analyze_sides)
+
+    n_on = popcount(fps).sum(axis=1)
+    dot = popcount(fps[a] & fps[b]).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mol_scores = (dot / (n_on[a] + n_on[b] - dot)).astype(np.float32)
+
+    if norm == 'max':
+        weights = np.maximum(n_atoms[a], n_atoms[b])
+    elif norm == 'min':
+        weights = np.minimum(n_atoms[a], n_atoms[b])
+
+    cum_score = np.bincount(pair_idx, weights=mol_scores * weights, minlength=len(i))
+    cum_atoms = np.bincount(pair_idx, weights=weights, minlength=len(i))
+
+    return cum_score / cum_atoms
+
+def reaction_difference_vectors(reactions: Iterable[str], radius: int = 2, length: int = 2**10, batch_size: int = 2**14) -> np.ndarray:
+    '''
+    Returns (# reactions x length) matrix of abs(rct_mfp_sum - pdt_mfp_sum),
+    the un-normalized vectors compared in agg_mfp_cosine_similarity
+    '''
+    fps, _, offsets, n_left = reaction_fingerprints(reactions, radius=radius, length=length)
+    n_mols = np.diff(offsets)
+    rxn_of_mol = np.repeat(np.arange(len(n_mols)), n_mols)
+    signs = np.where(np.arange(fps.shape[0]) - offsets[rxn_of_mol] < n_left[rxn_of_mol], -1.0, 1.0).astype(np.float32)
+    M = sp.csr_array((signs, (rxn_of_mol, np.arange(fps.shape[0]))), shape=(len(n_mols), fps.shape[0]))
+
+    X = np.zeros(shape=(len(n_mols), length), dtype=np.float32)
+    for start in range(0, fps.shape[0], batch_size):
+        batch = slice(start, start + batch_size)
+        bits = np.unpackbits(fps[batch].view(np.uint8), axis=1, bitorder='little')[:, :length]
+        X += M[:, batch] @ bits.astype(np.float32)
+
+    return np.abs(X)
+
 def agg_mfp_cosine_similarity(reactions: Iterable[str]) -> float:
     '''
     Computes cosine similarity between abs(rct_mfp_sum - pdt_mfp_sum)
@@ -663,6 +2154,63 @@ def tanimoto_similarity(bit_vec_1: np.ndarray, bit_vec_2: np.ndarray, dtype=np.f
     dot = np.dot(bit_vec_1, bit_vec_2)
     return dtype(dot / (bit_vec_1.sum() + bit_vec_2.sum() - dot))
 
+def pack_fingerprints(fps: np.ndarray) -> np.ndarray:
+    '''
+    Packs (n x length) binary fingerprints into (n x length / 64)
+    uint64 words, one bit per fingerprint bit
+    '''
+    packed = np.packbits(np.asarray(fps) > 0, axis=1, bitorder='little')
+    pad = -packed.shape[1] % 8
+    if pad:
+        packed = np.pad(packed, ((0, 0), (0, pad)))
+
+    return np.ascontiguousarray(packed).view(np.uint64)
+
+def popcount(x: np.ndarray) -> np.ndarray:
+    '''
+    Elementwise number of set bits of a uint64 array
+    '''
+    if hasattr(np, 'bitwise_count'): # numpy >= 2.0
+        return np.bitwise_count(x)
+
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return (x * np.uint64(0x0101010101010101)) >> np.uint64(56)
+
+def tanimoto_similarity_block(A: np.ndarray, B: np.ndarray = None, block_size: int = 256, dtype=np.float32):
+    '''
+    Tanimoto similarity of every row of A against every row of B
+    for bit-packed fingerprints, evaluated row-block x column-block
+
+    Args
+    ----
+    A:np.ndarray
+        (n x words) packed fingerprints, e.g., queries
+    B:np.ndarray
+        (m x words) packed fingerprints, e.g., corpus. Defaults to A
+    block_size:int
+        Rows / cols per block
+    
+    Returns
+    -------
+    S:np.ndarray
+        n x m similarity matrix
+    '''
+    B = A if B is None else B
+    n_on_A = popcount(A).sum(axis=1)
+    n_on_B = popcount(B).sum(axis=1)
+    S = np.empty(shape=(A.shape[0], B.shape[0]), dtype=dtype)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for r in range(0, A.shape[0], block_size):
+            rows = slice(r, r + block_size)
+            for c in range(0, B.shape[0], block_size):
+                cols = slice(c, c + block_size)
+                dot = popcount(A[rows, None, :] & B[None, cols, :]).sum(axis=2)
+                S[rows, cols] = dot / (n_on_A[rows, None] + n_on_B[None, cols] - dot)
+
+    return S
+
 def morgan_fingerprint(mol: Mol, radius: int = 2, length: int = 2**10, use_features: bool = False, use_chirality: bool = False):
     vec = AllChem.GetMorganFingerprintAsBitVect(
         mol,
@@ -673,6 +2221,77 @@ def morgan_fingerprint(mol: Mol, radius: int = 2, length: int = 2**10, use_featu
     )
     return np.array(vec, dtype=np.float32)
 
+def label_reaction_center(mol: Mol, reaction_center: Iterable[int], rc_scalar: int = 100) -> Mol:
+    '''
+    Returns a copy of mol w/ reaction center atoms marked by isotope
+    atomic number * rc_scalar and all other atoms by atomic number
+    '''
+    mol = Chem.Mol(mol)
+    for atom in mol.GetAtoms():
+        if atom.GetIdx() in reaction_center:
+            atom.SetIsotope(atom.GetAtomicNum() * rc_scalar) # Rxn ctr atom
+        else:
+            atom.SetIsotope(atom.GetAtomicNum()) # Non rxn ctr atom
+
+    return mol
+
+@lru_cache(maxsize=None)
+def label_reaction_center_patt(patt: str, rc_scalar: int = 100) -> str:
+    '''
+    Marks atoms of a reaction center SMARTS pattern w/ isotope
+    number atomic number * rc_scalar to match label_reaction_center
+    '''
+    def replace(match):
+        atomic_number = int(match.group(1))
+        return f"[{atomic_number * rc_scalar}#{atomic_number}"
+    
+    atomic_sub_patt = r'\[#(\d+)'
+    return re.sub(atomic_sub_patt, replace, patt)
+
+def mcs_memo_key(mol: Mol, reaction_center: Iterable[int] = None) -> tuple:
+    '''
+    Key identifying a molecule in an MCS problem: canonical SMILES (which
+    carries reaction center isotope labels, if any) and the canonical ranks
+    of its reaction center atoms, in reaction center order
+    '''
+    smiles = Chem.MolToSmiles(mol)
+    if reaction_center is None:
+        return (smiles, ())
+    
+    ranks = list(Chem.CanonicalRankAtoms(mol))
+    return (smiles, tuple(ranks[aidx] for aidx in reaction_center))
+
+class MCSMemo:
+    '''
+    Memo of molecule_mcs_similarity scores keyed by both molecules' mcs_memo_key
+    (order-normalized), seed pattern and norm. A process-local dict sits in front
+    of an optional dict shared across processes, e.g., multiprocessing.Manager().dict()
+    '''
+    def __init__(self, shared: dict = None):
+        self.local = {}
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple) -> float:
+        score = self.local.get(key)
+        if score is None and self.shared is not None:
+            score = self.shared.get(key)
+            if score is not None:
+                self.local[key] = score
+
+        if score is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return score
+
+    def set(self, key: tuple, score: float):
+        self.local[key] = score
+        if self.shared is not None:
+            self.shared[key] = score
+
 def _mcs_precheck(molecules: Iterable[Mol], reaction_centers: Iterable[tuple[int]], patt:str):
     '''
     Modifies single-atom patts and pre-checks ring info
@@ -740,32 +2359,229 @@ def wrap_gsi(args):
 def wrap_blosum(args):
     return blosum_similarity(*args)
 
-def _wrap_rxn_mcs(args):
-    return reaction_mcs_similarity(*args)
+def _init_similarity_worker(scorer, context: dict):
+    '''
+    Pool initializer. Installs pair inputs once per worker
+    '''
+    _worker_state.clear()
+    _worker_state.update(context)
+    _worker_state['scorer'] = scorer
+    if 'mcs_memo' in context:
+        _worker_state['memo'] = MCSMemo(shared=context['mcs_memo'])
+
+def _score_pair_chunk(chunk: np.ndarray) -> tuple[Counter, np.ndarray]:
+    '''
+    Scores a chunk of pairs. Returns counts of pairs, seconds spent and,
+    if memoizing, MCS memo hits / misses, along w/ the scores
+    '''
+    tic = perf_counter()
+    scorer = _worker_state['scorer']
+    memo = _worker_state.get('memo')
+    hits, misses = (memo.hits, memo.misses) if memo else (0, 0)
+    scores = np.array([scorer(i, j, flip) for i, j, flip in chunk], dtype=np.float64)
+
+    stats = Counter(pairs=len(chunk), busy=perf_counter() - tic)
+    if memo:
+        stats.update(mcs_hits=memo.hits - hits, mcs_misses=memo.misses - misses)
+
+    return stats, scores
+
+def _mcs_pair(i: int, j: int, flip: bool) -> float:
+    sides_j = (1, 0) if flip else (0, 1)
+    mols_i = chain(*(_worker_molecules(i, side) for side in (0, 1)))
+    mols_j = chain(*(_worker_molecules(j, side) for side in sides_j))
+    memo, keys = _worker_memo_keys(i, j, sides_j, rc_labeled=False)
+    return aligned_mcs_similarity(zip(mols_i, mols_j), memo=memo, molecule_key_pairs=keys)
+
+def _rcmcs_pair(i: int, j: int, flip: bool) -> float:
+    rcs = _worker_state['rcs']
+    sides_j = (1, 0) if flip else (0, 1)
+    mols_i = chain(*(_worker_molecules(i, side, rc_labeled=True) for side in (0, 1)))
+    mols_j = chain(*(_worker_molecules(j, side, rc_labeled=True) for side in sides_j))
+    rcs_i = chain(*rcs[i])
+    rcs_j = chain(*(rcs[j][side] for side in sides_j))
+    patts = chain(*_worker_state['patts'][_worker_state['rule_keys'][i]])
+    memo, keys = _worker_memo_keys(i, j, sides_j, rc_labeled=True)
+    return aligned_mcs_similarity(zip(mols_i, mols_j), zip(rcs_i, rcs_j), patts, rc_labeled=True, memo=memo, molecule_key_pairs=keys)
+
+def _worker_molecules(i: int, side: int, rc_labeled: bool = False) -> tuple[Mol]:
+    '''
+    Parsed molecules of one side of reaction i, RC-labeled templates if rc_labeled.
+    Cached for the lifetime of the worker; callers must not modify them
+    '''
+    cache = _worker_state.setdefault('molecules', {})
+    key = (i, side, rc_labeled)
+    if key not in cache:
+        mols = [Chem.MolFromSmiles(smi) for smi in _worker_state['smarts'][i].split('>>')[side].split('.')]
+        if rc_labeled:
+            mols = [label_reaction_center(mol, rc) for mol, rc in zip(mols, _worker_state['rcs'][i][side])]
+
+        cache[key] = tuple(mols)
+
+    return cache[key]
+
+def _worker_memo_keys(i: int, j: int, sides_j: tuple[int], rc_labeled: bool):
+    '''
+    Returns the worker's MCSMemo, if any, and mcs_memo_key pairs of the
+    aligned molecules of reactions i and j. Keys are cached like molecules
+    '''
+    memo = _worker_state.get('memo')
+    if memo is None:
+        return None, None
+
+    cache = _worker_state.setdefault('molecule_keys', {})
+    for rxn, side in [(i, 0), (i, 1), (j, 0), (j, 1)]:
+        key = (rxn, side, rc_labeled)
+        if key not in cache:
+            rcs = _worker_state['rcs'][rxn][side] if rc_labeled else repeat(None)
+            cache[key] = tuple(mcs_memo_key(mol, rc) for mol, rc in zip(_worker_molecules(rxn, side, rc_labeled), rcs))
+
+    keys_i = chain(cache[(i, 0, rc_labeled)], cache[(i, 1, rc_labeled)])
+    keys_j = chain(*(cache[(j, side, rc_labeled)] for side in sides_j))
+    return memo, zip(keys_i, keys_j)
+
+def _gsi_pair(i: int, j: int, flip: bool) -> float:
+    sequences = _worker_state['sequences']
+    return global_sequence_identity(sequences[i], sequences[j], _worker_state['aligner'])
+
+def _blosum_pair(i: int, j: int, flip: bool) -> float:
+    sequences = _worker_state['sequences']
+    if not (_worker_state['in_alphabet'][i] and _worker_state['in_alphabet'][j]): # See _sequence_similarity_chunk
+        return -1e6
+
+    return _worker_state['aligner'].score(sequences[i], sequences[j])
 
-def _wrap_rxn_tani(args):
-    return reaction_tanimoto_similarity(*args)
+def _flush(S):
+    '''
+    Flushes a memory-mapped output, dense or condensed
+    '''
+    S = S.values if isinstance(S, CondensedSimilarityMatrix) else S
+    if isinstance(S, np.memmap):
+        S.flush()
 
-def _wrap_agg_mfp_cosine(args):
-    return agg_mfp_cosine_similarity(*args)
+def _npy_path(save_to: Path) -> Path:
+    '''
+    Appends .npy like np.save does
+    '''
+    save_to = Path(save_to)
+    return save_to if save_to.suffix == '.npy' else save_to.parent / (save_to.name + '.npy')
 
-def load_similarity_matrix(sim_path: Path, dataset: str, toc: str, sim_metric: str):
-    if sim_metric == 'rcmcs':
-        S = np.load(
-            sim_path / f"{dataset}_{toc}_{sim_metric}.npy"
-        ).astype(np.float32)
+def load_similarity_matrix(sim_path: Path, dataset: str, toc: str, sim_metric: str, sparse: bool = False):
+    '''
+    Loads a saved similarity matrix: a single .npy (dense or condensed) or .npz
+    (sparse) file, or the row chunk .npz shards of gsi / blosum
+
+    Args
+    ----
+    sparse:bool
+        Return sparse files / shards as a symmetric float32 csr_array
+        instead of densifying them. Entries not stored are 0 similarity,
+        or for blosum, raw scores below the --min-similarity they were saved
+        w/, and the diagonal is only present if it was saved
+    '''
+    single = sim_path / f"{dataset}_{toc}_{sim_metric}.npz"
+    single_npy = sim_path / f"{dataset}_{toc}_{sim_metric}.npy"
+    if single.exists():
+        S = sp.load_npz(single).astype(np.float32)
+        if not sparse:
+            S = S.toarray()
+    elif sim_metric == 'rcmcs' or single_npy.exists(): # E.g., merged shards
+        S = np.load(single_npy, mmap_mode='r')
+        if S.ndim == 1: # Saved condensed, kept memory-mapped
+            S = CondensedSimilarityMatrix(S)
+        else:
+            S = S.astype(np.float32)
+    elif sparse:
+        rows, cols, data, n = [], [], [], 0
+        for chunk in similarity_chunks(sim_path, dataset, toc, sim_metric):
+            chunk = chunk.tocoo()
+            n = chunk.shape[1]
+            keep = _similarity_entries(chunk.data, sim_metric)
+            rows.append(chunk.row[keep])
+            cols.append(chunk.col[keep])
+            data.append(chunk.data[keep].astype(np.float32))
+
+        rows, cols, data = (np.concatenate(elt) if elt else np.zeros(shape=(0,), dtype=int) for elt in (rows, cols, data))
+        S = sp.csr_array((np.concatenate([data, data]), (np.concatenate([rows, cols]), np.concatenate([cols, rows]))), shape=(n, n))
     else:
-        for i, file in enumerate(sim_path.glob(f"{dataset}_{toc}_{sim_metric}*.npz")):
-            chunk = sp.load_npz(file).astype(np.float32)
+        for i, chunk in enumerate(similarity_chunks(sim_path, dataset, toc, sim_metric)):
+            chunk = chunk.astype(np.float32).tocoo()
 
             if i == 0:
                 S = np.zeros(shape=(chunk.shape[1], chunk.shape[1]), dtype=np.float32)
             
-            nz_coordinates = chunk.nonzero()
-            S[nz_coordinates] = chunk[nz_coordinates]
+            keep = chunk.data != 0 # Stored zeros must not overwrite other chunks' entries
+            S[chunk.row[keep], chunk.col[keep]] = chunk.data[keep]
 
     return S
 
+def _similarity_entries(data: np.ndarray, sim_metric: str) -> np.ndarray:
+    '''
+    Mask of the stored values of a shard that are entries of S. Raw blosum
+    scores of 0 are real alignment scores, for similarities a stored 0, e.g.,
+    every pair of older unthresholded gsi shards, is the same as none
+    '''
+    if sim_metric == 'blosum':
+        return np.ones(shape=data.shape, dtype=bool)
+
+    return data != 0
+
+def similarity_chunk_files(sim_path: Path, dataset: str, toc: str, sim_metric: str) -> list[Path]:
+    '''
+    Row chunk shards of a matrix, as listed in its manifest if it has
+    one (see scripts/similarity_matrix.py), otherwise found by name
+
+    Raises
+    ------
+    FileNotFoundError
+        If chunks listed in the manifest are missing
+    '''
+    manifest_path = sim_path / f"{dataset}_{toc}_{sim_metric}_manifest.json"
+    if not manifest_path.exists():
+        return list(sim_path.glob(f"{dataset}_{toc}_{sim_metric}_chunk_*.npz"))
+
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+
+    files = [sim_path / chunk['file'] for chunk in manifest['chunks']]
+    missing = [file.name for file in files if not file.exists()]
+    if missing:
+        raise FileNotFoundError(f"{len(missing)} of {len(files)} chunks in {manifest_path.name} are missing, e.g., {missing[:5]}")
+
+    return files
+
+def similarity_chunks(sim_path: Path, dataset: str, toc: str, sim_metric: str) -> Iterable[sp.csr_array]:
+    '''
+    Loads the row chunk shards of a matrix one at a time, see similarity_chunk_files.
+    Chunks listed in a manifest must hold exactly the rows of their entry, so
+    shards of a run w/ different chunks are never mixed in
+
+    Raises
+    ------
+    FileNotFoundError
+        If chunks listed in the manifest are missing
+    ValueError
+        If a chunk holds rows other than those of its manifest entry
+    '''
+    files = similarity_chunk_files(sim_path, dataset, toc, sim_metric)
+    manifest_path = sim_path / f"{dataset}_{toc}_{sim_metric}_manifest.json"
+    if not manifest_path.exists():
+        yield from (sp.load_npz(file) for file in files)
+        return
+
+    with open(manifest_path, 'r') as f:
+        manifest = json.load(f)
+
+    n = manifest['n']
+    for file, entry in zip(files, manifest['chunks']):
+        chunk = sp.csr_array(sp.load_npz(file))
+        rows = np.flatnonzero(np.diff(chunk.indptr))
+        shape = (max(min(entry['end'], n - 1), 0), n) # As saved by _sequence_similarity_chunk
+        if chunk.shape != shape or (len(rows) > 0 and (rows[0] < entry['start'] or rows[-1] >= entry['end'])):
+            raise ValueError(f"{file.name} does not hold rows [{entry['start']}, {entry['end']}) of {n} as listed in {manifest_path.name}")
+
+        yield chunk
+
 if __name__ == '__main__':
     # reaction1 = "CC=O.O>>CC.O.O"
     # reaction2 = "CC=O.O>>CC.O.O"
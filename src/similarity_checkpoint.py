@@ -0,0 +1,147 @@
+'''
+Shard files of completed pair tiles so long similarity
+matrix jobs can be resumed after preemption
+'''
+import os
+import json
+import tempfile
+import numpy as np
+from pathlib import Path
+
+class TileCheckpoint:
+    '''
+    Directory of completed tiles of a similarity matrix job. A tile is
+    a fixed-size block of consecutive pairs of the job's (deterministic)
+    pair stream, saved as tile_<k>.npz w/ its pairs and scores once all
+    of them are scored. The job's parameters are kept in meta.json so a
+    restart with different parameters is refused instead of mixing tiles.
+
+    Args
+    ----
+    directory:Path
+        Where tiles are kept, created if missing
+    meta:dict
+        JSON-serializable job parameters, e.g., shape, dtype, tile size
+    '''
+    def __init__(self, directory: Path, meta: dict):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.meta_path = self.directory / "meta.json"
+        self.meta = dict(meta)
+        if not self._create_meta(): # Another job, e.g., a concurrent shard, wrote it first
+            with open(self.meta_path, 'r') as f:
+                saved = json.load(f)
+
+            mismatched = {k: (saved.get(k), v) for k, v in meta.items() if saved.get(k) != v}
+            if mismatched:
+                raise ValueError(f"Checkpoint {self.directory} was written by a different job: {mismatched}")
+
+            self.meta = saved
+
+        self.done = self._saved_tiles()
+
+    @classmethod
+    def open(cls, directory: Path):
+        '''
+        Opens an existing checkpoint w/ the parameters it was written w/,
+        e.g., to merge the tiles of a sharded job
+        '''
+        meta_path = Path(directory) / "meta.json"
+        if not meta_path.exists():
+            raise FileNotFoundError(f"No checkpoint in {directory}")
+
+        with open(meta_path, 'r') as f:
+            return cls(directory, json.load(f))
+
+    def tile_path(self, k: int) -> Path:
+        return self.directory / f"tile_{k:07d}.npz"
+
+    def save(self, k: int, pairs: np.ndarray, scores: np.ndarray):
+        '''
+        Atomically saves tile k so a killed job never leaves a partial tile
+        '''
+        tmp = self.directory / f"tmp_tile_{k:07d}.npz"
+        np.savez(tmp, pairs=pairs, scores=scores)
+        os.replace(tmp, self.tile_path(k))
+        self.done.add(k)
+
+    def load(self, k: int) -> tuple[np.ndarray]:
+        '''
+        Returns pairs (m x 3, same layout as the pair stream) and scores of tile k
+        '''
+        with np.load(self.tile_path(k)) as tile:
+            return tile['pairs'], tile['scores']
+
+    def finish(self, n_tiles: int, n_pairs: int = None, check: bool = True):
+        '''
+        Records the size of the fully enumerated pair stream
+        and checks every tile of it has been saved
+
+        Args
+        ----
+        n_tiles:int
+        n_pairs:int
+            Pairs the tiles should hold in total, None if
+            not known, e.g., to a shard that pruned only its own tiles
+        check:bool
+            Check coverage, False for a shard that only saved its own tiles
+
+        Raises
+        ------
+        RuntimeError
+            If tiles are missing or hold a different number of pairs
+        '''
+        self.meta.update(n_tiles=n_tiles, n_pairs=n_pairs)
+        self._write_meta()
+        if check:
+            self.check_coverage()
+
+    def check_coverage(self):
+        if 'n_tiles' not in self.meta:
+            raise RuntimeError(f"Checkpoint {self.directory} has no finished run recording its number of tiles")
+
+        self.done = self._saved_tiles() # Incl. those other shards saved since
+        missing = sorted(set(range(self.meta['n_tiles'])) - self.done)
+        if missing:
+            raise RuntimeError(f"Checkpoint {self.directory} is missing {len(missing)} tiles, e.g., {missing[:10]}")
+
+        if self.meta['n_pairs'] is None:
+            return
+
+        n_saved = sum(len(self.load(k)[1]) for k in range(self.meta['n_tiles']))
+        if n_saved != self.meta['n_pairs']:
+            raise RuntimeError(f"Checkpoint {self.directory} holds {n_saved} pairs, expected {self.meta['n_pairs']}")
+
+    def _saved_tiles(self) -> set[int]:
+        return {int(path.stem.split('_')[1]) for path in self.directory.glob("tile_*.npz")}
+
+    def _create_meta(self) -> bool:
+        '''
+        Links a complete meta.json into place unless one exists,
+        so of several concurrent jobs exactly one creates it
+
+        Returns
+        -------
+        :bool
+            Whether this job created it
+        '''
+        tmp = self._dump_meta()
+        try:
+            os.link(tmp, self.meta_path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp)
+
+    def _write_meta(self):
+        os.replace(self._dump_meta(), self.meta_path)
+
+    def _dump_meta(self) -> Path:
+        '''
+        Writes meta to a temporary file of its own, never shared w/ other jobs
+        '''
+        with tempfile.NamedTemporaryFile('w', dir=self.directory, prefix="tmp_meta_", suffix=".json", delete=False) as f:
+            json.dump(self.meta, f)
+
+        return Path(f.name)
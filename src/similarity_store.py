@@ -0,0 +1,83 @@
+'''
+Persistent store of pairwise similarity scores so matrix
+rebuilds only compute pairs that have not been seen before
+'''
+import sqlite3
+import json
+import hashlib
+import numpy as np
+from pathlib import Path
+from typing import Iterable
+
+def content_hash(obj) -> str:
+    '''
+    Stable hash of a JSON-serializable object, e.g., the fields of a
+    reaction entry a similarity score depends on
+    '''
+    return hashlib.blake2b(json.dumps(obj, sort_keys=True).encode(), digest_size=12).hexdigest()
+
+class SimilarityStore:
+    '''
+    SQLite-backed store of pairwise scores keyed by metric (name + parameters)
+    and the content hashes of both items. Pair keys are order-normalized
+    so (a, b) and (b, a) share an entry.
+
+    Args
+    ----
+    path:Path
+        SQLite database file, created if missing
+    commit_every:int
+        Number of inserted scores between commits
+    '''
+    def __init__(self, path: Path, commit_every: int = 100_000):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS scores ("
+            "metric TEXT, key_1 TEXT, key_2 TEXT, score REAL, "
+            "PRIMARY KEY (metric, key_1, key_2)) WITHOUT ROWID"
+        )
+        self.conn.execute("CREATE TEMP TABLE query (idx INTEGER, key_1 TEXT, key_2 TEXT)")
+        self.commit_every = commit_every
+        self._uncommitted = 0
+
+    def get_many(self, metric: str, keys_1: Iterable[str], keys_2: Iterable[str]) -> np.ndarray:
+        '''
+        Returns stored scores of the given pairs, nan where missing
+        '''
+        query = [(idx, *sorted(pair)) for idx, pair in enumerate(zip(keys_1, keys_2))]
+        scores = np.full(shape=(len(query),), fill_value=np.nan)
+        self.conn.executemany("INSERT INTO query VALUES (?, ?, ?)", query)
+        rows = self.conn.execute(
+            "SELECT query.idx, scores.score FROM query JOIN scores "
+            "ON scores.metric = ? AND scores.key_1 = query.key_1 AND scores.key_2 = query.key_2",
+            (metric,)
+        ).fetchall()
+        self.conn.execute("DELETE FROM query")
+
+        if rows:
+            idxs, found = zip(*rows)
+            scores[list(idxs)] = found
+
+        return scores
+
+    def put_many(self, metric: str, keys_1: Iterable[str], keys_2: Iterable[str], scores: Iterable[float]):
+        rows = [(metric, *sorted(pair), float(score)) for pair, score in zip(zip(keys_1, keys_2), scores)]
+        self.conn.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)", rows)
+        self._uncommitted += len(rows)
+        if self._uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self._uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,130 @@
+'''
+Toy reactions and sequences shared by the tests, and their similarity
+matrices computed the baseline way: dense, unsharded, unpruned
+'''
+import pytest
+import numpy as np
+import pandas as pd
+from Bio import Align
+from Bio.Align import substitution_matrices
+from rdkit import RDLogger
+from src.similarity import rcmcs_similarity_matrix, mcs_similarity_matrix, homology_similarity_matrix
+
+RDLogger.DisableLog("rdApp.*")
+
+RULES = pd.DataFrame(
+    {
+        'Name': ['ruleOx', 'ruleRed', 'ruleAmOx', 'ruleAmRed', 'ruleX', 'ruleY'],
+        'SMARTS': [
+            '[#6:1]-[#8:2]>>[#6:1]=[#8:2]',
+            '[#6:1]=[#8:2]>>[#6:1]-[#8:2]',
+            '[#6:1]-[#7:2]>>[#6:1]=[#7:2]',
+            '[#6:1]=[#7:2]>>[#6:1]-[#7:2]',
+            '[#6:1]-[#8:2].[#8:3]>>[#6:1](=[#8:2])-[#8:3]',
+            '[#6:1](=[#8:2])-[#8:3]>>[#6:1]-[#8:2].[#8:3]',
+        ]
+    }
+).set_index('Name')
+
+ALCOHOLS = [ # (alcohol, carbonyl, reaction center)
+    ("CCO", "CC=O", (1, 2)),
+    ("OCC(C)C", "O=CC(C)C", (1, 0)),
+    ("OC1CCCCC1", "O=C1CCCCC1", (1, 0)),
+    ("OCc1ccccc1", "O=Cc1ccccc1", (1, 0)),
+    ("CCCCO", "CCCC=O", (3, 4)),
+    ("OCC(O)CO", "OCC(=O)CO", (3, 2)),
+    ("CC(O)c1ccc(N)cc1", "CC(=O)c1ccc(N)cc1", (1, 2)),
+    ("OCC1OC(O)C(O)C(O)C1O", "O=CC1OC(O)C(O)C(O)C1O", (1, 0)),
+]
+
+AMINES = [
+    ("CCN", "CC=N", (1, 2)),
+    ("NCc1ccccc1", "N=Cc1ccccc1", (1, 0)),
+    ("NC1CCCCC1", "N=C1CCCCC1", (1, 0)),
+]
+
+ACIDS = [ # Two substrate reactions, reaction centers per molecule
+    ("CCO.O", "CC(=O)O", [[(1, 2), (0,)], [(1, 2, 3)]]),
+    ("OCC(C)C.O", "OC(=O)C(C)C", [[(1, 0), (0,)], [(1, 2, 0)]]),
+]
+
+def _toy_reactions() -> dict[str, dict]:
+    smarts_rcs_rules = []
+    for l, r, rc in ALCOHOLS:
+        smarts_rcs_rules.append((f"{l}>>{r}", [[list(rc)], [list(rc)]], ['ruleOx', 'ruleRed']))
+        smarts_rcs_rules.append((f"{r}>>{l}", [[list(rc)], [list(rc)]], ['ruleRed', 'ruleOx']))
+
+    for l, r, rc in AMINES:
+        smarts_rcs_rules.append((f"{l}>>{r}", [[list(rc)], [list(rc)]], ['ruleAmOx', 'ruleAmRed']))
+
+    for l, r, rc in ACIDS:
+        rc = [[list(atoms) for atoms in side] for side in rc]
+        smarts_rcs_rules.append((f"{l}>>{r}", rc, ['ruleX', 'ruleY']))
+        smarts_rcs_rules.append((f"{r}>>{l}", rc[::-1], ['ruleY', 'ruleX']))
+
+    return {f"r{k}": {'smarts': smarts, 'rcs': rcs, 'min_rules': min_rules} for k, (smarts, rcs, min_rules) in enumerate(smarts_rcs_rules)}
+
+def _toy_sequences() -> dict[str, str]:
+    '''
+    Mutants of one base sequence, so identities span the whole range,
+    interleaved w/ unrelated random sequences of other lengths
+    '''
+    rng = np.random.default_rng(1)
+    amino_acids = list("ACDEFGHIKLMNPQRSTVWY")
+    base = ''.join(rng.choice(amino_acids, 60))
+    sequences = {}
+    for k in range(14):
+        seq = list(base if k % 2 == 0 else ''.join(rng.choice(amino_acids, 50 + k)))
+        for _ in range(k * 3):
+            seq[rng.integers(len(seq))] = rng.choice(amino_acids)
+
+        sequences[f"P{k}"] = ''.join(seq)
+
+    return sequences
+
+@pytest.fixture(scope='session')
+def rxns() -> dict[str, dict]:
+    return _toy_reactions()
+
+@pytest.fixture(scope='session')
+def rules() -> pd.DataFrame:
+    return RULES
+
+@pytest.fixture(scope='session')
+def idx(rxns) -> dict[int, str]:
+    return {i: rxn_id for i, rxn_id in enumerate(rxns)}
+
+@pytest.fixture(scope='session')
+def rcmcs_dense(rxns, rules, idx) -> np.ndarray:
+    return np.array(rcmcs_similarity_matrix(rxns, rules, idx))
+
+@pytest.fixture(scope='session')
+def mcs_dense(rxns, idx) -> np.ndarray:
+    return np.array(mcs_similarity_matrix(rxns, idx))
+
+@pytest.fixture(scope='session')
+def sequences() -> dict[str, str]:
+    return _toy_sequences()
+
+@pytest.fixture(scope='session')
+def gsi_aligner() -> Align.PairwiseAligner:
+    aligner = Align.PairwiseAligner(mode="global", scoring="blastp")
+    aligner.open_gap_score = -1e6
+    return aligner
+
+@pytest.fixture(scope='session')
+def blosum_aligner() -> Align.PairwiseAligner:
+    aligner = Align.PairwiseAligner()
+    aligner.substitution_matrix = substitution_matrices.load("BLOSUM62")
+    aligner.open_gap_score = -11
+    aligner.extend_gap_score = -1
+    return aligner
+
+@pytest.fixture(scope='session')
+def gsi_dense(sequences, gsi_aligner) -> np.ndarray:
+    '''
+    Upper triangle of the gsi matrix, as the chunk loaders fill it
+    '''
+    n = len(sequences)
+    S = homology_similarity_matrix(sequences, 0, n, gsi_aligner).astype(np.float32).toarray()
+    return np.pad(S, ((0, n - S.shape[0]), (0, 0)))
@@ -0,0 +1,132 @@
+import numpy as np
+import pytest
+import scipy.sparse as sp
+from sklearn.cluster import AgglomerativeClustering
+from src.clustering import (
+    hierarchy_clusters,
+    load_hierarchy,
+    minimum_spanning_edges,
+    mst_labels,
+    save_hierarchy,
+    streamed_minimum_spanning_edges,
+)
+from src.condensed_matrix import CondensedSimilarityMatrix
+from src.similarity import blosum_similarity_matrix, homology_similarity_matrix, load_similarity_matrix, similarity_chunks
+
+CUTOFFS = [0.05, 0.2, 0.35, 0.5, 0.8] # Distance
+
+def sklearn_labels(S: np.ndarray, d_cutoff: float) -> np.ndarray:
+    '''
+    Single linkage labels as scripts/cluster.py computed them before the spanning tree
+    '''
+    ac = AgglomerativeClustering(n_clusters=None, metric='precomputed', distance_threshold=d_cutoff, linkage='single')
+    return ac.fit(1 - S).labels_
+
+def assert_same_partition(a: np.ndarray, b: np.ndarray):
+    assert len(set(zip(a, b))) == len(set(a)) == len(set(b))
+
+def assert_same_hierarchy(n: int, edges: tuple[np.ndarray], other: tuple[np.ndarray]):
+    '''
+    Same partitions at every cutoff, and the same total weight of the
+    merging edges, which every minimum spanning forest shares
+    '''
+    for d_cutoff in CUTOFFS:
+        assert_same_partition(mst_labels(n, edges, d_cutoff), mst_labels(n, other, d_cutoff))
+
+    weight = lambda d: d[d < 1].sum()
+    assert weight(edges[2]) == pytest.approx(weight(other[2]))
+
+def save_chunks(sim_path, sim_metric, builder, sequences, aligner, rows: list[tuple[int]]):
+    for k, (start, end) in enumerate(rows):
+        sp.save_npz(sim_path / f"ds_toc_{sim_metric}_chunk_{k}.npz", builder(sequences, start, end, aligner))
+
+@pytest.fixture
+def S() -> np.ndarray:
+    rng = np.random.default_rng(0)
+    A = rng.random(size=(40, 40)) ** 4 # Mostly dissimilar, as real matrices
+    S = np.triu(A, 1) + np.triu(A, 1).T
+    np.fill_diagonal(S, 1)
+    return S
+
+def test_spanning_tree_cutoffs_equal_sklearn(S):
+    edges = minimum_spanning_edges(S)
+    assert len(edges[0]) == len(S) - 1
+    for d_cutoff in CUTOFFS:
+        assert_same_partition(mst_labels(len(S), edges, d_cutoff), sklearn_labels(S, d_cutoff))
+
+def test_condensed_and_sparse_inputs_equal_dense(S):
+    dense = minimum_spanning_edges(S)
+    condensed = minimum_spanning_edges(CondensedSimilarityMatrix.from_dense(S))
+    sparse = minimum_spanning_edges(sp.csr_array(np.where(S >= 0.3, S, 0)))
+    for d_cutoff in CUTOFFS:
+        labels = mst_labels(len(S), dense, d_cutoff)
+        assert_same_partition(mst_labels(len(S), condensed, d_cutoff), labels)
+        if d_cutoff <= 0.7: # Only pairs w/ S >= 0.3 can merge
+            assert_same_partition(mst_labels(len(S), sparse, d_cutoff), labels)
+
+def test_upper_triangular_matrices_cluster_like_sklearn(gsi_dense):
+    edges = minimum_spanning_edges(gsi_dense) # Lower triangle left 0, as the gsi loader does
+    for d_cutoff in CUTOFFS:
+        assert_same_partition(mst_labels(len(gsi_dense), edges, d_cutoff), sklearn_labels(gsi_dense, d_cutoff))
+
+def test_rcmcs_clusters_equal_sklearn(rcmcs_dense):
+    edges = minimum_spanning_edges(rcmcs_dense)
+    for d_cutoff in CUTOFFS:
+        assert_same_partition(mst_labels(len(rcmcs_dense), edges, d_cutoff), sklearn_labels(rcmcs_dense, d_cutoff))
+
+@pytest.mark.parametrize('min_similarity', [None, 0.3])
+def test_streamed_gsi_tree_equals_dense(tmp_path, min_similarity, sequences, gsi_aligner, gsi_dense):
+    builder = lambda *args: homology_similarity_matrix(*args, min_similarity=min_similarity)
+    save_chunks(tmp_path, 'gsi', builder, sequences, gsi_aligner, [(0, 3), (3, 9), (9, len(sequences))])
+    n = len(sequences)
+
+    streamed = streamed_minimum_spanning_edges(similarity_chunks(tmp_path, 'ds', 'toc', 'gsi'), n)
+    sparse = minimum_spanning_edges(load_similarity_matrix(tmp_path, 'ds', 'toc', 'gsi', sparse=True))
+    dense = minimum_spanning_edges(np.where(gsi_dense >= (min_similarity or 0), gsi_dense, 0))
+
+    assert_same_hierarchy(n, streamed, dense)
+    assert_same_hierarchy(n, sparse, dense)
+
+def test_streamed_blosum_tree_equals_dense(tmp_path, sequences, blosum_aligner):
+    lb, ub = -50, 300
+    normalize = lambda x: ((np.clip(x, lb, ub) - lb) / (ub - lb)).astype(np.float32) # As scripts/cluster.py
+    save_chunks(tmp_path, 'blosum', blosum_similarity_matrix, sequences, blosum_aligner, [(0, 5), (5, len(sequences))])
+    n = len(sequences)
+
+    raw = blosum_similarity_matrix(sequences, 0, n, blosum_aligner).astype(np.float32).toarray()
+    raw = np.pad(raw, ((0, n - raw.shape[0]), (0, 0)))
+    dense = np.triu(normalize(raw), 1) # Every upper triangle pair is stored, incl. raw scores of 0
+    sparse = load_similarity_matrix(tmp_path, 'ds', 'toc', 'blosum', sparse=True)
+    sparse.data = normalize(sparse.data)
+
+    streamed = streamed_minimum_spanning_edges(similarity_chunks(tmp_path, 'ds', 'toc', 'blosum'), n, transform=normalize)
+    assert_same_hierarchy(n, streamed, minimum_spanning_edges(dense))
+    assert_same_hierarchy(n, minimum_spanning_edges(sparse), minimum_spanning_edges(dense))
+
+def test_stored_raw_blosum_zeros_merge(tmp_path):
+    normalize = lambda x: ((np.clip(x, -100, 100) + 100) / 200).astype(np.float32)
+    chunk = sp.csr_array((np.array([0.0, -100.0]), ([0, 1], [1, 2])), shape=(2, 3)) # Raw 0 is similarity 0.5
+    sp.save_npz(tmp_path / "ds_toc_blosum_chunk_0.npz", chunk)
+
+    streamed = streamed_minimum_spanning_edges(similarity_chunks(tmp_path, 'ds', 'toc', 'blosum'), 3, transform=normalize)
+    sparse = load_similarity_matrix(tmp_path, 'ds', 'toc', 'blosum', sparse=True)
+    sparse.data = normalize(sparse.data)
+
+    for edges in [streamed, minimum_spanning_edges(sparse)]:
+        assert list(zip(*edges)) == [(0, 1, 0.5)]
+
+def test_saved_hierarchy_clusters_equal_sklearn(tmp_path, S):
+    ids = [f"id{i}" for i in range(len(S))]
+    save_hierarchy(tmp_path / "hierarchy.npz", minimum_spanning_edges(S), ids)
+    hierarchy = load_hierarchy(tmp_path / "hierarchy.npz")
+    assert hierarchy[1] == ids
+
+    cutoffs = [95, 80, 65, 50]
+    clusters = hierarchy_clusters(hierarchy, cutoffs)
+    assert list(clusters) == cutoffs
+    assert clusters[80] == hierarchy_clusters(hierarchy, 80)
+    for cutoff, id2cluster in clusters.items():
+        assert_same_partition(np.array([id2cluster[id] for id in ids]), sklearn_labels(S, 1 - cutoff / 100))
+
+    for finer, coarser in zip(cutoffs[:-1], cutoffs[1:]): # Nested
+        assert all(clusters[coarser][a] == clusters[coarser][b] for a in ids for b in ids if clusters[finer][a] == clusters[finer][b])
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from scipy.spatial.distance import squareform
+from src.condensed_matrix import CondensedSimilarityMatrix
+from src.similarity import rcmcs_similarity_matrix
+
+@pytest.fixture
+def S() -> np.ndarray:
+    rng = np.random.default_rng(0)
+    A = rng.random(size=(9, 9)).astype(np.float32)
+    S = np.triu(A, 1) + np.triu(A, 1).T
+    np.fill_diagonal(S, 1)
+    return S
+
+def test_condensed_values_in_squareform_order(S):
+    C = CondensedSimilarityMatrix.from_dense(S, block_size=4)
+    np.testing.assert_array_equal(C.condensed(), squareform(S, checks=False))
+
+def test_indexing_equals_dense(S):
+    C = CondensedSimilarityMatrix.from_dense(S)
+    rows, cols = np.array([3, 0, 8]), np.array([1, 3, 3, 7])
+
+    np.testing.assert_array_equal(np.asarray(C), S)
+    np.testing.assert_array_equal(C[4], S[4])
+    np.testing.assert_array_equal(C[:, 2], S[:, 2])
+    np.testing.assert_array_equal(C[2:6, 1:7], S[2:6, 1:7])
+    np.testing.assert_array_equal(C[np.ix_(rows, cols)], S[np.ix_(rows, cols)])
+    np.testing.assert_array_equal(C[rows, cols[:3]], S[rows, cols[:3]])
+    assert C[5, 5] == 1 and C[2, 7] == S[2, 7]
+
+def test_distance_view_equals_dense(S):
+    D = 1 - CondensedSimilarityMatrix.from_dense(S)
+    np.testing.assert_allclose(np.asarray(D), 1 - S)
+    np.testing.assert_allclose(D.condensed(), squareform(1 - S, checks=False))
+
+def test_set_pairs_and_save_load(tmp_path, S):
+    C = CondensedSimilarityMatrix.empty(len(S), path=tmp_path / "S.npy")
+    i, j = np.triu_indices(len(S), 1)
+    C.set_pairs(j, i, S[i, j]) # Either order
+    np.testing.assert_array_equal(np.asarray(CondensedSimilarityMatrix.load(tmp_path / "S.npy")), S)
+
+def test_condensed_rcmcs_equals_dense(tmp_path, rxns, rules, idx, rcmcs_dense):
+    S = rcmcs_similarity_matrix(rxns, rules, idx, condensed=True, save_to=tmp_path / "S.npy")
+    assert isinstance(S, CondensedSimilarityMatrix)
+    np.testing.assert_array_equal(np.asarray(S), rcmcs_dense)
+
+    S = rcmcs_similarity_matrix(rxns, rules, idx, condensed=True, dt=np.float16)
+    np.testing.assert_allclose(np.asarray(S), rcmcs_dense, atol=1e-3)
@@ -0,0 +1,16 @@
+import pytest
+
+pytest.importorskip("torch") # src.cross_validation imports src.utils
+from src.cross_validation import is_reaction_split
+
+@pytest.mark.parametrize('split_strategy, expected', [
+    ('rcmcs', True),
+    ('mcs', True),
+    ('rcmcs_leader', True),
+    ('mcs_leader', True),
+    ('homology', False),
+    ('esm', False),
+    ('leader', False),
+])
+def test_is_reaction_split(split_strategy, expected):
+    assert is_reaction_split(split_strategy) == expected
@@ -0,0 +1,27 @@
+import warnings
+import numpy as np
+import pytest
+from scipy.special import expit
+from src.similarity import embedding_similarity_matrix, sigmoid
+
+def test_sigmoid_is_stable_and_in_place():
+    z = np.array([-1e4, -30, -1, 0, 1, 30, 1e4], dtype=np.float32)
+    want = expit(z.astype(np.float64))
+    with warnings.catch_warnings():
+        warnings.simplefilter('error') # No overflow
+        out = sigmoid(z)
+
+    assert out is z
+    np.testing.assert_allclose(out, want, rtol=1e-6)
+
+@pytest.mark.parametrize('tile_entries', [1, 20, 2**24])
+def test_tiled_matrix_equals_untiled(tmp_path, tile_entries):
+    rng = np.random.default_rng(0)
+    X, X2 = rng.normal(size=(13, 4)), rng.normal(size=(6, 4))
+    for args in [(X,), (X, X2)]:
+        want = expit(args[0] @ args[-1].T)
+        np.testing.assert_allclose(embedding_similarity_matrix(*args, tile_entries=tile_entries), want, rtol=1e-6)
+
+    S = embedding_similarity_matrix(X, tile_entries=tile_entries, save_to=tmp_path / "S")
+    assert isinstance(S, np.memmap)
+    np.testing.assert_array_equal(np.load(tmp_path / "S.npy"), S)
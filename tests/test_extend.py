@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from src.similarity import (
+    embedding_similarity_matrix,
+    extend_embedding_similarity_matrix,
+    extend_rcmcs_similarity_matrix,
+)
+from src.condensed_matrix import CondensedSimilarityMatrix
+
+@pytest.fixture
+def old_idx(idx) -> dict[int, str]:
+    '''
+    Every other reaction, in another order
+    '''
+    return {k: idx[i] for k, i in enumerate(range(len(idx) - 2, -1, -2))}
+
+@pytest.mark.parametrize('old_format', ['dense', 'condensed'])
+def test_extended_rcmcs_equals_dense(rxns, rules, idx, rcmcs_dense, old_idx, old_format):
+    id_to_idx = {v: k for k, v in idx.items()}
+    old_positions = [id_to_idx[old_idx[k]] for k in range(len(old_idx))]
+    S_old = rcmcs_dense[np.ix_(old_positions, old_positions)]
+    if old_format == 'condensed':
+        S_old = CondensedSimilarityMatrix.from_dense(S_old)
+
+    S = extend_rcmcs_similarity_matrix(S_old, old_idx, rxns, rules, idx)
+    np.testing.assert_array_equal(S, rcmcs_dense)
+
+def test_extended_embedding_equals_dense(idx, old_idx):
+    X = np.random.default_rng(0).normal(size=(len(idx), 8)).astype(np.float32)
+    id_to_idx = {v: k for k, v in idx.items()}
+    old_positions = [id_to_idx[old_idx[k]] for k in range(len(old_idx))]
+    S_old = embedding_similarity_matrix(X[old_positions])
+
+    S = extend_embedding_similarity_matrix(S_old, old_idx, X, idx)
+    S_dense = embedding_similarity_matrix(X)
+    np.testing.assert_allclose(S[np.ix_(old_positions, old_positions)], S_old)
+    np.testing.assert_allclose(S, S_dense, rtol=1e-6)
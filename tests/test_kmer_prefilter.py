@@ -0,0 +1,27 @@
+import numpy as np
+import pytest
+from src.similarity import homology_similarity_matrix, kmer_pair_bound, upper_triangle_pairs
+
+@pytest.mark.parametrize('min_similarity', [0.3, 0.5, 0.7, 0.9])
+def test_bounds_never_below_exact_identity(min_similarity, sequences, gsi_dense):
+    n = len(sequences)
+    pairs = np.array(list(upper_triangle_pairs(0, n - 1, n)))
+    bounds = kmer_pair_bound(sequences, min_similarity)(pairs)
+    exact = gsi_dense[pairs[:, 0], pairs[:, 1]]
+
+    assert np.all(bounds >= exact - 1e-3) # gsi is stored as float16
+    if min_similarity >= 0.7: # k > 1
+        assert np.any(bounds < min_similarity) # Bounds prune something
+
+@pytest.mark.parametrize('min_similarity', [0.5, 0.7])
+def test_prefiltered_chunks_equal_unfiltered(min_similarity, sequences, gsi_aligner):
+    n = len(sequences)
+    pair_bound = kmer_pair_bound(sequences, min_similarity) # Shared by the chunks
+    for start, end in [(0, 5), (5, n)]:
+        S = homology_similarity_matrix(sequences, start, end, gsi_aligner, min_similarity=min_similarity)
+        prefiltered = homology_similarity_matrix(sequences, start, end, gsi_aligner, min_similarity=min_similarity, kmer_prefilter=True)
+        shared = homology_similarity_matrix(sequences, start, end, gsi_aligner, min_similarity=min_similarity, pair_bound=pair_bound)
+
+        S = S.astype(np.float32).toarray()
+        np.testing.assert_array_equal(prefiltered.astype(np.float32).toarray(), S)
+        np.testing.assert_array_equal(shared.astype(np.float32).toarray(), S)
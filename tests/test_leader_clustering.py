@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+from src.similarity import leader_clusters, mcs_bound_features, mcs_pair_bounds
+
+CUTOFFS = [90, 60, 30]
+
+def pair_bound(rxns, idx, rcmcs: bool, a: int, b: int) -> float:
+    i, j = min(a, b), max(a, b)
+    flip = rxns[idx[i]]['min_rules'] != rxns[idx[j]]['min_rules']
+    smarts = [rxns[idx[k]]['smarts'] for k in range(len(idx))]
+    rcs = [rxns[idx[k]]['rcs'] for k in range(len(idx))] if rcmcs else None
+    return mcs_pair_bounds(np.array([[i, j, flip]]), mcs_bound_features(smarts, rcs))[0]
+
+@pytest.mark.parametrize('metric, reverse', [('rcmcs', False), ('rcmcs', True), ('mcs', False)])
+def test_leader_clusters_invariants(metric, reverse, rxns, rules, idx, request):
+    S = request.getfixturevalue(f"{metric}_dense")
+    order = np.arange(len(idx))[::-1] if reverse else np.arange(len(idx))
+    labels = leader_clusters(rxns, idx, CUTOFFS, rules=rules if metric == 'rcmcs' else None, order=order)
+
+    assert list(labels) == CUTOFFS
+    for cutoff, cutoff_labels in labels.items():
+        min_similarity = cutoff / 100
+        leaders = {} # Cluster -> leader, the first of it visited
+        for i in order:
+            label = cutoff_labels[i]
+            if label not in leaders:
+                assert all(S[i, leader] < min_similarity for leader in leaders.values())
+                leaders[label] = i
+                continue
+
+            # Joins the highest-bound leader reaching the cutoff
+            assert S[i, leaders[label]] >= min_similarity
+            reaching = [leader for leader in leaders.values() if S[i, leader] >= min_similarity]
+            bounds = {leader: pair_bound(rxns, idx, metric == 'rcmcs', i, leader) for leader in reaching}
+            assert bounds[leaders[label]] == max(bounds.values())
+
+        assert sorted(leaders) == list(range(len(leaders))) # Numbered in order of creation
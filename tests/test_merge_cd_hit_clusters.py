@@ -0,0 +1,67 @@
+import copy
+import numpy as np
+import pytest
+import scipy.sparse as sp
+from src.condensed_matrix import CondensedSimilarityMatrix
+from src.similarity import merge_cd_hit_clusters
+
+def brute_force_merge(pairs, Drxn, sim_i_to_rxn_id, cd_hit_clusters, distance_cutoff) -> dict:
+    '''
+    Visits every pair of pairs, merging their clusters if their reactions are close
+    '''
+    rxn2i = {v: k for k, v in sim_i_to_rxn_id.items()}
+    cd_hit_clusters = copy.deepcopy(cd_hit_clusters)
+    upid2cluster = {upid: cluster for cluster, upids in cd_hit_clusters.items() for upid in upids}
+    for a, (upid_1, rxnid_1) in enumerate(pairs):
+        for upid_2, rxnid_2 in pairs[a:]:
+            if upid_1 not in upid2cluster or upid_2 not in upid2cluster:
+                continue
+
+            cluster_1, cluster_2 = upid2cluster[upid_1], upid2cluster[upid_2]
+            if cluster_1 != cluster_2 and Drxn[rxn2i[rxnid_1], rxn2i[rxnid_2]] < distance_cutoff:
+                for upid in cd_hit_clusters.pop(cluster_2):
+                    upid2cluster[upid] = cluster_1
+                    cd_hit_clusters[cluster_1].append(upid)
+
+    return {(upid, rxnid): upid2cluster[upid] for upid, rxnid in pairs if upid in upid2cluster}
+
+def partition(id2cluster: dict) -> list[list]:
+    clusters = {}
+    for id, cluster in id2cluster.items():
+        clusters.setdefault(cluster, []).append(id)
+
+    return sorted(sorted(ids) for ids in clusters.values())
+
+@pytest.mark.parametrize('seed', range(40))
+def test_merge_equals_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    n_rxns, n_prots, n_clusters = rng.integers(2, 25), rng.integers(2, 40), rng.integers(1, 15)
+    S = rng.random(size=(n_rxns, n_rxns))
+    S = np.round((S + S.T) / 2, 1) # Ties at the cutoff
+    if seed % 2:
+        np.fill_diagonal(S, 1)
+
+    D = 1 - S
+    sim_i_to_rxn_id = {i: f"R{i}" for i in range(n_rxns)}
+    cd_hit_clusters = {}
+    for p in rng.permutation(n_prots):
+        if rng.random() < 0.9: # Some proteins unclustered
+            cd_hit_clusters.setdefault(int(rng.integers(n_clusters)) * 7, []).append(f"P{p}")
+
+    pairs = sorted({(f"P{rng.integers(n_prots)}", f"R{rng.integers(n_rxns)}") for _ in range(rng.integers(1, 60))})
+    distance_cutoff = float(rng.choice([0.0, 0.15, 0.3, 0.55]))
+    clusters_before = copy.deepcopy(cd_hit_clusters)
+
+    want = brute_force_merge(pairs, D, sim_i_to_rxn_id, cd_hit_clusters, distance_cutoff)
+    outputs = [merge_cd_hit_clusters(pairs, D, sim_i_to_rxn_id, cd_hit_clusters, distance_cutoff, tile_entries=int(rng.integers(1, 100)))]
+    if seed % 2: # Condensed and neighbor list inputs have reactions at distance 0 from themselves
+        outputs.append(merge_cd_hit_clusters(pairs, 1 - CondensedSimilarityMatrix.from_dense(S), sim_i_to_rxn_id, cd_hit_clusters, distance_cutoff))
+        close = D < distance_cutoff
+        outputs.append(merge_cd_hit_clusters(pairs, sp.csr_array((D[close], np.nonzero(close)), shape=D.shape), sim_i_to_rxn_id, cd_hit_clusters, distance_cutoff))
+
+    assert cd_hit_clusters == clusters_before # Not modified
+    upid2cluster = {upid: cluster for cluster, upids in cd_hit_clusters.items() for upid in upids}
+    for id2cluster in outputs:
+        assert partition(id2cluster) == partition(want)
+        for ids in partition(id2cluster): # Labeled by their lowest cd-hit cluster
+            assert id2cluster[ids[0]] == min(upid2cluster[upid] for upid, _ in ids)
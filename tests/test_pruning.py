@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+from src.similarity import (
+    mcs_bound_features,
+    mcs_pair_bounds,
+    mcs_similarity_matrix,
+    pair_chunks,
+    rcmcs_similarity_matrix,
+    rule_compatible_pairs,
+)
+
+@pytest.fixture(scope='module')
+def pairs(rxns, idx) -> np.ndarray:
+    return np.concatenate(list(pair_chunks(rule_compatible_pairs(rxns, idx), 2**14)))
+
+@pytest.mark.parametrize('metric', ['mcs', 'rcmcs'])
+def test_bounds_never_below_exact_scores(metric, rxns, idx, pairs, request):
+    S = request.getfixturevalue(f"{metric}_dense")
+    smarts = [rxns[idx[i]]['smarts'] for i in range(len(idx))]
+    rcs = [rxns[idx[i]]['rcs'] for i in range(len(idx))] if metric == 'rcmcs' else None
+
+    bounds = mcs_pair_bounds(pairs, mcs_bound_features(smarts, rcs))
+    exact = S[pairs[:, 0], pairs[:, 1]]
+
+    assert np.all(bounds >= exact - 1e-6)
+    assert np.any(bounds < 1) # Bounds prune something
+
+@pytest.mark.parametrize('min_similarity', [0.2, 0.5, 0.8])
+def test_pruned_rcmcs_equals_thresholded_dense(min_similarity, rxns, rules, idx, rcmcs_dense):
+    S = rcmcs_similarity_matrix(rxns, rules, idx, min_similarity=min_similarity)
+    np.testing.assert_array_equal(S.toarray(), np.where(rcmcs_dense >= min_similarity, rcmcs_dense, 0))
+
+@pytest.mark.parametrize('min_similarity', [0.2, 0.5, 0.8])
+def test_pruned_mcs_equals_thresholded_dense(min_similarity, rxns, idx, mcs_dense):
+    S = mcs_similarity_matrix(rxns, idx, min_similarity=min_similarity)
+    np.testing.assert_array_equal(S.toarray(), np.where(mcs_dense >= min_similarity, mcs_dense, 0))
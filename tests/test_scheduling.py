@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+import src.similarity as similarity
+from src.similarity import cost_balanced_chunks, rcmcs_similarity_matrix
+
+@pytest.mark.parametrize('n_chunks, max_chunk_size', [(1, 256), (4, 256), (8, 3), (100, 256)])
+def test_chunks_cover_every_pair_once_most_expensive_first(n_chunks, max_chunk_size):
+    rng = np.random.default_rng(0)
+    pairs = np.stack([np.arange(50), np.arange(50) + 1, np.zeros(50, dtype=int)], axis=1)
+    costs = rng.lognormal(sigma=2, size=50)
+
+    chunks = list(cost_balanced_chunks(pairs, costs, n_chunks, max_chunk_size))
+    dispatched = np.concatenate(chunks)
+
+    assert sorted(map(tuple, dispatched)) == sorted(map(tuple, pairs))
+    assert all(0 < len(chunk) <= max_chunk_size for chunk in chunks)
+    assert np.all(np.diff(costs[dispatched[:, 0]]) <= 0)
+
+def test_matrix_unchanged_by_cost_ordering(monkeypatch, rxns, rules, idx, rcmcs_dense):
+    streamed = similarity.streamed_similarity_matrix
+    monkeypatch.setattr(similarity, 'streamed_similarity_matrix', lambda **kwargs: streamed(**{**kwargs, 'pair_cost': None}))
+    S = rcmcs_similarity_matrix(rxns, rules, idx)
+    np.testing.assert_array_equal(S, rcmcs_dense)
@@ -0,0 +1,59 @@
+import json
+import numpy as np
+import pytest
+import scipy.sparse as sp
+from src.similarity import balanced_row_chunks, homology_similarity_matrix, load_similarity_matrix
+
+def save_chunks(sim_path, sequences, chunks, aligner) -> dict:
+    '''
+    Row chunk shards and manifest laid out as scripts/similarity_matrix.py saves them
+    '''
+    n = len(sequences)
+    manifest = {
+        'n': n,
+        'ids': list(sequences),
+        'chunks': [
+            {'chunk': i, 'start': start, 'end': end, 'file': f"ds_toc_gsi_chunk_{i}_rows_{start}_{end}.npz"}
+            for i, (start, end) in enumerate(chunks)
+        ]
+    }
+    for entry in manifest['chunks']:
+        sp.save_npz(sim_path / entry['file'], homology_similarity_matrix(sequences, entry['start'], entry['end'], aligner))
+
+    with open(sim_path / "ds_toc_gsi_manifest.json", 'w') as f:
+        json.dump(manifest, f)
+
+    return manifest
+
+@pytest.mark.parametrize('n_chunks', [1, 3, 7])
+def test_balanced_chunks_cover_rows_in_order(n_chunks):
+    lengths = np.random.default_rng(0).integers(10, 500, size=40)
+    chunks = balanced_row_chunks(lengths, n_chunks)
+
+    assert chunks[0][0] == 0 and chunks[-1][1] == len(lengths)
+    assert all(end == start for (_, end), (start, _) in zip(chunks[:-1], chunks[1:]))
+    assert all(start < end for start, end in chunks)
+    assert len(chunks) <= n_chunks
+
+@pytest.mark.parametrize('balanced', [False, True])
+def test_chunked_matrix_equals_dense(tmp_path, balanced, sequences, gsi_aligner, gsi_dense):
+    n = len(sequences)
+    if balanced:
+        chunks = balanced_row_chunks([len(seq) for seq in sequences.values()], 4)
+    else:
+        chunks = [(start, min(start + 4, n)) for start in range(0, n, 4)]
+
+    save_chunks(tmp_path, sequences, chunks, gsi_aligner)
+    S = load_similarity_matrix(tmp_path, 'ds', 'toc', 'gsi')
+    np.testing.assert_array_equal(S, gsi_dense)
+
+def test_chunks_of_other_rows_are_refused(tmp_path, sequences, gsi_aligner):
+    manifest = save_chunks(tmp_path, sequences, [(0, 5), (5, 10), (10, len(sequences))], gsi_aligner)
+    first, second = (tmp_path / entry['file'] for entry in manifest['chunks'][:2])
+    first.write_bytes(second.read_bytes())
+    with pytest.raises(ValueError):
+        load_similarity_matrix(tmp_path, 'ds', 'toc', 'gsi')
+
+    second.unlink()
+    with pytest.raises(FileNotFoundError):
+        load_similarity_matrix(tmp_path, 'ds', 'toc', 'gsi')
@@ -0,0 +1,78 @@
+from functools import partial
+import multiprocessing as mp
+import numpy as np
+import pytest
+import src.similarity as similarity
+from src.similarity import assemble_similarity_tiles, embedding_similarity_matrix, rcmcs_similarity_matrix
+from src.similarity_checkpoint import TileCheckpoint
+
+N_SHARDS = 3
+
+def thresholded(S: np.ndarray, min_similarity: float) -> np.ndarray:
+    return S if min_similarity is None else np.where(S >= min_similarity, S, 0)
+
+def as_dense(S) -> np.ndarray:
+    return S.toarray() if hasattr(S, 'toarray') else np.asarray(S)
+
+@pytest.fixture
+def small_tiles(monkeypatch):
+    monkeypatch.setattr(similarity, 'streamed_similarity_matrix', partial(similarity.streamed_similarity_matrix, tile_size=8))
+
+@pytest.mark.parametrize('min_similarity', [None, 0.5])
+def test_merged_rcmcs_shards_equal_unsharded(tmp_path, small_tiles, min_similarity, rxns, rules, idx, rcmcs_dense):
+    for i in reversed(range(N_SHARDS)): # Any order
+        assert rcmcs_similarity_matrix(rxns, rules, idx, checkpoint_dir=tmp_path, min_similarity=min_similarity, shard=(i, N_SHARDS)) is None
+
+    want = thresholded(rcmcs_dense, min_similarity)
+    for output in ['dense', 'sparse', 'condensed']:
+        S = assemble_similarity_tiles(tmp_path, output=output)
+        np.testing.assert_array_equal(thresholded(as_dense(S), min_similarity), want)
+
+def test_merge_refuses_missing_shard(tmp_path, small_tiles, rxns, rules, idx):
+    for i in range(N_SHARDS - 1):
+        rcmcs_similarity_matrix(rxns, rules, idx, checkpoint_dir=tmp_path, shard=(i, N_SHARDS))
+
+    with pytest.raises(RuntimeError, match="missing"):
+        assemble_similarity_tiles(tmp_path)
+
+def _embedding_shard(X, i, checkpoint_dir, min_similarity):
+    embedding_similarity_matrix(X, shard=(i, N_SHARDS), checkpoint_dir=checkpoint_dir, min_similarity=min_similarity, tile_entries=20)
+
+@pytest.mark.parametrize('min_similarity', [None, 0.6])
+def test_concurrent_embedding_shards_equal_unsharded(tmp_path, min_similarity):
+    X = np.random.default_rng(0).normal(size=(17, 4)).astype(np.float32)
+    shards = [mp.Process(target=_embedding_shard, args=(X, i, tmp_path, min_similarity)) for i in range(N_SHARDS)]
+    for shard in shards:
+        shard.start()
+
+    for shard in shards:
+        shard.join()
+        assert shard.exitcode == 0
+
+    want = thresholded(embedding_similarity_matrix(X), min_similarity)
+    for output in ['dense', 'sparse']:
+        S = assemble_similarity_tiles(tmp_path, output=output)
+        np.testing.assert_allclose(thresholded(as_dense(S), min_similarity), want, rtol=1e-6)
+
+def _open_checkpoint(directory, meta, barrier, outcomes):
+    barrier.wait() # All at once
+    try:
+        TileCheckpoint(directory, meta)
+        outcomes.put('ok')
+    except Exception as e:
+        outcomes.put(repr(e))
+
+@pytest.mark.parametrize('attempt', range(10)) # Races are not certain to occur in any one attempt
+def test_concurrent_shards_create_one_meta(tmp_path, attempt):
+    meta, n_shards = {'shape': [5, 5], 'tile_size': 8}, 16
+    barrier, outcomes = mp.Barrier(n_shards), mp.Queue()
+    shards = [mp.Process(target=_open_checkpoint, args=(tmp_path, meta, barrier, outcomes)) for _ in range(n_shards)]
+    for shard in shards:
+        shard.start()
+
+    for shard in shards:
+        shard.join()
+
+    assert {outcomes.get() for _ in shards} == {'ok'}
+    assert [path.name for path in tmp_path.iterdir()] == ["meta.json"] # No temporary files left
+    assert TileCheckpoint.open(tmp_path).meta == meta
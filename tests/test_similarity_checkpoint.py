@@ -0,0 +1,41 @@
+from functools import partial
+import numpy as np
+import pytest
+import src.similarity as similarity
+from src.similarity import rcmcs_similarity_matrix
+from src.similarity_checkpoint import TileCheckpoint
+
+@pytest.fixture
+def small_tiles(monkeypatch):
+    '''
+    Several tiles even for the toy reactions
+    '''
+    monkeypatch.setattr(similarity, 'streamed_similarity_matrix', partial(similarity.streamed_similarity_matrix, tile_size=8))
+
+def test_resumed_job_equals_dense(tmp_path, small_tiles, rxns, rules, idx, rcmcs_dense):
+    checkpoint_dir = tmp_path / "checkpoint"
+    S = rcmcs_similarity_matrix(rxns, rules, idx, checkpoint_dir=checkpoint_dir)
+    np.testing.assert_array_equal(S, rcmcs_dense)
+
+    tiles = sorted(checkpoint_dir.glob("tile_*.npz"))
+    assert len(tiles) > 2
+    for tile in tiles[::2]: # As if preempted
+        tile.unlink()
+
+    S = rcmcs_similarity_matrix(rxns, rules, idx, checkpoint_dir=checkpoint_dir)
+    np.testing.assert_array_equal(S, rcmcs_dense)
+    assert len(list(checkpoint_dir.glob("tile_*.npz"))) == len(tiles)
+
+def test_checkpoint_of_other_job_is_refused(tmp_path):
+    TileCheckpoint(tmp_path, {'shape': [5, 5], 'tile_size': 8})
+    TileCheckpoint(tmp_path, {'shape': [5, 5], 'tile_size': 8})
+    with pytest.raises(ValueError):
+        TileCheckpoint(tmp_path, {'shape': [5, 5], 'tile_size': 16})
+
+def test_missing_tiles_are_reported(tmp_path):
+    checkpoint = TileCheckpoint(tmp_path, {'shape': [5, 5]})
+    pairs = np.array([[0, 1, 0]])
+    checkpoint.save(0, pairs, np.array([0.5]))
+    checkpoint.save(2, pairs, np.array([0.5]))
+    with pytest.raises(RuntimeError, match="missing 1 tiles"):
+        checkpoint.finish(n_tiles=3)
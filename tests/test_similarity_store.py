@@ -0,0 +1,39 @@
+import sqlite3
+import numpy as np
+from src.similarity import rcmcs_similarity_matrix, n_rule_compatible_pairs
+from src.similarity_store import SimilarityStore
+
+def test_scores_round_trip_in_either_pair_order(tmp_path):
+    with SimilarityStore(tmp_path / "store.sqlite") as store:
+        store.put_many('rcmcs:norm=max', ['a', 'b'], ['b', 'c'], [0.5, 0.25])
+
+    with SimilarityStore(tmp_path / "store.sqlite") as store:
+        scores = store.get_many('rcmcs:norm=max', ['b', 'c', 'a'], ['a', 'b', 'c'])
+        other_metric = store.get_many('mcs:norm=max', ['a'], ['b'])
+
+    np.testing.assert_array_equal(scores[:2], [0.5, 0.25])
+    assert np.isnan(scores[2])
+    assert np.isnan(other_metric).all()
+
+def test_store_fills_in_matrix_of_more_reactions(tmp_path, rxns, rules, idx, rcmcs_dense):
+    path = tmp_path / "store.sqlite"
+    sub_idx = {i: idx[i] for i in range(len(idx) // 2)}
+    with SimilarityStore(path) as store:
+        S_sub = rcmcs_similarity_matrix(rxns, rules, sub_idx, store=store)
+
+    n_sub = len(sub_idx)
+    np.testing.assert_array_equal(S_sub, rcmcs_dense[:n_sub, :n_sub])
+
+    with SimilarityStore(path) as store:
+        S = rcmcs_similarity_matrix(rxns, rules, idx, store=store)
+
+    np.testing.assert_array_equal(S, rcmcs_dense)
+
+    with sqlite3.connect(path) as conn: # Every scored pair stored once
+        n_stored = conn.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+
+    assert n_stored == n_rule_compatible_pairs(rxns, idx)
+    with SimilarityStore(path) as store: # All pairs found, nothing rescored
+        S = rcmcs_similarity_matrix(rxns, rules, idx, store=store)
+
+    np.testing.assert_array_equal(S, rcmcs_dense)
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+import scipy.sparse as sp
+from src.similarity import (
+    agg_mfp_cosine_similarity_matrix,
+    blosum_similarity_matrix,
+    embedding_similarity_matrix,
+    homology_similarity_matrix,
+    load_similarity_matrix,
+    tanimoto_similarity_matrix,
+)
+
+def thresholded(S: np.ndarray, min_similarity: float) -> np.ndarray:
+    return np.where(S >= min_similarity, S, 0)
+
+@pytest.mark.parametrize('builder', [tanimoto_similarity_matrix, agg_mfp_cosine_similarity_matrix])
+def test_sparse_reaction_fingerprint_matrix_equals_thresholded_dense(builder, rxns, idx):
+    dense = np.asarray(builder(rxns, idx))
+    S = builder(rxns, idx, min_similarity=0.4)
+    assert sp.issparse(S)
+    np.testing.assert_array_equal(S.toarray(), thresholded(dense, 0.4))
+
+def test_sparse_embedding_matrix_equals_thresholded_dense():
+    rng = np.random.default_rng(0)
+    X, X2 = rng.normal(size=(9, 4)).astype(np.float32), rng.normal(size=(5, 4)).astype(np.float32)
+    for args in [(X,), (X, X2)]:
+        dense = embedding_similarity_matrix(*args)
+        S = embedding_similarity_matrix(*args, min_similarity=0.6, tile_entries=10)
+        np.testing.assert_allclose(S.toarray(), thresholded(dense, 0.6), rtol=1e-6) # Tiled matmuls may round differently
+
+@pytest.mark.parametrize('builder, aligner, min_similarity', [
+    (homology_similarity_matrix, 'gsi_aligner', 0.3),
+    (blosum_similarity_matrix, 'blosum_aligner', 50),
+])
+def test_sparse_sequence_chunk_equals_thresholded_dense(builder, aligner, min_similarity, sequences, request):
+    aligner = request.getfixturevalue(aligner)
+    dense = builder(sequences, 4, 9, aligner).astype(np.float32).toarray()
+    S = builder(sequences, 4, 9, aligner, min_similarity=min_similarity)
+    assert S.shape == dense.shape
+    np.testing.assert_array_equal(S.astype(np.float32).toarray(), thresholded(dense, min_similarity))
+
+@pytest.mark.parametrize('sim_metric, n_entries', [('blosum', 2 * 3), ('gsi', 2 * 2)])
+def test_loading_sparse_chunks_keeps_raw_blosum_zeros(tmp_path, sim_metric, n_entries):
+    i, j, scores = np.array([0, 0, 1]), np.array([1, 2, 2]), np.array([7.0, 0.0, -3.0])
+    chunk = sp.csr_array((scores, (i, j)), shape=(2, 3)).astype(np.float16)
+    sp.save_npz(tmp_path / f"ds_toc_{sim_metric}_chunk_0.npz", chunk)
+
+    S = load_similarity_matrix(tmp_path, 'ds', 'toc', sim_metric, sparse=True)
+    assert S.nnz == n_entries # Mirrored, gsi drops the stored 0
+    np.testing.assert_array_equal(S.toarray(), sp.csr_array((np.tile(scores, 2), (np.r_[i, j], np.r_[j, i])), shape=(3, 3)).toarray())